@@ -2,6 +2,8 @@ import time
 import pendulum as pm
 import os
 import src.python.rdams_client as rc
+from src.metadata import MetadataIndex
+from src.scheduler import Backlog
 
 
 WAIT_INTERVAL = int(os.getenv('WAIT_INTERVAL', 60*5))
@@ -47,87 +49,75 @@ def purge_request(request_id: str):
     else:
         print(pm.now(), f'Purge failed for request with id {request_id}')
 
-def get_instant_products(metadata):
+def get_instant_products(index):
     # wind/temperature/humidity/pressure - exclude analysis and averages
-    param_vars = list(filter(lambda x: x['param'] == 'TMP', metadata))
-    products = list(set([item['product'] for item in param_vars if 'Forecast' in item['product']]))
-    return products
+    return index.products('TMP', 'Forecast')
 
-def get_precip_products(metadata):
+def get_precip_products(index):
     # precipitation - total accumulated only available after 2019-06-12, before that only 3- and 6-hour accumulated are available
-    param_vars = list(filter(lambda x: x['param'] == 'A PCP', metadata))
-    #products = list(set([item['product'] for item in param_vars if '(initial+0 ' in item['product']]))
-    #products = list(set([item['product'] for item in param_vars if item['product'].startswith('3-hour') or item['product'].startswith('6-hour')]))
-    products = sorted(list(set([item['product'] for item in param_vars if item['product'].startswith('12-hour')])))[1:]
-    return products
+    #products = index.products('A PCP', r'\(initial\+0 ')
+    #products = index.products('A PCP', '^[36]-hour')
+    return sorted(index.products('A PCP', '^12-hour'))[1:]
 
-def get_solar_products(metadata):
+def get_solar_products(index):
     # solar - all products (for hours > 240, 12 hour averages are returned before 2019-06-12, and 6 hour averages after)
-    param_vars = list(filter(lambda x: x['param'] == 'DSWRF', metadata))
-    products = list(set([item['product'] for item in param_vars]))
-    return products
+    return index.products('DSWRF')
 
-def get_cloud_cover_products(metadata):
-    param_vars = list(filter(lambda x: x['param'] == 'T CDC', metadata))
-    products = list(set([item['product'] for item in param_vars if 'Forecast' in item['product']]))
-    return products
+def get_cloud_cover_products(index):
+    return index.products('T CDC', 'Forecast')
 
-def get_cloud_cover_old_products(metadata):
+def get_cloud_cover_old_products(index):
     # cloud cover is average, as solar, before 2021-03-22
-    param_vars = list(filter(lambda x: x['param'] == 'DSWRF', metadata))
-    products = list(set([item['product'] for item in param_vars]))
-    return products
+    return index.products('DSWRF')
 
-def get_frozen_precip_products(metadata):
-    param_vars = list(filter(lambda x: x['param'] == 'CPOFP', metadata))
-    products = list(set([item['product'] for item in param_vars if 'Forecast' in item['product']]))
-    return products
+def get_frozen_precip_products(index):
+    return index.products('CPOFP', 'Forecast')
 
-def get_parameter_set(set_name, metadata):
+def get_parameter_set(set_name, index):
     if set_name == 'all':
         params = 'TMP/U GRD/V GRD/R H/DSWRF/A PCP/PRMSL'
         levels = 'HTGL:2/10/100;SFC:0;MSL:0'
-        products = '/'.join(get_instant_products(metadata) + get_precip_products(metadata) + get_solar_products(metadata))
+        products = '/'.join(get_instant_products(index) + get_precip_products(index) + get_solar_products(index))
         return params, levels, products
     elif set_name == 'all_except_temp':
         params = 'U GRD/V GRD/R H/DSWRF/A PCP/PRMSL'
         levels = 'HTGL:2/10/100;SFC:0;MSL:0'
-        products = '/'.join(get_instant_products(metadata) + get_precip_products(metadata) + get_solar_products(metadata))
+        products = '/'.join(get_instant_products(index) + get_precip_products(index) + get_solar_products(index))
         return params, levels, products
     elif set_name == 'all_except_temp_solar':
         params = 'U GRD/V GRD/R H/A PCP/PRMSL'
         levels = 'HTGL:2/10/100;SFC:0;MSL:0'
-        products = '/'.join(get_instant_products(metadata) + get_precip_products(metadata))
+        products = '/'.join(get_instant_products(index) + get_precip_products(index))
         return params, levels, products
     elif set_name == 'temp':
         params = 'TMP'
         levels = 'HTGL:2'
-        products = '/'.join(get_instant_products(metadata))
+        products = '/'.join(get_instant_products(index))
         return params, levels, products
     elif set_name == 'solar':
         params = 'DSWRF'
         levels = 'SFC:0'
-        products = '/'.join(get_solar_products(metadata))
+        products = '/'.join(get_solar_products(index))
         return params, levels, products
     elif set_name == 'precip':
         params = 'A PCP'
         levels = 'SFC:0'
-        products = '/'.join(get_precip_products(metadata))
+        products = '/'.join(get_precip_products(index))
         return params, levels, products
     elif set_name == 'cloud_cover':
         params = 'T CDC'
         levels = 'EATM:0'
-        products = '/'.join(get_cloud_cover_products(metadata))
+        products = '/'.join(get_cloud_cover_products(index))
         return params, levels, products
     elif set_name == 'cloud_cover_old':
         params = 'T CDC'
         levels = 'EATM:0'
-        products = '/'.join(get_cloud_cover_old_products(metadata))
+        products = '/'.join(get_cloud_cover_old_products(index))
         return params, levels, products
     elif set_name == 'frozen_precip':
         params = 'CPOFP'
         levels = 'SFC:0'
-        products = '/'.join(get_frozen_precip_products(metadata))
+        products = '/'.join(get_frozen_precip_products(index))
         return params, levels, products
     else:
         raise ValueError('Parameter set {} not implemented'.format(set_name))
@@ -161,9 +151,9 @@ def request_data(args):
     template_dict = rc.read_control_file(template)
 
     # get selected products for all parameters
-    metadata_response = rc.query(['-get_metadata', dataset_id])
-    metadata = metadata_response['data']['data']
-    params, levels, products = get_parameter_set(args.param_set, metadata)
+    # only param and product are used, the rest of each record is dropped while parsing
+    index = MetadataIndex(rc.iter_metadata(dataset_id, ['param', 'product']))
+    params, levels, products = get_parameter_set(args.param_set, index)
 
     # HACK
     #products = '3-hour Forecast'
@@ -187,32 +177,41 @@ def request_data(args):
     
     answer = input('Is this okay (y/N)? ')
     if answer == 'y':
-        time_intervals_not_requested = set(time_intervals)
+        # most recent first
+        time_intervals_not_requested = Backlog(time_intervals)
         requests_to_download = set()
         number_of_requests = get_number_of_requests()
         while len(time_intervals_not_requested) > 0 or len(requests_to_download) > 0:
             try:
                 print(pm.now(), '\nNew iteration:')
-                print(pm.now(), 'time intervals not requested:', time_intervals_not_requested)
+                print(pm.now(), 'time intervals not requested:', [(item.from_dt, item.to_dt) for item in time_intervals_not_requested])
                 print(pm.now(), 'requests to download:', requests_to_download)
-                for start_date, end_date in sorted(list(time_intervals_not_requested), key=lambda x: x[0], reverse=True):
-                    # can only have 11 requests at a time
-                    if number_of_requests >= 11:
-                        print(pm.now(), f'Request limit is reached, waiting for requests to be completed')
-                        break
-                    
-                    print(pm.now(), 'Requesting data from {} to {}'.format(start_date, end_date))
-                    
-                    template_dict['date'] = '{}0000/to/{}0000'.format(start_date.format('YYYYMMDD'), end_date.format('YYYYMMDD'))
-
-                    response = rc.submit_json(template_dict)
-                    if response['http_response'] != 200:
-                        print(pm.now(), 'Request could not be made:\n{}'.format(response))
-                        continue
-                    
-                    number_of_requests += 1
-                    time_intervals_not_requested.remove((start_date, end_date))
-                    if args.download: requests_to_download.add(response['data']['request_id'])
+                not_submitted = []
+                try:
+                    while len(time_intervals_not_requested) > 0:
+                        # can only have 11 requests at a time
+                        if number_of_requests >= 11:
+                            print(pm.now(), f'Request limit is reached, waiting for requests to be completed')
+                            break
+
+                        item = time_intervals_not_requested.pop()
+                        not_submitted.append(item)
+                        start_date, end_date = item.from_dt, item.to_dt
+                        print(pm.now(), 'Requesting data from {} to {}'.format(start_date, end_date))
+
+                        template_dict['date'] = '{}0000/to/{}0000'.format(start_date.format('YYYYMMDD'), end_date.format('YYYYMMDD'))
+
+                        response = rc.submit_json(template_dict)
+                        if response['http_response'] != 200:
+                            print(pm.now(), 'Request could not be made:\n{}'.format(response))
+                            continue
+
+                        not_submitted.pop()
+                        number_of_requests += 1
+                        if args.download: requests_to_download.add(response['data']['request_id'])
+                finally:
+                    # tried again in the next iteration
+                    time_intervals_not_requested.extend(not_submitted)
                 
                 if args.download:
                     for request_id in sorted(list(requests_to_download)):
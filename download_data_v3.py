@@ -1,38 +1,107 @@
+from __future__ import annotations
 import time
-import pendulum as pm
-from pendulum.datetime import DateTime as PmDateTime
 from typing import *
-import yaml
 import threading
 import traceback
-import requests
+from functools import partial
 import os
 from pathlib import Path
 import argparse
 import re
+import signal
 import src.python.rdams_client as rda_client
-from src.settings import SLEEP_INTERVAL
+from src.settings import SLEEP_INTERVAL, MAX_REQUESTS, MAX_SPLIT_DEPTH, DISK_WATERMARK, BANDWIDTH_LIMIT, BANDWIDTH_SCHEDULE, CONTENT_STORE, METRICS_HOST, METRICS_PORT, METRICS_TEXTFILE, PROFILE, PROFILE_DIR, RDA_RATE_LIMIT, RDA_RATE_BURST, RDA_CIRCUIT_FAILURES, RDA_CIRCUIT_RESET
 from src.utils.logger import scope_logger
+from src.utils import metrics
+from src.utils.tracing import RequestTracer, TraceEvent, report
+from src.utils.ratelimit import TokenBucket, RetryPolicy, RetryDecision, CircuitBreaker, CircuitState
+from src.utils.bandwidth import BandwidthGovernor, parse_rate, parse_schedule
+from src.utils.profiling import profiler, parse_modes
 from src.utils.entities import *
-from src.config import parse_config, parse_time_intervals
-
-
-def request_wrapper(func: Callable, *args, **kwargs) -> Dict[str, Any] | None:
-    response = None
-    n_retries = 10
-    for _ in range(n_retries):
+from src.config import load_request_config, parse_config, parse_time_intervals
+from src.scheduler import ORDERS, Backlog, ConfigJob, Scheduler, WorkItem, load_schedule, parse_config_item_spec
+from src.purge import PurgeStage
+from src.storage import StorageManager
+from src.content_store import ContentStore, Deduplicator, selection_key
+from src.metadata import METADATA_FIELDS, MetadataCache, RequestValidator
+from src.utils.lazy import lazy_import
+
+# heavy dependencies are loaded on first use, see tools/benchmark_startup.py
+pm = lazy_import('pendulum')
+
+if TYPE_CHECKING:
+    import requests
+    from pendulum.datetime import DateTime as PmDateTime
+    from src.follow import CycleFollower
+
+
+rate_limiter = TokenBucket(RDA_RATE_LIMIT, RDA_RATE_BURST)
+retry_policy = RetryPolicy(max_attempts=10)
+circuit_breaker = CircuitBreaker(RDA_CIRCUIT_FAILURES, RDA_CIRCUIT_RESET)
+# shared by all download threads, the API calls themselves are not counted
+bandwidth_governor = BandwidthGovernor(parse_rate(BANDWIDTH_LIMIT), parse_schedule(BANDWIDTH_SCHEDULE))
+
+def request_wrapper(func: Callable, *args, decode: Callable[[requests.Response], Any] | None = None, **kwargs) -> Dict[str, Any] | None:
+    """Call an rdams_client function through the shared rate limiter and circuit breaker.
+
+    Throttling (429/503) and server errors are retried with jittered exponential backoff,
+    honouring Retry-After, other client errors are returned as-is without retrying.
+    A successful response is parsed by decode instead of .json() if given, e.g. for a streamed response.
+    """
+    endpoint = func.__name__
+    for attempt in range(retry_policy.max_attempts):
+        if attempt > 0: metrics.api_retries.inc(endpoint=endpoint)
+        circuit_breaker.acquire()
+        rate_limiter.acquire()
+
+        retry_after = None
+        response: requests.Response | None = None
+        start = time.monotonic()
         try:
             #scope_logger.info('Making RDA API request')
-            response: requests.Response = func(*args, **kwargs)
-            if response.status_code != 200: print('Request failed with status code', response.status_code)
-            response = response.json()
-            return response
+            # only the call itself, waiting for the rate limiter is not part of the endpoint's profile
+            with profiler.stage(f'api.{endpoint}'):
+                response = func(*args, **kwargs)
+            metrics.api_latency.observe(time.monotonic() - start, endpoint=endpoint)
+            metrics.api_responses.inc(endpoint=endpoint, code=response.status_code)
+            decision = retry_policy.classify(response.status_code)
+
+            if decision == RetryDecision.SUCCESS:
+                response = decode(response) if decode is not None else response.json()
+                circuit_breaker.record_success()
+                metrics.api_circuit_open.set(0)
+                return response
+
+            if decision == RetryDecision.FAIL:
+                circuit_breaker.record_success()
+                scope_logger.error('Request failed with status code %s, not retrying', response.status_code)
+                try:
+                    return response.json()
+                except ValueError:
+                    return None
+                finally:
+                    response.close()
+
+            retry_after = RetryPolicy.parse_retry_after(response.headers.get('Retry-After'))
+            if response.status_code == 429 or retry_after is not None:
+                # the whole client backs off, not just this thread
+                rate_limiter.pause(retry_after if retry_after is not None else retry_policy.backoff(attempt))
+            scope_logger.error('Request failed with status code %s', response.status_code)
 
         except Exception:
-            scope_logger.error('There was an exception during the request, trying again in 10 seconds')
+            metrics.api_latency.observe(time.monotonic() - start, endpoint=endpoint)
+            scope_logger.error('There was an exception during the request')
             traceback.print_exc()
-            time.sleep(5)
 
+        # a streamed response holds on to its connection until it's closed
+        if response is not None: response.close()
+        circuit_breaker.record_failure()
+        metrics.api_circuit_open.set(int(circuit_breaker.state != CircuitState.CLOSED))
+        delay = retry_policy.backoff(attempt, retry_after)
+        scope_logger.info('Trying again in %.1f seconds', delay)
+        time.sleep(delay)
+
+    metrics.api_failures.inc(endpoint=endpoint)
     scope_logger.info('Request could not be made, giving up')
     return None
 
@@ -72,52 +141,91 @@ def write_data_error_to_log(log_path: str, response_data: Dict[str, str]) -> Non
         scope_logger.error('Could not write to log file')
         traceback.print_exc()
 
-def download_worker(request_id: int, target_dir: Path, log_path: str) -> None:
-    try:
-        scope_logger.info(f'Starting download for request {request_id}')
-        
-        start = time.time()
-        response = request_wrapper(rda_client.download, request_id, target_dir)
-        scope_logger.info(f'Time elapsed: {time.time() - start} s')
-        
-        # keep request if unsuccessful to debug later
-        if response is not None: 
-            scope_logger.info('Download completed successfully, purging request')
-        else:
-            scope_logger.info('Could not download files, purging request')
-            write_data_error_to_log(log_path, response['data'][0])
+def admit_download(request_id: int, target_dir: Path, storage: StorageManager) -> Tuple[Path, List[str]] | None:
+    """Reserve disk space for a request, returns the directory to download to and the files to download, or None to try again later."""
+    response = request_wrapper(rda_client.get_filelist, request_id)
+    if response is None:
+        scope_logger.info('Could not get file list, trying later')
+        return None
+
+    web_files = response['data']['web_files'] if len(response['data']) > 0 else []
+    n_bytes = rda_client.get_filelist_size(web_files)
+    download_dir = storage.reserve(request_id, n_bytes, target_dir)
+    if download_dir is None:
+        scope_logger.warning('Not enough disk space for %.1f GB, postponing download', n_bytes / 1e9)
+        metrics.downloads_deferred.inc()
+        return None
+    # only download unique files
+    return download_dir, sorted(set(web_file['web_path'] for web_file in web_files))
+
+def download_worker(request: Dict[str, Any], target_dir: Path, log_path: str, tracer: RequestTracer, purge_stage: PurgeStage,
+                    storage: StorageManager, on_deferred: Callable[[int], None], dedup: Deduplicator | None = None) -> None:
+    request_id = request['request_index']
+    # context variables don't propagate to new threads, so the request scope is entered here
+    with scope_logger.create_loggerscope(f'request_id={request_id}'):
+        try:
+            admitted = admit_download(request_id, target_dir, storage)
+        except Exception:
+            scope_logger.error('Exception during admission of download')
+            traceback.print_exc()
+            admitted = None
+        if admitted is None:
+            # the request stays on the server and is picked up again by the service loop
+            on_deferred(request_id)
+            return
+        download_dir, web_paths = admitted
+
+        try:
+            scope_logger.info('Starting download for request %s', request_id)
             
-    except Exception:
-        scope_logger.error('Exception in download worker, writing to error log')
-        traceback.print_exc()
-        write_data_error_to_log(log_path, response['data'][0])
+            start = time.time()
+            tracer.record(request_id, TraceEvent.DOWNLOAD_START, start)
+            # the file server isn't the JSON API, so the files bypass its rate limiter and circuit breaker,
+            # download_files retries each file and checks it against its Content-Length, raising if it stays incomplete
+            success = False
+            try:
+                with bandwidth_governor.session() as bandwidth:
+                    rda_client.download_files(web_paths, download_dir, throttle=bandwidth.consume, dedup=dedup)
+                success = True
+            finally:
+                tracer.record(request_id, TraceEvent.DOWNLOAD_END, success=success)
+            scope_logger.info('Time elapsed: %s s', time.time() - start)
+            scope_logger.info('Download completed successfully, purging request')
+            # only intact downloads are purged, purging and confirming it happens on the purge threads
+            purge_stage.submit(request_id)
+                
+        except Exception:
+            # the request stays on the server, so its files can still be fetched with the download command
+            scope_logger.error('Could not download files, keeping the request and writing to error log')
+            traceback.print_exc()
+            write_data_error_to_log(log_path, request)
 
-    finally:
-        print(f'Purging request {request_id}')
-        request_wrapper(rda_client.purge_request, str(request_id))
+        finally:
+            storage.release(request_id)
 
 def setup_requests(config_item: str, area: str, from_dt: PmDateTime | None = None, to_dt: PmDateTime | None = None, 
-                  time_intervals_file: str | None = None) -> tuple[Dict[str, str], List[Tuple[PmDateTime, PmDateTime]]]:
-    
-    with open('./config/request_configs.yaml', 'r') as file:
-        config = yaml.safe_load(file)
+                  time_intervals_file: str | None = None, confirm: bool = True) -> tuple[Dict[str, str], List[Tuple[PmDateTime, PmDateTime]]]:
     
-    scope_logger.info(f'Request config: {config[config_item]}')
-    config = parse_config(config[config_item])
+    config = load_request_config(config_item)
+    scope_logger.info(f'Request config: {config}')
+    config = parse_config(config)
 
     scope_logger.info('Requesting following data:')
     if time_intervals_file is not None:
         time_intervals = parse_time_intervals(time_intervals_file)
         scope_logger.info(f'{len(time_intervals)} time intervals from file')
-    else:
+    elif from_dt is not None:
         time_intervals = split_time_interval(from_dt, to_dt)
         scope_logger.info(f'Time range: {from_dt} to {to_dt} in {len(time_intervals)} batches')
+    else:
+        time_intervals = []
 
     scope_logger.info(f'Parameters: {config.parameters}')
     scope_logger.info(f'Levels: {config.levels}')
     scope_logger.info(f'Products:\n{config.products}')
-    answer = input('Is this okay (y/N)? ')
-    if answer != 'y': return 
+    if confirm:
+        answer = input('Is this okay (y/N)? ')
+        if answer != 'y': return 
 
     dataset_id = 'd084001'
     response = request_wrapper(rda_client.get_control_file_template, dataset_id)
@@ -151,77 +259,236 @@ def setup_requests(config_item: str, area: str, from_dt: PmDateTime | None = Non
 
     return request_dict, time_intervals
 
-def service(request_dict: Dict[str, str], time_intervals: List[Tuple[PmDateTime, PmDateTime]], target_dir: Path, filter_request_ids: List[int] | None = None) -> None:
-    max_requests = 10
+def setup_jobs(config_item_specs: List[str], area: str, target_dir: Path, from_dt: PmDateTime | None = None, to_dt: PmDateTime | None = None,
+               time_intervals_file: str | None = None, confirm: bool = True, order: str = 'recent') -> List[ConfigJob] | None:
+    jobs = []
+    for spec in config_item_specs:
+        config_item, priority, weight = parse_config_item_spec(spec)
+        setup = setup_requests(config_item, area, from_dt, to_dt, time_intervals_file, confirm)
+        if setup is None: return None
+        request_dict, time_intervals = setup
+
+        job_target_dir = target_dir / config_item if len(config_item_specs) > 1 else target_dir
+        os.makedirs(job_target_dir, exist_ok=True)
+        jobs.append(ConfigJob(config_item, request_dict, Backlog(time_intervals, order), job_target_dir, priority, weight))
+    return jobs
+
+def decode_metadata(response: requests.Response) -> List[Dict[str, Any]] | None:
+    # parsed while it arrives, only keeping the fields the validator and follower look at
+    records = list(rda_client.iter_records(response, METADATA_FIELDS))
+    # error responses have no records
+    return records if len(records) > 0 else None
+
+def fetch_metadata(dataset_id: str = 'd084001') -> List[Dict[str, Any]] | None:
+    return request_wrapper(rda_client.get_metadata, dataset_id, stream=True, decode=decode_metadata)
+
+def setup_validator(mode: str, dataset_id: str = 'd084001') -> RequestValidator | None:
+    if mode == 'off': return None
+    metadata_cache = MetadataCache(partial(fetch_metadata, dataset_id), f'./data_cache/metadata/{dataset_id}.json')
+    return RequestValidator(metadata_cache.get, drop=mode == 'drop')
+
+def update_request_metrics(current_requests: List[Dict[str, Any]], requests_error: Set[int], n_slots_free: int, n_time_intervals: int) -> None:
+    states = {'active': len(current_requests), 'queued': 0, 'processing': 0, 'completed': 0, 'error': len(requests_error)}
+    for request in current_requests:
+        status = request['status'].lower()
+        if 'queue' in status: states['queued'] += 1
+        elif status == 'completed': states['completed'] += 1
+        elif status != 'error': states['processing'] += 1
+
+    for state, count in states.items(): metrics.requests_by_state.set(count, state=state)
+    metrics.request_slots_free.set(n_slots_free)
+    metrics.time_intervals_remaining.set(n_time_intervals)
+
+def start_metrics_exporters(port: int | None, textfile: str | None, host: str = METRICS_HOST) -> None:
+    try:
+        if port is not None: metrics.start_http_server(port, host)
+        if textfile is not None: metrics.start_textfile_exporter(textfile)
+    except Exception:
+        scope_logger.error('Could not start metrics exporters, continuing without')
+        traceback.print_exc()
+
+def validate_interval(validator: RequestValidator, request_dict: Dict[str, Any], from_dt: PmDateTime, to_dt: PmDateTime,
+                      log_path: str) -> Dict[str, Any] | None:
+    """The request dict reduced to what the metadata lists for its dates, None if nothing of it is available."""
+    result = validator.validate(request_dict)
+    for issue in result.issues: scope_logger.warning(issue)
+    if not result.valid:
+        scope_logger.error('Nothing of the request is available according to the metadata, writing to log and skipping')
+        write_request_error_to_log(log_path, from_dt, to_dt, f'Not available: {"; ".join(result.issues)}')
+        return None
+    return result.request_dict
+
+def format_work_item(item: WorkItem) -> str:
+    interval = '{}-{}'.format(item.from_dt.format('YYYYMMDDHH'), item.to_dt.format('YYYYMMDDHH'))
+    parts = ', '.join(f'{len(value.split("/"))} {key}s' for key, value in item.overrides)
+    return f'{interval} ({parts})' if parts else interval
+
+def split_failed(scheduler: Scheduler, job: ConfigJob, item: WorkItem) -> bool:
+    """Queue the halves of a failed work item, returns False if it's not split any further."""
+    pieces = scheduler.bisect(job, item)
+    if pieces: scope_logger.warning('Requesting %s again as %s', format_work_item(item), ' and '.join(format_work_item(piece) for piece in pieces))
+    return len(pieces) > 0
+
+def submit_interval(job: ConfigJob, item: WorkItem, tracer: RequestTracer, log_path: str, validator: RequestValidator | None = None,
+                    on_rejected: Callable[[], bool] | None = None) -> Tuple[int, Dict[str, str]] | None:
+    """Submit a work item, returns the request id and the request dict as it was submitted, or None if it failed."""
+    from_dt, to_dt = item.from_dt, item.to_dt
+    request_dict_copy = job.request_dict.copy()
+    request_dict_copy['date'] = '{}00/to/{}00'.format(from_dt.format('YYYYMMDDHH'), to_dt.format('YYYYMMDDHH'))
+    request_dict_copy.update(item.overrides)
+    # requests the server would fail on don't get to take up a slot
+    if validator is not None:
+        request_dict_copy = validate_interval(validator, request_dict_copy, from_dt, to_dt, log_path)
+        if request_dict_copy is None: return None
+    
+    scope_logger.info(f'Requesting {job.name} data for {format_work_item(item)}')
+    response = request_wrapper(rda_client.submit_json, request_dict_copy)
+    scope_logger.info(f'Response: {response}')
+
+    if response is not None:
+        scope_logger.info('Request submitted successfully')
+        response_status = response['status']
+        if response_status != 'error' and 'request_id' in (response.get('data') or {}):
+            request_id = response['data']['request_id']
+            tracer.record(request_id, TraceEvent.SUBMITTED, config_item=job.name, interval=request_dict_copy['date'])
+            return request_id, request_dict_copy
+
+        if response_status == 'error':
+            message = f'{response["http_response"]} {response["error_messages"]}'
+            # a rejected request is retried in parts, in case only some of it is the problem
+            if on_rejected is not None and on_rejected():
+                scope_logger.error('Request was rejected: %s', message)
+            else:
+                scope_logger.error('Could not fetch data for this time interval, writing to log and skipping')
+                write_request_error_to_log(log_path, from_dt, to_dt, message)
+
+    else:
+        scope_logger.info('Could not submit request, writing to log and skipping')
+        message = 'Could not submit request'
+        write_request_error_to_log(log_path, from_dt, to_dt, message)
+
+    return None
+
+def submit_worker(job: ConfigJob, item: WorkItem, scheduler: Scheduler, tracer: RequestTracer, log_path: str,
+                  validator: RequestValidator | None = None) -> None:
+    with scope_logger.create_loggerscope(f'submit={job.name}'):
+        submitted = None
+        try:
+            submitted = submit_interval(job, item, tracer, log_path, validator, partial(split_failed, scheduler, job, item))
+        except Exception:
+            scope_logger.error('Exception in submit worker, writing to error log')
+            traceback.print_exc()
+            write_request_error_to_log(log_path, item.from_dt, item.to_dt, 'Exception during submit')
+        finally:
+            # hand the slot back to the scheduler (or turn it into a tracked request)
+            request_id, request_dict = submitted if submitted is not None else (None, None)
+            scheduler.complete_submission(job, request_id, item, request_dict)
+
+def service(jobs: List[ConfigJob], target_dir: Path, filter_request_ids: List[int] | None = None, follower: CycleFollower | None = None,
+            storage: StorageManager | None = None, store: ContentStore | None = None, validator: RequestValidator | None = None,
+            max_split_depth: int = MAX_SPLIT_DEPTH, schedule_file: str | None = None) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    storage = storage if storage is not None else StorageManager(target_dir, watermark=DISK_WATERMARK)
+
+    # the follower only saves a cycle as done once it was submitted
+    scheduler = Scheduler(MAX_REQUESTS, jobs, max_split_depth, on_submitted=follower.on_submitted if follower is not None else None,
+                          on_split=follower.on_split if follower is not None else None)
+    # submissions run next to the loop, so a slow or retrying submit doesn't hold up status handling and downloads
+    submit_executor = ThreadPoolExecutor(max_workers=MAX_REQUESTS, thread_name_prefix='submit')
     log_path = f'./data_cache/logs/{pm.now("Europe/Oslo").format("YYYYMMDDTHHmm")}.log'
+    tracer = RequestTracer(f'./data_cache/traces/{pm.now("Europe/Oslo").format("YYYYMMDDTHHmm")}.jsonl', jobs[0].name if len(jobs) == 1 else None)
     with open(log_path, 'a') as file:
-        file.write(f'{str(request_dict)}\n')
+        for job in jobs: file.write(f'{job.name}: {str(job.request_dict)}\n')
+
+    def on_purged(request_id: int) -> None:
+        tracer.record(request_id, TraceEvent.PURGED)
+        # the slot can be reused right away, without waiting for the next status check
+        scheduler.mark_purged(request_id)
+
+    # the schedule file is read at the start and again on SIGHUP, applied between iterations of the loop
+    reload_schedule = threading.Event()
+    if schedule_file is not None:
+        reload_schedule.set()
+        if hasattr(signal, 'SIGHUP'): signal.signal(signal.SIGHUP, lambda signum, frame: reload_schedule.set())
+
+    purge_stage = PurgeStage(partial(request_wrapper, rda_client.purge_request), partial(request_wrapper, rda_client.get_status), on_purged)
 
     requests_downloaded = set()
     requests_error = set()
     while True:
         try:
-            scope_logger.info('Checking status of requests')
-            response = request_wrapper(rda_client.get_status)
-            if response is None:
-                scope_logger.info('Could not get status of existing requests, trying later')
-                time.sleep(SLEEP_INTERVAL)
-                continue
+            # per iteration, a profile is only collected once its stage returns
+            with profiler.stage('service'):
+                if reload_schedule.is_set():
+                    reload_schedule.clear()
+                    try:
+                        scheduler.apply_schedule(load_schedule(schedule_file))
+                    except Exception:
+                        scope_logger.error('Could not apply schedule %s, keeping the current one', schedule_file)
+                        traceback.print_exc()
+
+                scope_logger.info('Checking status of requests')
+                snapshot_time = time.monotonic()
+                response = request_wrapper(rda_client.get_status)
+                if response is None:
+                    scope_logger.info('Could not get status of existing requests, trying later')
+                    time.sleep(SLEEP_INTERVAL)
+                    continue
             
-            current_requests = response['data']
-            scope_logger.info(f'n_current_requests={len(current_requests)}, n_requests_error={len(requests_error)}, n_time_intervals={len(time_intervals)}, n_requests_downloaded={len(requests_downloaded)}')
-            if len(current_requests) == len(requests_error) and len(time_intervals) == 0:
-                scope_logger.info('Nothing more to do, exiting')
-                break
-
-            # handle current requests
-            for request in current_requests:
-                request_id = request['request_index']
-                if filter_request_ids is not None and request_id not in filter_request_ids: continue
-                
-                request_status = request['status']
-                if request_status == 'Completed' and request_id not in requests_downloaded:
-                    with scope_logger.create_loggerscope(f'request_id={request_id}'):
-                        #download_worker(request_id, target_dir, log_path)
-                        threading.Thread(target=download_worker, args=(request_id, target_dir, log_path)).start()
-
-                    requests_downloaded.add(request_id)
+                scheduler.sync([request['request_index'] for request in response['data']], snapshot_time)
+                current_requests = [request for request in response['data'] if not scheduler.is_purged(request['request_index'])]
+                current_request_ids = [request['request_index'] for request in current_requests]
+                if follower is not None: follower.poll(scheduler, tracer)
+                n_time_intervals = scheduler.n_remaining() + scheduler.n_pending()
+                update_request_metrics(current_requests, requests_error, scheduler.free_slots(current_request_ids), n_time_intervals)
+                storage.update_metrics()
+                scope_logger.info(f'n_current_requests={len(current_requests)}, n_requests_error={len(requests_error)}, n_time_intervals={n_time_intervals}, n_requests_downloaded={len(requests_downloaded)}')
+                if len(current_requests) == len(requests_error) and n_time_intervals == 0 and follower is None:
+                    scope_logger.info('Nothing more to do, exiting')
+                    submit_executor.shutdown()
+                    break
+
+                # handle current requests
+                for request in current_requests:
+                    request_id = request['request_index']
+                    if filter_request_ids is not None and request_id not in filter_request_ids: continue
                 
-                elif request_status == 'Error':
-                    if request_id not in requests_error:
-                        scope_logger.error(f'Request {request_id} is faulty/stuck, contact rdahelp@ucar.edu for removal!')
-                        requests_error.add(request_id)
-                        write_data_error_to_log(log_path, request)
+                    request_status = request['status']
+                    tracer.record_status(request_id, request_status)
+                    if request_status == 'Completed' and request_id not in requests_downloaded:
+                        job = scheduler.job_for_request(request_id)
+                        request_target_dir = job.target_dir if job is not None else target_dir
+                        # files of requests with the same selection covering the same cycles are only downloaded once,
+                        # the selection is the one submitted (split products, levels the validator dropped), not the config item's
+                        dedup = Deduplicator(store, selection_key(scheduler.request_dict_for(request_id))) if store is not None else None
+                        requests_downloaded.add(request_id)
+                        threading.Thread(target=download_worker, args=(request, request_target_dir, log_path, tracer, purge_stage, storage,
+                                                                       requests_downloaded.discard, dedup)).start()
                 
-                else:
-                    scope_logger.info(f'Request {request_id} has status {request_status}, waiting')
-
-            # make new requests
-            n_request_slots = max_requests - len(current_requests)
-            n_new_requests_to_make = min(n_request_slots, len(time_intervals))
-            for _ in range(n_new_requests_to_make):
-                from_dt, to_dt = time_intervals.pop()
-                request_dict_copy = request_dict.copy()
-                request_dict_copy['date'] = '{}00/to/{}00'.format(from_dt.format('YYYYMMDDHH'), to_dt.format('YYYYMMDDHH'))
+                    elif request_status == 'Error':
+                        if request_id not in requests_error:
+                            scope_logger.error(f'Request {request_id} is faulty/stuck, contact rdahelp@ucar.edu for removal!')
+                            requests_error.add(request_id)
+                            job, item = scheduler.job_for_request(request_id), scheduler.item_for_request(request_id)
+                            if job is None or item is None or not split_failed(scheduler, job, item): write_data_error_to_log(log_path, request)
                 
-                scope_logger.info(f'Requesting data from {from_dt} to {to_dt}')
-                response = request_wrapper(rda_client.submit_json, request_dict_copy)
-                scope_logger.info(f'Response: {response}')
-
-                if response is not None:
-                    scope_logger.info('Request submitted successfully')
-                    response_status = response['status']
-                    if response_status == 'error':
-                        scope_logger.error('Could not fetch data for this time interval, writing to log and skipping')
-                        message = f'{response["http_response"]} {response["error_messages"]}'
-                        write_request_error_to_log(log_path, from_dt, to_dt, message)
-
-                else:
-                    scope_logger.info('Could not submit request, writing to log and skipping')
-                    message = 'Could not submit request'
-                    write_request_error_to_log(log_path, from_dt, to_dt, message)
-
-            time.sleep(SLEEP_INTERVAL)
+                    else:
+                        scope_logger.info('Request %s has status %s, waiting', request_id, request_status)
+
+                # make new requests, the slots are shared by all config items
+                n_request_slots = scheduler.free_slots(current_request_ids)
+                # don't request more data than the disks can take, counting requests that are not downloaded yet
+                n_outstanding = scheduler.n_pending() + sum(1 for request in current_requests
+                                                            if request['request_index'] not in requests_downloaded and request['request_index'] not in requests_error)
+                n_admissible = storage.admissible_requests(n_outstanding)
+                if n_admissible is not None and n_admissible < n_request_slots:
+                    scope_logger.info('Disk usage would exceed the watermark, submitting %s instead of %s new requests', n_admissible, n_request_slots)
+                    n_request_slots = n_admissible
+                for job, item in scheduler.next_submissions(n_request_slots):
+                    submit_executor.submit(submit_worker, job, item, scheduler, tracer, log_path, validator)
+
+            scheduler.wait_for_slot(SLEEP_INTERVAL)
 
         except Exception:
             print('Exception in main loop:')
@@ -234,21 +501,79 @@ def main():
     subparser = parser.add_subparsers(title='command', dest='command')
 
     request_parser = subparser.add_parser('request', help='Service to request and download data for specified time interval(s)')
-    request_parser.add_argument('--config_item', required=True, help='Request configuration in config/request_configs.yaml')
+    request_parser.add_argument('--config_item', required=True, nargs='+', help='Request configuration(s) in config/request_configs.yaml, as name[:priority[:weight]]. '
+                                'Several config items share the request slots, each is downloaded to a subdirectory of target_dir')
     request_parser.add_argument('--from_to', nargs=2, help='Date interval to fetch data for, format: "YYYY-MM-DDTHH:MM')
     request_parser.add_argument('--area', required=True, choices=['global', 'europe'], help='Predefined geographical area to fetch')
     request_parser.add_argument('--target_dir', required=True, help='Directory to download the data to')
     request_parser.add_argument('--time_intervals_file', help='CSV file with set of time intervals to fetch data for (arg from/to will be ignored)')
+    request_parser.add_argument('--order', choices=ORDERS, default='recent', help='Order to submit the time intervals of each config item in: '
+                                'newest first, oldest first, or spread over the date range so the data so far covers it evenly (gaps)')
+    request_parser.add_argument('--schedule_file', help='JSON file with the order, priority, weight and a date range to submit first per config item, '
+                                're-read on SIGHUP to reprioritise a running service')
+    request_parser.add_argument('--spill_dirs', nargs='*', default=[], help='Directories to download to when target_dir would exceed the disk watermark')
+    request_parser.add_argument('--disk_watermark', type=float, default=DISK_WATERMARK, help='Maximum fraction of a disk to fill, new requests are held back above it')
+    request_parser.add_argument('--bandwidth_limit', default=BANDWIDTH_LIMIT, help='Total download bandwidth in bytes/s, e.g. 50M, defaults to unlimited')
+    request_parser.add_argument('--bandwidth_schedule', default=BANDWIDTH_SCHEDULE, help='Bandwidth per time of day overriding --bandwidth_limit, e.g. "08:00-17:00=10M,17:00-22:00=unlimited"')
+    request_parser.add_argument('--max_split_depth', type=int, default=MAX_SPLIT_DEPTH, help='How often a rejected or failed request is split in halves '
+                                '(time interval, then products, then parameters) and requested again, 0 to only log it')
+    request_parser.add_argument('--validate', choices=['drop', 'flag', 'off'], default='drop', help='Check requests against the cached dataset metadata before submitting: '
+                                'drop products/levels that are not available, only log them, or skip the check')
+    request_parser.add_argument('--content_store', default=CONTENT_STORE, help='Directory of a content store shared between runs, files already in it are linked instead of downloaded')
+    request_parser.add_argument('--metrics_port', type=int, default=METRICS_PORT, help='Serve Prometheus metrics on http://<metrics_host>:<port>/metrics')
+    request_parser.add_argument('--metrics_host', default=METRICS_HOST, help='Address to serve the metrics on, defaults to localhost only, e.g. 0.0.0.0 for remote scraping')
+    request_parser.add_argument('--metrics_textfile', default=METRICS_TEXTFILE, help='Periodically write Prometheus metrics to this file (node exporter textfile collector)')
+    request_parser.add_argument('--profile', default=PROFILE, help='Comma separated profilers to run: cprofile, sample and/or tracemalloc, defaults to none')
+    request_parser.add_argument('--profile_dir', default=PROFILE_DIR, help='Directory to periodically write profiles per stage and their summary to')
+
+    follow_parser = subparser.add_parser('follow', help='Headless service that requests and downloads each new init cycle as soon as it is available')
+    follow_parser.add_argument('--config_item', required=True, nargs='+', help='Request configuration(s) in config/request_configs.yaml, as name[:priority[:weight]]')
+    follow_parser.add_argument('--area', required=True, choices=['global', 'europe'], help='Predefined geographical area to fetch')
+    follow_parser.add_argument('--target_dir', required=True, help='Directory to download the data to')
+    follow_parser.add_argument('--start', required=False, help='First init cycle to fetch if there is no saved state, format: "YYYY-MM-DDTHH:MM", defaults to the newest available')
+    follow_parser.add_argument('--poll_interval', type=float, default=600, help='Seconds between checks for new cycles')
+    follow_parser.add_argument('--state_file', default='./data_cache/follow_state.json', help='File with the last submitted cycle per config item')
+    follow_parser.add_argument('--spill_dirs', nargs='*', default=[], help='Directories to download to when target_dir would exceed the disk watermark')
+    follow_parser.add_argument('--disk_watermark', type=float, default=DISK_WATERMARK, help='Maximum fraction of a disk to fill, new requests are held back above it')
+    follow_parser.add_argument('--bandwidth_limit', default=BANDWIDTH_LIMIT, help='Total download bandwidth in bytes/s, e.g. 50M, defaults to unlimited')
+    follow_parser.add_argument('--bandwidth_schedule', default=BANDWIDTH_SCHEDULE, help='Bandwidth per time of day overriding --bandwidth_limit, e.g. "08:00-17:00=10M,17:00-22:00=unlimited"')
+    follow_parser.add_argument('--max_split_depth', type=int, default=MAX_SPLIT_DEPTH, help='How often a rejected or failed request is split in halves '
+                                '(time interval, then products, then parameters) and requested again, 0 to only log it')
+    follow_parser.add_argument('--validate', choices=['drop', 'flag', 'off'], default='drop', help='Check requests against the cached dataset metadata before submitting: '
+                                'drop products/levels that are not available, only log them, or skip the check')
+    follow_parser.add_argument('--content_store', default=CONTENT_STORE, help='Directory of a content store shared between runs, files already in it are linked instead of downloaded')
+    follow_parser.add_argument('--metrics_port', type=int, default=METRICS_PORT, help='Serve Prometheus metrics on http://<metrics_host>:<port>/metrics')
+    follow_parser.add_argument('--metrics_host', default=METRICS_HOST, help='Address to serve the metrics on, defaults to localhost only, e.g. 0.0.0.0 for remote scraping')
+    follow_parser.add_argument('--metrics_textfile', default=METRICS_TEXTFILE, help='Periodically write Prometheus metrics to this file (node exporter textfile collector)')
+    follow_parser.add_argument('--profile', default=PROFILE, help='Comma separated profilers to run: cprofile, sample and/or tracemalloc, defaults to none')
+    follow_parser.add_argument('--profile_dir', default=PROFILE_DIR, help='Directory to periodically write profiles per stage and their summary to')
 
     download_parser = subparser.add_parser('download', help='Download previously requested datasets.')
     download_parser.add_argument('--request_ids', nargs='*', required=False, help='Download a specific request only, defaults to all active requests.')
     download_parser.add_argument('--target_dir', required=True, help='Directory to download the data to')
     download_parser.add_argument('--purge', action='store_true', help='Purge all requests for which download was successful')
+    download_parser.add_argument('--spill_dirs', nargs='*', default=[], help='Directories to download to when target_dir would exceed the disk watermark')
+    download_parser.add_argument('--disk_watermark', type=float, default=DISK_WATERMARK, help='Maximum fraction of a disk to fill, new requests are held back above it')
+    download_parser.add_argument('--bandwidth_limit', default=BANDWIDTH_LIMIT, help='Total download bandwidth in bytes/s, e.g. 50M, defaults to unlimited')
+    download_parser.add_argument('--bandwidth_schedule', default=BANDWIDTH_SCHEDULE, help='Bandwidth per time of day overriding --bandwidth_limit, e.g. "08:00-17:00=10M,17:00-22:00=unlimited"')
+    download_parser.add_argument('--content_store', default=CONTENT_STORE, help='Directory of a content store shared between runs, files already in it are linked instead of downloaded')
+    download_parser.add_argument('--metrics_port', type=int, default=METRICS_PORT, help='Serve Prometheus metrics on http://<metrics_host>:<port>/metrics')
+    download_parser.add_argument('--metrics_host', default=METRICS_HOST, help='Address to serve the metrics on, defaults to localhost only, e.g. 0.0.0.0 for remote scraping')
+    download_parser.add_argument('--metrics_textfile', default=METRICS_TEXTFILE, help='Periodically write Prometheus metrics to this file (node exporter textfile collector)')
+    download_parser.add_argument('--profile', default=PROFILE, help='Comma separated profilers to run: cprofile, sample and/or tracemalloc, defaults to none')
+    download_parser.add_argument('--profile_dir', default=PROFILE_DIR, help='Directory to periodically write profiles per stage and their summary to')
 
     purge_parser = subparser.add_parser('purge', help='Purge a previously requested dataset.')
     purge_parser.add_argument('--request_ids', nargs='*', required=True, help='If "all", purge all active requests.')
 
+    report_parser = subparser.add_parser('report', help='Summarise request latencies per phase from the request traces.')
+    report_parser.add_argument('--trace_dir', default='./data_cache/traces', help='Directory with trace files written by the request/download service')
+    report_parser.add_argument('--config_item', required=False, help='Only include requests for this config item')
+
     args = parser.parse_args()
+    if args.command in ('request', 'follow', 'download'):
+        bandwidth_governor.configure(parse_rate(args.bandwidth_limit), parse_schedule(args.bandwidth_schedule))
+        profiler.configure(parse_modes(args.profile), args.profile_dir)
     
     if args.command == 'request':
         os.makedirs(args.target_dir, exist_ok=True)
@@ -259,12 +584,36 @@ def main():
         else:
             from_dt = to_dt = None
         
-        request_dict, time_intervals = setup_requests(args.config_item, args.area, from_dt, to_dt, args.time_intervals_file)
-        service(request_dict, time_intervals, Path(args.target_dir))
+        jobs = setup_jobs(args.config_item, args.area, Path(args.target_dir), from_dt, to_dt, args.time_intervals_file, order=args.order)
+        if jobs is None: return
+
+        storage = StorageManager(Path(args.target_dir), [Path(spill_dir) for spill_dir in args.spill_dirs], args.disk_watermark)
+        start_metrics_exporters(args.metrics_port, args.metrics_textfile, args.metrics_host)
+        store = ContentStore(Path(args.content_store)) if args.content_store is not None else None
+        service(jobs, Path(args.target_dir), storage=storage, store=store, validator=setup_validator(args.validate), max_split_depth=args.max_split_depth,
+                schedule_file=args.schedule_file)
+
+    elif args.command == 'follow':
+        from src.follow import CycleFollower
+
+        os.makedirs(args.target_dir, exist_ok=True)
+        jobs = setup_jobs(args.config_item, args.area, Path(args.target_dir), confirm=False)
+        start = pm.parse(args.start, tz='UTC') if args.start is not None else None
+        latency_log_path = './data_cache/logs/follow_latency.csv'
+        follower = CycleFollower(jobs, fetch_metadata, args.state_file, latency_log_path, args.poll_interval, start)
+
+        storage = StorageManager(Path(args.target_dir), [Path(spill_dir) for spill_dir in args.spill_dirs], args.disk_watermark)
+        start_metrics_exporters(args.metrics_port, args.metrics_textfile, args.metrics_host)
+        store = ContentStore(Path(args.content_store)) if args.content_store is not None else None
+        service(jobs, Path(args.target_dir), follower=follower, storage=storage, store=store, validator=setup_validator(args.validate),
+                max_split_depth=args.max_split_depth)
     
     elif args.command == 'download':
         os.makedirs(args.target_dir, exist_ok=True)
-        service(dict(), list(), Path(args.target_dir), args.request_ids)
+        storage = StorageManager(Path(args.target_dir), [Path(spill_dir) for spill_dir in args.spill_dirs], args.disk_watermark)
+        start_metrics_exporters(args.metrics_port, args.metrics_textfile, args.metrics_host)
+        store = ContentStore(Path(args.content_store)) if args.content_store is not None else None
+        service([], Path(args.target_dir), args.request_ids, storage=storage, store=store)
     
     elif args.command == 'purge':
         if args.request_ids == 'all':
@@ -279,6 +628,9 @@ def main():
                 response = request_wrapper(rda_client.purge_request, request_id)
                 scope_logger.info(response)
 
+    elif args.command == 'report':
+        print(report(args.trace_dir, args.config_item))
+
 
 if __name__ == '__main__':
     main()
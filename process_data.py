@@ -0,0 +1,137 @@
+from __future__ import annotations
+import os
+import time
+import argparse
+from datetime import datetime
+from src.config import load_request_config
+from src.settings import PROFILE, PROFILE_DIR
+from src.utils.logger import scope_logger
+from src.utils.profiling import profiler, parse_modes
+
+
+def config_selection(config_item: str | None) -> tuple:
+    """Parameters and levels of a config item in config/request_configs.yaml, (None, None) selects everything."""
+    if config_item is None: return None, None
+    config = load_request_config(config_item)
+    return config['parameters'], config['levels']
+
+def parse_steps(value: str) -> list:
+    """'0-24,48' -> [0, 1, ..., 24, 48], ranges include their end."""
+    steps = []
+    for part in value.split(','):
+        first, _, last = part.strip().partition('-')
+        steps.extend(range(int(first), int(last or first) + 1))
+    return steps
+
+def init_range(args: argparse.Namespace) -> tuple | None:
+    """(from_init, to_init) of the CLI, an open end is unbounded, None if neither is given."""
+    if args.from_init is None and args.to_init is None: return None
+    return (args.from_init or datetime.min, args.to_init or datetime.max)
+
+def add_time_arguments(parser: argparse.ArgumentParser) -> None:
+    parse_init = lambda value: datetime.strptime(value, '%Y%m%d%H')
+    parser.add_argument('--from_init', type=parse_init, help='Only process inits from this one on, YYYYMMDDHH')
+    parser.add_argument('--to_init', type=parse_init, help='Only process inits up to and including this one, YYYYMMDDHH')
+    parser.add_argument('--steps', type=parse_steps, help='Only process these forecast steps (hours), e.g. "3-72,84", of .tar files only their members are read')
+
+def main():
+    parser = argparse.ArgumentParser(description='Post-processing of downloaded GFS data')
+    parser.add_argument('--profile', default=PROFILE, help='Comma separated profilers to run: cprofile, sample and/or tracemalloc, defaults to none')
+    parser.add_argument('--profile_dir', default=PROFILE_DIR, help='Directory to write profiles per stage and process and their summary to')
+    subparser = parser.add_subparsers(title='command', dest='command')
+
+    sites_parser = subparser.add_parser('sites', help='Extract site time series to Parquet')
+    sites_parser.add_argument('--input_dir', required=True, help='Directory with downloaded .tar/.grib2 files')
+    sites_parser.add_argument('--sites', required=True, help='CSV file with columns name, lat, lon and optionally hub_height')
+    sites_parser.add_argument('--config_item', required=False, help='Only extract the parameters and levels of this config item')
+    sites_parser.add_argument('--output', required=True, help='Parquet file to write')
+    sites_parser.add_argument('--deaccumulate', action='store_true', help='Convert accumulations to rates per hour and averages to means between consecutive steps')
+    sites_parser.add_argument('--derive', action='store_true', help='Add wind speed/direction, specific humidity and the wind at each site\'s hub height')
+    sites_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of files processed in parallel')
+    add_time_arguments(sites_parser)
+
+    regrid_parser = subparser.add_parser('regrid', help='Regrid fields to another lat/lon grid, written as netCDF per init')
+    regrid_parser.add_argument('--input_dir', required=True, help='Directory with downloaded .tar/.grib2 files')
+    regrid_parser.add_argument('--griddef', required=True, help='Target grid in RDA griddef format, e.g. "720:361:90N:0E:90S:359.5E:0.5:0.5"')
+    regrid_parser.add_argument('--config_item', required=False, help='Only regrid the parameters and levels of this config item')
+    regrid_parser.add_argument('--output_dir', required=True, help='Directory to write the netCDF files to')
+    regrid_parser.add_argument('--cache_dir', default='./data_cache/regrid_weights', help='Directory to cache the interpolation weights in')
+    regrid_parser.add_argument('--deaccumulate', action='store_true', help='Convert accumulations to rates per hour and averages to means between consecutive steps')
+    regrid_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of files processed in parallel')
+    add_time_arguments(regrid_parser)
+
+    derive_parser = subparser.add_parser('derive', help='Compute derived variables and write them next to the raw variables as netCDF per init')
+    derive_parser.add_argument('--input_dir', required=True, help='Directory with downloaded .tar/.grib2 files')
+    derive_parser.add_argument('--config_item', required=False, help='Only keep the raw parameters and levels of this config item')
+    derive_parser.add_argument('--output_dir', required=True, help='Directory to write the netCDF files to')
+    derive_parser.add_argument('--hub_heights', type=lambda value: [float(height) for height in value.split(',')], default=[],
+                               help='Comma separated heights (m) to extrapolate the wind to, e.g. "80,120"')
+    derive_parser.add_argument('--chunk_size', type=int, default=1 << 18, help='Grid points per chunk of a computation')
+    derive_parser.add_argument('--deaccumulate', action='store_true', help='Convert accumulations to rates per hour and averages to means between consecutive steps')
+    derive_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of files processed in parallel')
+    add_time_arguments(derive_parser)
+
+    index_parser = subparser.add_parser('index', help='Build the member index next to every downloaded .tar file')
+    index_parser.add_argument('--input_dir', required=True, help='Directory with downloaded .tar files')
+    index_parser.add_argument('--rebuild', action='store_true', help='Rebuild indexes that are still up to date')
+    index_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of files indexed in parallel')
+
+    args = parser.parse_args()
+    profiler.configure(parse_modes(args.profile), args.profile_dir)
+
+    if args.command == 'sites':
+        from src.processing.grib import list_grib_files
+        from src.processing.sites import read_sites, extract_sites
+
+        sites = read_sites(args.sites)
+        parameters, levels = config_selection(args.config_item)
+        paths = list_grib_files(args.input_dir)
+        scope_logger.info('Extracting %s sites from %s files with %s workers', len(sites), len(paths), args.workers)
+        start = time.monotonic()
+        n_rows = extract_sites(paths, sites, args.output, parameters, levels, args.deaccumulate, args.derive, args.workers, init_range(args), args.steps)
+        scope_logger.info('Wrote %s rows to %s in %.1f s', n_rows, args.output, time.monotonic() - start)
+
+    elif args.command == 'regrid':
+        from src.processing.grib import list_grib_files
+        from src.processing.grid import LatLonGrid
+        from src.processing.regrid import regrid_files
+
+        target = LatLonGrid.from_griddef(args.griddef)
+        parameters, levels = config_selection(args.config_item)
+        paths = list_grib_files(args.input_dir)
+        scope_logger.info('Regridding %s files to %s with %s workers', len(paths), target, args.workers)
+        start = time.monotonic()
+        output_paths = regrid_files(paths, target, args.output_dir, args.cache_dir, parameters, levels, args.deaccumulate, args.workers,
+                                    init_range(args), args.steps)
+        scope_logger.info('Wrote %s files to %s in %.1f s', len(output_paths), args.output_dir, time.monotonic() - start)
+
+    elif args.command == 'derive':
+        from src.processing.grib import list_grib_files
+        from src.processing.derived import derived_variables, derive_files
+
+        variables = derived_variables(args.hub_heights)
+        parameters, levels = config_selection(args.config_item)
+        paths = list_grib_files(args.input_dir)
+        scope_logger.info('Deriving %s variables from %s files with %s workers', len(variables), len(paths), args.workers)
+        start = time.monotonic()
+        output_paths = derive_files(paths, args.output_dir, variables, parameters, levels, args.deaccumulate, args.chunk_size, args.workers,
+                                    init_range(args), args.steps)
+        scope_logger.info('Wrote %s files to %s in %.1f s', len(output_paths), args.output_dir, time.monotonic() - start)
+
+    elif args.command == 'index':
+        from src.processing.grib import list_grib_files
+        from src.processing.parallel import map_files
+        from src.processing.tarindex import build_index, load_index
+
+        paths = [path for path in list_grib_files(args.input_dir) if path.endswith('.tar')]
+        start = time.monotonic()
+        for path, (members, elapsed) in zip(paths, map_files(build_index if args.rebuild else load_index, [(path,) for path in paths], args.workers)):
+            scope_logger.info('%s: %s members in %.2f s', path, len(members), elapsed)
+        scope_logger.info('Indexed %s files in %.1f s', len(paths), time.monotonic() - start)
+
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
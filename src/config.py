@@ -1,9 +1,13 @@
+from __future__ import annotations
 from typing import *
-import pendulum as pm
-import pandas as pd
+import csv
 import itertools
+from datetime import datetime
 from src.utils.entities import RequestConfig
 
+if TYPE_CHECKING:
+    import pendulum as pm
+
 # 2022-04-06: archive changed from 12h to 6h frequency for forecast hours > 240
 FORECAST_HOURS = list(range(3, 240, 3)) + list(range(240, 384 + 1, 6))
 
@@ -17,7 +21,7 @@ def get_average_products():
     return three_hour_averages + six_hour_averages
 
 def get_total_accumulated_products():
-    products = [f'{hour}-hour Accumulation (initial+0 to initial+{hour}' for hour in FORECAST_HOURS]
+    products = [f'{hour}-hour Accumulation (initial+0 to initial+{hour})' for hour in FORECAST_HOURS]
     return products
 
 def get_six_hour_accumulated_products():
@@ -47,9 +51,22 @@ def parse_config(config: Dict[str, Any]) -> RequestConfig:
     products ='/'.join(itertools.chain(*[get_products_by_type(product_type) for product_type in config['product_types']]))
     return RequestConfig(parameters, levels, products)
 
+def load_request_config(config_item: str, path: str = './config/request_configs.yaml') -> Dict[str, Any]:
+    import yaml
+
+    with open(path, 'r') as file:
+        config = yaml.safe_load(file)
+    if config_item not in config: raise ValueError(f'Config item {config_item} not found in {path}')
+    return config[config_item]
+
 def parse_time_intervals(file_path: str) -> List[Tuple[pm.DateTime, pm.DateTime]]:
-    time_intervals = pd.read_csv(file_path, header=None, names=['from_dt', 'to_dt'])
-    time_intervals['from_dt'] = pd.to_datetime(time_intervals['from_dt'].str.strip(), format='%Y-%m-%d %H:%M:%S')
-    time_intervals['to_dt'] = pd.to_datetime(time_intervals['to_dt'].str.strip(), format='%Y-%m-%d %H:%M:%S')
-    time_intervals = [(pm.instance(from_dt), pm.instance(to_dt)) for from_dt, to_dt in zip(time_intervals['from_dt'], time_intervals['to_dt'])]
+    # plain csv instead of pandas, which would dominate the startup time of the CLI
+    import pendulum as pm
+
+    time_intervals = []
+    with open(file_path, 'r', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) == 0 or all(value.strip() == '' for value in row): continue
+            from_dt, to_dt = (datetime.strptime(value.strip(), '%Y-%m-%d %H:%M:%S') for value in row[:2])
+            time_intervals.append((pm.instance(from_dt), pm.instance(to_dt)))
     return time_intervals
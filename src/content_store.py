@@ -0,0 +1,143 @@
+from __future__ import annotations
+from typing import *
+import os
+import json
+import errno
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from src.utils import metrics
+from src.utils.logger import scope_logger
+
+
+def file_digest(path: str, buffer_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while n_bytes := file.readinto(buffer): digest.update(view[:n_bytes])
+    return digest.hexdigest()
+
+def selection_key(request_dict: Dict[str, Any] | None) -> str:
+    """What a request selects apart from its dates (parameters, levels, products, area), as a short hash."""
+    if request_dict is None: return ''
+    selection = {key: value for key, value in request_dict.items() if key != 'date'}
+    return hashlib.sha1(json.dumps(selection, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def link_or_copy(source: str, target: str) -> bool:
+    """Hard link target to source, copied if they are on different file systems. Returns whether it's a link."""
+    tmp_target = f'{target}.{os.getpid()}.link'
+    try:
+        os.link(source, tmp_target)
+        linked = True
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK): raise
+        shutil.copyfile(source, tmp_target)
+        linked = False
+    os.replace(tmp_target, target)
+    return linked
+
+
+class ContentStore(object):
+    """Downloaded files by sha256, with an index to recognise them before they are fetched again.
+
+    Every file is stored once under objects/ and hard linked into the download directories.
+    Files are known by two identities: the name and size of the web file, and the (init,
+    step, selection, size) parsed from its name for requests with the same parameters, levels,
+    products and area, which also matches files of other requests covering the same cycles.
+    """
+
+    def __init__(self, root: Path):
+        # sqlite3 and tarfile (via tarindex) are only loaded when a content store is configured
+        import sqlite3
+        self.root = Path(root)
+        self.objects_dir = self.root / 'objects'
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.root / 'index.sqlite'), timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, path TEXT NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (name TEXT NOT NULL, size INTEGER NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (name, size))')
+            # stores from before the size was part of the key: the fields are only an index, they are dropped and recorded again
+            if 'size' not in [column[1] for column in self._db.execute('PRAGMA table_info(fields)')]: self._db.execute('DROP TABLE IF EXISTS fields')
+            self._db.execute('CREATE TABLE IF NOT EXISTS fields (init TEXT NOT NULL, step INTEGER NOT NULL, selection TEXT NOT NULL, '
+                             'size INTEGER NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (init, step, selection, size))')
+
+    def close(self) -> None:
+        with self._lock: self._db.close()
+
+    def _object_path(self, digest: str) -> str | None:
+        row = self._db.execute('SELECT path, size FROM objects WHERE digest = ?', (digest,)).fetchone()
+        if row is None: return None
+        path, size = row
+        # objects outside the store (see add) can be moved or deleted by users
+        if os.path.exists(path) and os.path.getsize(path) == size: return path
+        self._db.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+        return None
+
+    def lookup(self, name: str, size: int, selection: str = '') -> str | None:
+        """Stored path of a web file that is already known, None if it has to be downloaded."""
+        from src.processing.tarindex import parse_member_name
+        name = os.path.basename(name)
+        init, step = parse_member_name(name)
+        with self._lock, self._db:
+            row = self._db.execute('SELECT digest FROM files WHERE name = ? AND size = ?', (name, size)).fetchone()
+            if row is None and init is not None and selection:
+                # a file of the same cycle and selection only counts as the same if the sizes agree as well
+                row = self._db.execute('SELECT digest FROM fields WHERE init = ? AND step = ? AND selection = ? AND size = ?',
+                                       (init.isoformat(), step, selection, size)).fetchone()
+            return self._object_path(row[0]) if row is not None else None
+
+    def link(self, name: str, size: int, target: str, selection: str = '') -> bool:
+        """Put a known web file at target without downloading it, returns False if it's not known."""
+        path = self.lookup(name, size, selection)
+        if path is None: return False
+        link_or_copy(path, target)
+        metrics.dedup_files.inc(outcome='skipped')
+        metrics.dedup_bytes.inc(size)
+        scope_logger.info('%s is already stored as %s, skipping download', os.path.basename(name), os.path.basename(path))
+        return True
+
+    def add(self, name: str, path: str, selection: str = '') -> str:
+        """Store a downloaded file, replacing it by a link if the same content is stored already. Returns the digest."""
+        from src.processing.tarindex import parse_member_name
+        name = os.path.basename(name)
+        digest = file_digest(path)
+        size = os.path.getsize(path)
+        init, step = parse_member_name(name)
+        with self._lock, self._db:
+            stored = self._object_path(digest)
+            if stored is not None and not os.path.samefile(stored, path):
+                link_or_copy(stored, path)
+                metrics.dedup_files.inc(outcome='duplicate')
+                metrics.dedup_bytes.inc(size)
+                scope_logger.info('%s has the same content as %s, linked', name, stored)
+            elif stored is None:
+                object_path = str(self.objects_dir / digest[:2] / digest)
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                try:
+                    os.link(path, object_path)
+                except FileExistsError:
+                    pass
+                except OSError:
+                    # a download directory on another file system is referenced in place
+                    object_path = path
+                self._db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', (digest, size, object_path))
+                metrics.dedup_files.inc(outcome='stored')
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (name, size, digest))
+            if init is not None and selection:
+                self._db.execute('INSERT OR REPLACE INTO fields VALUES (?, ?, ?, ?, ?)', (init.isoformat(), step, selection, size, digest))
+        return digest
+
+
+class Deduplicator(NamedTuple):
+    """A content store bound to the selection of one request, passed to rdams_client.download_files."""
+    store: ContentStore
+    selection: str = ''
+
+    def link(self, name: str, size: int, target: str) -> bool:
+        return self.store.link(name, size, target, self.selection)
+
+    def add(self, name: str, path: str) -> str:
+        return self.store.add(name, path, self.selection)
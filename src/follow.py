@@ -0,0 +1,178 @@
+from __future__ import annotations
+from typing import *
+import os
+import json
+import itertools
+import time
+import threading
+import traceback
+import pendulum as pm
+from src.scheduler import ConfigJob, Scheduler, WorkItem
+from src.utils.tracing import RequestTracer, TraceEvent
+from src.utils.logger import scope_logger
+
+if TYPE_CHECKING:
+    from pendulum.datetime import DateTime as PmDateTime
+
+
+CYCLE_HOURS = 6
+
+
+def parse_rda_date(value: int | str) -> PmDateTime:
+    # metadata dates are formatted as YYYYMMDDHHmm
+    return pm.from_format(str(value), 'YYYYMMDDHHmm', tz='UTC')
+
+def format_interval(cycle: PmDateTime) -> str:
+    # same format as the 'date' field of a submitted request
+    return '{}00/to/{}00'.format(cycle.format('YYYYMMDDHH'), cycle.format('YYYYMMDDHH'))
+
+def latest_available_cycle(metadata: List[Dict[str, Any]], parameters: List[str]) -> PmDateTime | None:
+    """Newest init for which all parameters are available, according to the dataset metadata."""
+    end_dates = {}
+    for item in metadata:
+        if item['param'] not in parameters or item.get('end_date') is None: continue
+        end_dates[item['param']] = max(end_dates.get(item['param'], 0), int(item['end_date']))
+
+    if len(end_dates) < len(set(parameters)): return None
+    return parse_rda_date(min(end_dates.values()))
+
+
+class CycleFollower(object):
+    """Submits every new GFS init cycle as soon as the metadata reports it as available.
+
+    The state file keeps per config item the last cycle up to which every cycle was
+    submitted, so a restarted follower continues where it stopped instead of skipping
+    cycles. It is only advanced from on_submitted/on_split (the scheduler's callbacks):
+    a cycle that was queued but never submitted, e.g. because the follower was stopped
+    or its submission failed, is requested again after a restart.
+    """
+
+    def __init__(self, jobs: List[ConfigJob], fetch_metadata: Callable[[], List[Dict[str, Any]] | None], state_path: str,
+                 latency_log_path: str, poll_interval: float, start: PmDateTime | None = None):
+        self.jobs = jobs
+        self.fetch_metadata = fetch_metadata
+        self.state_path = state_path
+        self.latency_log_path = latency_log_path
+        self.poll_interval = poll_interval
+        self.start = start
+        self.last_poll = 0.0
+        self.state = self._load_state()
+        # newest cycle queued per config item, ahead of the state while submissions are outstanding
+        self.queued: Dict[str, PmDateTime] = {name: pm.parse(cycle, tz='UTC') for name, cycle in self.state.items()}
+        # (config item, cycle) -> work items of the cycle not submitted yet, a split item counts once per piece
+        self.unsubmitted: Dict[Tuple[str, PmDateTime], int] = {}
+        # cycles with a work item that could not be submitted, they hold back the state
+        self.failed: Set[Tuple[str, PmDateTime]] = set()
+        self._split: Set[Tuple[str, WorkItem]] = set()
+        self._lock = threading.Lock()
+        # (config item, interval string) -> (cycle, time the cycle was detected)
+        self.outstanding: Dict[Tuple[str, str], Tuple[PmDateTime, float]] = {}
+
+    def _load_state(self) -> Dict[str, str]:
+        if not os.path.exists(self.state_path): return {}
+        with open(self.state_path, 'r') as file:
+            return json.load(file)
+
+    def _save_state(self) -> None:
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.state, file, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def new_cycles(self, job: ConfigJob, latest: PmDateTime) -> List[PmDateTime]:
+        if job.name in self.queued:
+            cycle = self.queued[job.name].add(hours=CYCLE_HOURS)
+        elif self.start is not None:
+            cycle = self.start
+        else:
+            # without a state, start with the newest cycle instead of backfilling
+            cycle = latest
+
+        cycles = []
+        while cycle <= latest:
+            cycles.append(cycle)
+            cycle = cycle.add(hours=CYCLE_HOURS)
+        return cycles
+
+    def poll(self, scheduler: Scheduler, tracer: RequestTracer) -> None:
+        self.report_latencies(tracer)
+        if time.time() - self.last_poll < self.poll_interval: return
+        self.last_poll = time.time()
+
+        metadata = self.fetch_metadata()
+        if metadata is None:
+            scope_logger.info('Could not get metadata, checking for new cycles later')
+            return
+
+        detected_at = time.time()
+        for job in self.jobs:
+            latest = latest_available_cycle(metadata, job.request_dict['param'].split('/'))
+            if latest is None:
+                scope_logger.info('No cycles available for %s', job.name)
+                continue
+
+            cycles = self.new_cycles(job, latest)
+            scope_logger.info('Latest available cycle for %s is %s, %s new', job.name, latest, len(cycles))
+            if len(cycles) == 0: continue
+
+            with self._lock:
+                for cycle in cycles: self.unsubmitted[(job.name, cycle)] = 1
+                self.queued[job.name] = cycles[-1]
+            scheduler.add_intervals(job, [(cycle, cycle) for cycle in cycles])
+            for cycle in cycles: self.outstanding[(job.name, format_interval(cycle))] = (cycle, detected_at)
+
+    def on_split(self, job: ConfigJob, item: WorkItem, pieces: List[WorkItem]) -> None:
+        with self._lock:
+            key = (job.name, item.from_dt)
+            if key not in self.unsubmitted and key not in self.failed: return
+            # the pieces replace an item that was rejected on submit, a cycle already submitted stays submitted
+            self.unsubmitted[key] = self.unsubmitted.get(key, 0) + len(pieces)
+            self._split.add((job.name, item))
+
+    def on_submitted(self, job: ConfigJob, item: WorkItem, request_id: int | None) -> None:
+        with self._lock:
+            key = (job.name, item.from_dt)
+            if key not in self.unsubmitted: return
+            split = (job.name, item) in self._split
+            self._split.discard((job.name, item))
+            if request_id is None and not split: self.failed.add(key)
+            self.unsubmitted[key] -= 1
+            if self.unsubmitted[key] <= 0: del self.unsubmitted[key]
+            self._advance(job.name)
+
+    def _advance(self, name: str) -> None:
+        # the state moves up to the cycle before the oldest one that isn't submitted
+        held_back = [cycle for job_name, cycle in itertools.chain(self.unsubmitted, self.failed) if job_name == name]
+        cycle = min(held_back).subtract(hours=CYCLE_HOURS) if held_back else self.queued[name]
+        previous = self.state.get(name)
+        if previous is not None and cycle <= pm.parse(previous, tz='UTC'): return
+        self.state[name] = cycle.to_iso8601_string()
+        try:
+            self._save_state()
+        except Exception:
+            scope_logger.error('Could not write follower state to %s', self.state_path)
+            traceback.print_exc()
+
+    def report_latencies(self, tracer: RequestTracer) -> None:
+        """Log and persist end-to-end latency of cycles that have been downloaded."""
+        for request_id, trace in tracer.snapshot().items():
+            key = (trace['config_item'], trace['fields'].get('interval'))
+            if key not in self.outstanding or TraceEvent.DOWNLOAD_END.value not in trace['events']: continue
+
+            cycle, detected_at = self.outstanding.pop(key)
+            events = trace['events']
+            downloaded_at = events[TraceEvent.DOWNLOAD_END.value]
+            latency = downloaded_at - cycle.timestamp()
+            scope_logger.info('Cycle %s for %s downloaded %.1f min after init, %.1f min after it was detected as available',
+                              cycle, key[0], latency / 60, (downloaded_at - detected_at) / 60)
+            try:
+                write_header = not os.path.exists(self.latency_log_path)
+                with open(self.latency_log_path, 'a') as file:
+                    if write_header: file.write('config_item,cycle,request_id,detected,submitted,completed,downloaded,latency_minutes\n')
+                    timestamps = [detected_at, events.get(TraceEvent.SUBMITTED.value), events.get(TraceEvent.COMPLETED.value), downloaded_at]
+                    timestamps = [pm.from_timestamp(ts).to_iso8601_string() if ts is not None else '' for ts in timestamps]
+                    file.write(f'{key[0]},{cycle.to_iso8601_string()},{request_id},{",".join(timestamps)},{latency / 60:.1f}\n')
+            except Exception:
+                scope_logger.error('Could not write to latency log')
+                traceback.print_exc()
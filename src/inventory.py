@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import *
+import os
+import re
+import json
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from src import settings
+from src.utils.logger import scope_logger
+
+GFS_BUCKET = 'noaa-gfs-bdp-pds'
+
+DATE_PREFIX = re.compile(r'^gfs\.(\d{8})/$')
+CYCLE_PREFIX = re.compile(r'/(\d{2})/$')
+# gfs.20240101/00/atmos/gfs.t00z.pgrb2.0p25.f003, without the .idx files
+STEP_KEY = re.compile(r'/gfs\.t\d{2}z\.pgrb2\.0p25\.f(\d{3})$')
+
+CYCLE_HOURS = ('00', '06', '12', '18')
+LAST_STEP = 384
+
+
+def make_client(endpoint_url: str | None = None) -> Any:
+    """Anonymous S3 client, endpoint_url points it to another S3 implementation, e.g. a local stand-in."""
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
+    return boto3.client('s3', endpoint_url=endpoint_url, config=Config(signature_version=UNSIGNED, max_pool_connections=32))
+
+def list_pages(client: Any, bucket: str, prefix: str, delimiter: str | None = None, start_after: str | None = None) -> Iterator[Dict[str, Any]]:
+    """All pages of list_objects_v2, following the continuation tokens."""
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter is not None: kwargs['Delimiter'] = delimiter
+    if start_after is not None: kwargs['StartAfter'] = start_after
+    while True:
+        page = client.list_objects_v2(**kwargs)
+        yield page
+        if not page.get('IsTruncated'): return
+        kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+def list_prefixes(client: Any, bucket: str, prefix: str, start_after: str | None = None) -> List[str]:
+    return [item['Prefix'] for page in list_pages(client, bucket, prefix, '/', start_after) for item in page.get('CommonPrefixes', [])]
+
+def list_keys(client: Any, bucket: str, prefix: str) -> List[str]:
+    return [item['Key'] for page in list_pages(client, bucket, prefix) for item in page.get('Contents', [])]
+
+
+class GfsInventory(object):
+    """Which GFS cycles and forecast steps exist in the NOAA bucket, cached on disk and updated incrementally.
+
+    The inventory maps 'YYYYMMDD' -> 'HH' -> sorted steps. An update only lists the dates after
+    the newest one in the cache, plus the recent dates that were still incomplete, one date per
+    task on a thread pool.
+    """
+
+    def __init__(self, cache_path: str = settings.GFS_INVENTORY, client: Any | None = None, bucket: str = GFS_BUCKET,
+                 n_workers: int = 16, relist_days: int = 2, with_steps: bool = True):
+        self.cache_path = cache_path
+        self._client = client
+        self.bucket = bucket
+        self.n_workers = n_workers
+        self.relist_days = relist_days
+        self.with_steps = with_steps
+        self.dates: Dict[str, Dict[str, List[int]]] = {}
+        self.updated_at: float | None = None
+        self._read()
+
+    @property
+    def client(self) -> Any:
+        if self._client is None: self._client = make_client(settings.S3_ENDPOINT_URL)
+        return self._client
+
+    def _read(self) -> None:
+        try:
+            with open(self.cache_path, 'r') as file: content = json.load(file)
+        except (OSError, ValueError):
+            return
+        if content.get('bucket') != self.bucket or content.get('with_steps') != self.with_steps: return
+        self.dates, self.updated_at = content['dates'], content['updated_at']
+
+    def _write(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'bucket': self.bucket, 'with_steps': self.with_steps, 'updated_at': self.updated_at, 'dates': self.dates}, file)
+        os.replace(tmp_path, self.cache_path)
+
+    def _is_complete(self, cycles: Dict[str, List[int]]) -> bool:
+        if set(cycles) != set(CYCLE_HOURS): return False
+        return not self.with_steps or all(len(steps) > 0 and steps[-1] >= LAST_STEP for steps in cycles.values())
+
+    def list_date(self, date: str) -> Dict[str, List[int]]:
+        cycles = {}
+        for prefix in list_prefixes(self.client, self.bucket, f'gfs.{date}/'):
+            match = CYCLE_PREFIX.search(prefix)
+            if match is None: continue
+            if not self.with_steps:
+                cycles[match.group(1)] = []
+                continue
+            keys = list_keys(self.client, self.bucket, f'{prefix}atmos/gfs.t{match.group(1)}z.pgrb2.0p25.f')
+            cycles[match.group(1)] = sorted(int(step.group(1)) for step in map(STEP_KEY.search, keys) if step is not None)
+        return cycles
+
+    def update(self) -> List[str]:
+        """List new and incomplete recent dates, returns the dates that were listed."""
+        start = time.monotonic()
+        newest = max(self.dates) if self.dates else None
+        new_dates = []
+        # '~' sorts after the keys of the newest date, so listing starts at the next one
+        for prefix in list_prefixes(self.client, self.bucket, 'gfs.', f'gfs.{newest}/~' if newest is not None else None):
+            match = DATE_PREFIX.match(prefix)
+            if match is not None: new_dates.append(match.group(1))
+
+        # cycles and steps of the last days are still being uploaded
+        recent = (datetime.strptime(newest, '%Y%m%d') - timedelta(days=self.relist_days)).strftime('%Y%m%d') if newest is not None else ''
+        relist = [date for date, cycles in self.dates.items() if date >= recent and not self._is_complete(cycles)]
+        dates = sorted(set(new_dates + relist))
+
+        with ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix='inventory') as executor:
+            for date, cycles in zip(dates, executor.map(self.list_date, dates)): self.dates[date] = cycles
+
+        self.updated_at = time.time()
+        self._write()
+        scope_logger.info('Listed %s dates of %s in %.1f s, %s dates in the inventory', len(dates), self.bucket, time.monotonic() - start, len(self.dates))
+        return dates
+
+    def cycles(self, start: datetime | None = None, end: datetime | None = None, min_step: int | None = None) -> List[datetime]:
+        """Available cycles between start and end (inclusive), optionally only those with steps up to min_step."""
+        cycles = []
+        for date, hours in self.dates.items():
+            for hour, steps in hours.items():
+                cycle = datetime.strptime(date + hour, '%Y%m%d%H')
+                if start is not None and cycle < start or end is not None and cycle > end: continue
+                if min_step is not None and (len(steps) == 0 or steps[-1] < min_step): continue
+                cycles.append(cycle)
+        return sorted(cycles)
+
+    def steps(self, cycle: datetime) -> List[int]:
+        return self.dates.get(cycle.strftime('%Y%m%d'), {}).get(cycle.strftime('%H'), [])
+
+    def has(self, cycle: datetime, step: int | None = None) -> bool:
+        hours = self.dates.get(cycle.strftime('%Y%m%d'), {})
+        if cycle.strftime('%H') not in hours: return False
+        return step is None or step in self.steps(cycle)
+
+    def latest_cycle(self, min_step: int | None = None) -> datetime | None:
+        cycles = self.cycles(min_step=min_step)
+        return cycles[-1] if cycles else None
@@ -0,0 +1,251 @@
+from __future__ import annotations
+from typing import *
+import os
+import re
+import json
+import time
+import threading
+from src.utils.logger import scope_logger
+
+# fields of the get_metadata records that are used, the others are dropped while parsing
+METADATA_FIELDS = ('param', 'product', 'start_date', 'end_date', 'levels')
+
+
+def parse_levels(levels: str) -> Dict[str, List[str]]:
+    """'HTGL:2/10/100;SFC:0' -> {'HTGL': ['2', '10', '100'], 'SFC': ['0']}."""
+    parsed = {}
+    for item in levels.split(';'):
+        if item.strip() == '': continue
+        name, _, values = item.partition(':')
+        parsed[name.strip()] = [value.strip() for value in values.split('/') if value.strip() != '']
+    return parsed
+
+def format_levels(levels: Dict[str, Iterable[str]]) -> str:
+    return ';'.join(f'{name}:{"/".join(values)}' for name, values in levels.items())
+
+def parse_request_dates(date: str) -> Tuple[int, int]:
+    """'YYYYMMDDHHmm/to/YYYYMMDDHHmm' of a request dict as comparable integers, the format of the metadata dates."""
+    from_date, _, to_date = date.partition('/to/')
+    return int(from_date), int(to_date or from_date)
+
+def summarize(values: List[str], n: int = 3) -> str:
+    # product lists run into the hundreds
+    return ', '.join(values[:n]) + (f' and {len(values) - n} more' if len(values) > n else '')
+
+def level_value(value: Any) -> str:
+    # values are listed as e.g. '2' or '2.0'
+    try:
+        return format(float(value), 'g')
+    except (TypeError, ValueError):
+        return str(value)
+
+def item_levels(item: Dict[str, Any]) -> Dict[str, Set[str]] | None:
+    """Level types and values of a metadata item, None if the metadata doesn't list them."""
+    if not isinstance(item.get('levels'), list): return None
+    levels = {}
+    for level in item['levels']:
+        name = level.get('level')
+        if name is None: continue
+        value = level.get('level_value')
+        levels.setdefault(name, set()).add(level_value(value) if value not in (None, '') else '0')
+    return levels
+
+
+class MetadataCache(object):
+    """get_metadata of a dataset, kept on disk for max_age seconds so it isn't fetched for every run."""
+
+    def __init__(self, fetch: Callable[[], List[Dict[str, Any]] | None], path: str, max_age: float = 6 * 3600):
+        self.fetch = fetch
+        self.path = path
+        self.max_age = max_age
+        self._items: List[Dict[str, Any]] | None = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def _read(self) -> None:
+        try:
+            with open(self.path, 'r') as file: content = json.load(file)
+            self._items, self._fetched_at = content['data'], content['fetched_at']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _write(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file: json.dump({'fetched_at': self._fetched_at, 'data': self._items}, file)
+        os.replace(tmp_path, self.path)
+
+    def get(self, refresh: bool = False) -> List[Dict[str, Any]] | None:
+        """Metadata items, fetched if the cache is missing or stale, a stale copy if fetching fails."""
+        # submit threads validate concurrently, only one of them fetches
+        with self._lock: return self._get(refresh)
+
+    def _get(self, refresh: bool) -> List[Dict[str, Any]] | None:
+        if self._items is None: self._read()
+        if not refresh and self._items is not None and time.time() - self._fetched_at < self.max_age: return self._items
+
+        items = self.fetch()
+        if items is None:
+            if self._items is not None: scope_logger.warning('Could not fetch metadata, using the cached copy from %s', time.ctime(self._fetched_at))
+            return self._items
+        self._items, self._fetched_at = items, time.time()
+        try:
+            self._write()
+        except OSError:
+            scope_logger.warning('Could not write metadata cache %s', self.path)
+        return self._items
+
+
+class MetadataEntry(NamedTuple):
+    start_date: int | None
+    end_date: int | None
+    # None if the metadata doesn't list the levels
+    levels: Dict[str, Set[str]] | None
+
+    def overlaps(self, from_date: int | None, to_date: int | None) -> bool:
+        if to_date is not None and self.start_date is not None and self.start_date > to_date: return False
+        return from_date is None or self.end_date is None or self.end_date >= from_date
+
+
+def merge_levels(entries: Iterable[MetadataEntry]) -> Dict[str, Set[str]] | None:
+    """Union of the levels of entries, None if any of them doesn't list its levels."""
+    merged = {}
+    for entry in entries:
+        if entry.levels is None: return None
+        for name, values in entry.levels.items(): merged.setdefault(name, set()).update(values)
+    return merged
+
+
+class MetadataIndex(object):
+    """get_metadata records as param -> product -> entries with their dates and levels.
+
+    Built once per fetch, so lookups only look at the entries of one parameter or product
+    instead of scanning all records. Records can be passed as they are parsed, e.g. from
+    rdams_client.iter_metadata. Dates are integers formatted as YYYYMMDDHHmm, like in the
+    metadata, and None leaves that end of a date range open.
+    """
+
+    def __init__(self, items: Iterable[Dict[str, Any]]):
+        self._params: Dict[str, Dict[str, List[MetadataEntry]]] = {}
+        for item in items:
+            if 'param' not in item or 'product' not in item: continue
+            start_date, end_date = item.get('start_date'), item.get('end_date')
+            entry = MetadataEntry(int(start_date) if start_date is not None else None, int(end_date) if end_date is not None else None, item_levels(item))
+            self._params.setdefault(item['param'], {}).setdefault(item['product'], []).append(entry)
+
+    def __len__(self) -> int:
+        return len(self._params)
+
+    def __contains__(self, param: str) -> bool:
+        return param in self._params
+
+    def params(self) -> List[str]:
+        return list(self._params)
+
+    def products(self, param: str, pattern: str | None = None, from_date: int | None = None, to_date: int | None = None) -> List[str]:
+        """Products of param in metadata order, only those matching the regular expression pattern and available between the dates."""
+        products = []
+        for product, entries in self._params.get(param, {}).items():
+            if pattern is not None and re.search(pattern, product) is None: continue
+            if any(entry.overlaps(from_date, to_date) for entry in entries): products.append(product)
+        return products
+
+    def levels(self, param: str, product: str | None = None, from_date: int | None = None, to_date: int | None = None) -> Dict[str, Set[str]] | None:
+        """Level types and values of param (and product) between the dates, None if the metadata doesn't list them."""
+        return merge_levels(entry for name, entries in self._params.get(param, {}).items() if product is None or name == product
+                            for entry in entries if entry.overlaps(from_date, to_date))
+
+    def product_levels(self, param: str, from_date: int | None = None, to_date: int | None = None) -> Dict[str, Dict[str, Set[str]] | None]:
+        """product -> levels (None if unknown) of param, for the products available between the dates."""
+        available = {}
+        for product, entries in self._params.get(param, {}).items():
+            entries = [entry for entry in entries if entry.overlaps(from_date, to_date)]
+            if entries: available[product] = merge_levels(entries)
+        return available
+
+    def date_range(self, param: str, product: str | None = None) -> Tuple[int | None, int | None] | None:
+        """First and last date of param (and product), None if it's not in the metadata."""
+        entries = [entry for name, entries in self._params.get(param, {}).items() if product is None or name == product for entry in entries]
+        if len(entries) == 0: return None
+        start_dates, end_dates = [entry.start_date for entry in entries], [entry.end_date for entry in entries]
+        return (None if None in start_dates else min(start_dates)), (None if None in end_dates else max(end_dates))
+
+
+class ValidationResult(NamedTuple):
+    request_dict: Dict[str, Any]
+    # human readable problems, e.g. products not available for the dates
+    issues: List[str]
+    # whether there is anything left to request
+    valid: bool
+
+
+class RequestValidator(object):
+    """Checks request dicts against the dataset metadata before they are submitted.
+
+    A product is kept if at least one requested parameter has it for some of the requested
+    dates, the same holds for levels if the metadata lists them. Parameters with none of the
+    products available make the server fail the request, so they are reported as well. With
+    drop=True the request dict is reduced to what is available. Otherwise the issues are only
+    reported, the request stays valid and is submitted as it is.
+    """
+
+    def __init__(self, metadata: Callable[[], List[Dict[str, Any]] | MetadataIndex | None], drop: bool = True):
+        self.metadata = metadata
+        self.drop = drop
+        # the index of the last metadata list, rebuilt when the cache fetched a new one
+        self._indexed: Tuple[Any, MetadataIndex] | None = None
+
+    def index(self) -> MetadataIndex | None:
+        items = self.metadata()
+        if items is None or isinstance(items, MetadataIndex): return items
+        indexed = self._indexed
+        if indexed is None or indexed[0] is not items:
+            indexed = self._indexed = (items, MetadataIndex(items))
+        return indexed[1]
+
+    def validate(self, request_dict: Dict[str, Any]) -> ValidationResult:
+        index = self.index()
+        if index is None: return ValidationResult(request_dict, ['No metadata available, request not validated'], True)
+
+        from_date, to_date = parse_request_dates(request_dict['date'])
+        parameters = request_dict['param'].split('/')
+        available = {param: index.product_levels(param, from_date, to_date) for param in set(parameters)}
+        available = {param: products for param, products in available.items() if products}
+        products = request_dict['product'].split('/')
+        levels = parse_levels(request_dict.get('level', ''))
+        issues = []
+
+        unknown_parameters = [param for param in parameters if param not in available]
+        if unknown_parameters: issues.append(f'Parameters not available for {request_dict["date"]}: {summarize(unknown_parameters)}')
+        known_parameters = [param for param in parameters if param in available]
+
+        valid_products = [product for product in products if any(product in available[param] for param in known_parameters)]
+        missing_products = [product for product in products if product not in valid_products]
+        if missing_products: issues.append(f'Products not available for {request_dict["date"]}: {summarize(missing_products)}')
+
+        without_products = [param for param in known_parameters if not any(product in available[param] for product in valid_products)]
+        if without_products: issues.append(f'Parameters without any of the requested products: {summarize(without_products)}')
+
+        valid_levels = {}
+        listed = [available[param][product] for param in known_parameters for product in valid_products if product in available[param]]
+        for name, values in levels.items():
+            # levels are only checked where the metadata lists them
+            if len(listed) == 0 or any(product_levels is None for product_levels in listed):
+                valid_levels[name] = values
+                continue
+            listed_values = set().union(*[product_levels.get(name, set()) for product_levels in listed])
+            valid_levels[name] = [value for value in values if level_value(value) in listed_values]
+            missing_levels = [value for value in values if value not in valid_levels[name]]
+            if missing_levels: issues.append(f'Levels not available: {name}:{"/".join(missing_levels)}')
+        valid_levels = {name: values for name, values in valid_levels.items() if values}
+
+        valid_parameters = [param for param in known_parameters if param not in without_products]
+        valid = len(valid_parameters) > 0 and len(valid_products) > 0 and (len(levels) == 0 or len(valid_levels) > 0)
+        if not self.drop: return ValidationResult(request_dict, issues, True)
+        if not valid: return ValidationResult(request_dict, issues, False)
+
+        request_dict = request_dict.copy()
+        request_dict['param'] = '/'.join(valid_parameters)
+        request_dict['product'] = '/'.join(valid_products)
+        if 'level' in request_dict: request_dict['level'] = format_levels(valid_levels)
+        return ValidationResult(request_dict, issues, valid)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+from typing import *
+import numpy as np
+from src.utils.lazy import lazy_import
+
+xr = lazy_import('xarray')
+
+
+def interval_values(values: np.ndarray, start_steps: np.ndarray, end_steps: np.ndarray, step_type: str,
+                    same_series: np.ndarray | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Turn windowed GFS products into values per interval between consecutive steps.
+
+    values has the steps on axis 0, sorted by end step. A window that starts where the previous
+    one started (0-6h after 0-3h, or 0-N after 0-(N-3) for total accumulations) is differenced
+    with it, otherwise it's an interval of its own (6-9h after 0-6h). This covers the 3h/6h
+    alternation and the switch to 6-hourly output at 240h without special cases.
+
+    Returns (values, interval start steps): accumulations become rates per hour, averages the
+    mean over the interval. same_series marks rows that continue the series of the previous row
+    (defaults to all), so several series can be handled in one call.
+    """
+    start_steps = np.asarray(start_steps, dtype=np.float64)
+    end_steps = np.asarray(end_steps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    expand = (slice(None),) + (None,) * (values.ndim - 1)
+
+    # averages are turned into integrals over their window first
+    integrals = values * (end_steps - start_steps)[expand] if step_type == 'avg' else values
+
+    continues = np.zeros(len(end_steps), dtype=bool)
+    continues[1:] = (start_steps[1:] == start_steps[:-1]) & (end_steps[1:] > end_steps[:-1])
+    if same_series is not None: continues &= same_series
+
+    previous_ends = np.concatenate([[0.0], end_steps[:-1]])
+    interval_starts = np.where(continues, previous_ends, start_steps)
+    previous_integrals = np.concatenate([np.zeros_like(integrals[:1]), integrals[:-1]])
+    amounts = integrals - np.where(continues[expand], previous_integrals, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rates = amounts / (end_steps - interval_starts)[expand]
+    return rates, interval_starts.astype(np.int16)
+
+def deaccumulate_columns(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """interval_values for long format site columns (see sites.to_columns), in place of the windowed values.
+
+    Series are identified by site, init, param, level and the kind of window: total windows
+    (0-N) and the 3h/6h windows ((N-6)-N) are separate series when both products are requested.
+    Accumulations get the step type 'rate'.
+    """
+    if len(columns.get('value', ())) == 0: return columns
+    columns = dict(columns)
+    for step_type in ('accum', 'avg'):
+        rows = np.flatnonzero(columns['step_type'] == step_type)
+        if len(rows) == 0: continue
+
+        keys = [columns[name][rows] for name in ('site', 'init', 'param', 'level_type', 'level')] + [columns['start_step'][rows] == 0]
+        codes = [np.unique(key.astype(str) if key.dtype == object else key, return_inverse=True)[1] for key in keys]
+        sort = np.lexsort([columns['end_step'][rows]] + codes[::-1])
+        order = rows[sort]
+        sorted_codes = np.stack([code[sort] for code in codes])
+        same_series = np.zeros(len(order), dtype=bool)
+        same_series[1:] = (sorted_codes[:, 1:] == sorted_codes[:, :-1]).all(axis=0)
+
+        rates, interval_starts = interval_values(columns['value'][order], columns['start_step'][order], columns['end_step'][order],
+                                                 step_type, same_series)
+        for name in ('value', 'start_step', 'step_type'): columns[name] = columns[name].copy()
+        columns['value'][order] = rates
+        columns['start_step'][order] = interval_starts
+        if step_type == 'accum': columns['step_type'][order] = 'rate'
+    return columns
+
+def deaccumulate_dataset(dataset: 'xr.Dataset') -> 'xr.Dataset':
+    """interval_values for the windowed variables of an InitDatasetWriter dataset, the start steps become interval starts."""
+    dataset = dataset.copy()
+    for name in list(dataset.data_vars):
+        start_name = f'{name}_start_step'
+        if start_name not in dataset: continue
+        variable = dataset[name]
+        step_type = variable.attrs.get('step_type')
+        valid = dataset[start_name].values >= 0
+        if not valid.any(): continue
+
+        values = variable.values.copy()
+        start_steps = dataset[start_name].values.copy()
+        rates, interval_starts = interval_values(values[valid], start_steps[valid], dataset['step'].values[valid], step_type)
+        values[valid] = rates
+        start_steps[valid] = interval_starts
+        dataset[name] = (variable.dims, values.astype(variable.dtype), {**variable.attrs, 'step_type': 'rate' if step_type == 'accum' else step_type})
+        dataset[start_name] = (dataset[start_name].dims, start_steps)
+    return dataset
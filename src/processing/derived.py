@@ -0,0 +1,170 @@
+from __future__ import annotations
+from typing import *
+import os
+from functools import partial
+from datetime import datetime
+import numpy as np
+from src.processing.grib import MessageInfo, iter_field_batches, select_fields, select_times
+from src.processing.output import InitDatasetWriter
+from src.processing.parallel import map_files
+from src.processing.tarindex import select_members
+from src.utils.logger import scope_logger
+
+# (param, level_type, level) of an instant field
+FieldKey = Tuple[str, str, float]
+
+# points per chunk, bounds the float64 temporaries of a computation to a few MB
+DEFAULT_CHUNK_SIZE = 1 << 18
+
+# power law exponent used where the shear can't be estimated, e.g. calm wind at 10 m
+DEFAULT_SHEAR_EXPONENT = 1 / 7
+
+
+def wind_speed(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    return np.hypot(u, v)
+
+def wind_direction(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """Meteorological direction the wind blows from, in degrees clockwise from north."""
+    return np.degrees(np.arctan2(-u, -v)) % 360
+
+def hub_height_wind(u10: np.ndarray, v10: np.ndarray, u100: np.ndarray, v100: np.ndarray, height: float | np.ndarray) -> np.ndarray:
+    """Wind speed at height (m), extrapolated from 100 m with the power law shear between 10 and 100 m."""
+    speed10, speed100 = np.hypot(u10, v10), np.hypot(u100, v100)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponent = np.log(speed100 / speed10) / np.log(10.0)
+    exponent = np.where(np.isfinite(exponent), np.clip(exponent, -0.5, 1.0), DEFAULT_SHEAR_EXPONENT)
+    return speed100 * (height / 100.0) ** exponent
+
+def specific_humidity(rh: np.ndarray, temperature: np.ndarray, pressure: np.ndarray) -> np.ndarray:
+    """kg/kg from relative humidity (%), temperature (K) and pressure (Pa), saturation vapour pressure after Bolton (1980)."""
+    saturation = 611.2 * np.exp(17.67 * (temperature - 273.15) / (temperature - 29.65))
+    vapour = rh / 100.0 * saturation
+    return 0.622 * vapour / (pressure - 0.378 * vapour)
+
+
+class DerivedVariable(NamedTuple):
+    param: str
+    level_type: str
+    # None for the hub height wind at sites, which is computed at each site's own hub height
+    level: float | None
+    inputs: Tuple[FieldKey, ...]
+    func: Callable[..., np.ndarray]
+
+    @property
+    def key(self) -> Tuple[str, str, float | None]:
+        return self.param, self.level_type, self.level
+
+    def compute(self, inputs: List[np.ndarray], chunk_size: int = DEFAULT_CHUNK_SIZE, heights: np.ndarray | None = None) -> np.ndarray:
+        """func over the flattened inputs in chunks of chunk_size points, heights are the hub heights for level None."""
+        shape = inputs[0].shape
+        flat = [np.asarray(values).reshape(-1) for values in inputs]
+        heights = np.asarray(heights, dtype=np.float64).reshape(-1) if heights is not None else None
+        values = np.empty(flat[0].size, dtype=np.float32)
+        for start in range(0, values.size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            kwargs = {'height': heights[chunk]} if self.level is None else {}
+            values[chunk] = self.func(*(inputs[chunk] for inputs in flat), **kwargs)
+        return values.reshape(shape)
+
+
+WIND_10 = (('U GRD', 'HTGL', 10.0), ('V GRD', 'HTGL', 10.0))
+WIND_100 = (('U GRD', 'HTGL', 100.0), ('V GRD', 'HTGL', 100.0))
+
+def derived_variables(hub_heights: Iterable[float] = (), site_hub_heights: bool = False) -> List[DerivedVariable]:
+    """Wind speed and direction at 10 and 100 m, specific humidity at 2 m and the wind at the given hub heights."""
+    variables = [
+        DerivedVariable('WIND', 'HTGL', 10.0, WIND_10, wind_speed),
+        DerivedVariable('WDIR', 'HTGL', 10.0, WIND_10, wind_direction),
+        DerivedVariable('WIND', 'HTGL', 100.0, WIND_100, wind_speed),
+        DerivedVariable('WDIR', 'HTGL', 100.0, WIND_100, wind_direction),
+        # GFS has no surface pressure in the configs, the sea level pressure is close enough at 2 m over most sites
+        DerivedVariable('SPF H', 'HTGL', 2.0, (('R H', 'HTGL', 2.0), ('TMP', 'HTGL', 2.0), ('PRMSL', 'MSL', 0.0)), specific_humidity),
+    ]
+    for height in hub_heights:
+        if float(height) in (10.0, 100.0): continue
+        variables.append(DerivedVariable('WIND', 'HTGL', float(height), WIND_10 + WIND_100, partial(hub_height_wind, height=float(height))))
+    if site_hub_heights: variables.append(DerivedVariable('WIND', 'HTGL', None, WIND_10 + WIND_100, hub_height_wind))
+    return variables
+
+def input_selection(variables: List[DerivedVariable]) -> Tuple[List[str], Dict[str, List[float]]]:
+    """Parameters and levels of all inputs, in the terms of select_fields."""
+    parameters, levels = set(), {}
+    for variable in variables:
+        for param, level_type, level in variable.inputs:
+            parameters.add(param)
+            levels.setdefault(level_type, set()).add(level)
+    return sorted(parameters), {level_type: sorted(values) for level_type, values in levels.items()}
+
+def with_inputs(select: Callable[[MessageInfo], bool], variables: List[DerivedVariable]) -> Callable[[MessageInfo], bool]:
+    """select extended by the inputs of the derived variables."""
+    select_inputs = select_fields(*input_selection(variables))
+    return lambda info: select(info) or select_inputs(info)
+
+
+class DerivedFields(object):
+    """Collects the instant input fields per init and step and computes each derived variable once its inputs are complete.
+
+    Fields may be grids or values at sites, only the inputs of the current init are kept.
+    """
+
+    def __init__(self, variables: List[DerivedVariable], chunk_size: int = DEFAULT_CHUNK_SIZE, heights: np.ndarray | None = None):
+        self.variables = variables
+        self.chunk_size = chunk_size
+        self.heights = heights
+        self.inputs: Set[FieldKey] = {key for variable in variables for key in variable.inputs}
+        self.pending: Dict[Tuple[Any, int], Dict[FieldKey, np.ndarray]] = {}
+        self.done: Dict[Tuple[Any, int], Set[int]] = {}
+
+    def add(self, info: MessageInfo, field: np.ndarray) -> List[Tuple[MessageInfo, np.ndarray]]:
+        """Derived (info, field) that became computable with this field."""
+        key = (info.param, info.level_type, float(info.level))
+        if info.step_type != 'instant' or key not in self.inputs: return []
+
+        group = (info.init, info.end_step)
+        if any(init != info.init for init, _ in self.pending):
+            self.pending = {other: fields for other, fields in self.pending.items() if other[0] == info.init}
+            self.done = {other: done for other, done in self.done.items() if other[0] == info.init}
+        fields = self.pending.setdefault(group, {})
+        done = self.done.setdefault(group, set())
+        fields[key] = field
+
+        derived = []
+        for idx, variable in enumerate(self.variables):
+            if idx in done or key not in variable.inputs or not all(name in fields for name in variable.inputs): continue
+            values = variable.compute([fields[name] for name in variable.inputs], self.chunk_size, self.heights)
+            level = variable.level if variable.level is not None else np.nan
+            derived.append((MessageInfo(variable.param, variable.level_type, level, 'instant', info.start_step, info.end_step, info.init), values))
+            done.add(idx)
+        if len(done) == len(self.variables):
+            del self.pending[group], self.done[group]
+        return derived
+
+
+def derive_file(path: str, output_dir: str, variables: List[DerivedVariable], parameters: List[str] | None = None,
+                levels: Dict[str, List[float]] | None = None, deaccumulate: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                init_range: Tuple[datetime, datetime] | None = None, steps: List[int] | None = None, batch_size: int = 32) -> List[str]:
+    """Write the selected raw fields of a .grib2/.tar file and the derived variables next to them, as one netCDF file per init.
+
+    Of a .tar file only the members of init_range and steps are read, found through its index.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    select = select_fields(parameters, levels)
+    derived = DerivedFields(variables, chunk_size)
+    members = select_members(path, init_range, steps)
+    writer = None
+    for grid, infos, fields in iter_field_batches(path, select_times(with_inputs(select, variables), init_range, steps), batch_size, members):
+        if writer is None: writer = InitDatasetWriter(output_dir, stem, grid, {'source': os.path.basename(path)}, deaccumulate)
+        for info, field in zip(infos, fields):
+            if select(info): writer.add(info, field)
+            for derived_info, derived_field in derived.add(info, field): writer.add(derived_info, derived_field)
+    return writer.close() if writer is not None else []
+
+def derive_files(paths: List[str], output_dir: str, variables: List[DerivedVariable], parameters: List[str] | None = None,
+                 levels: Dict[str, List[float]] | None = None, deaccumulate: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 n_workers: int = 1, init_range: Tuple[datetime, datetime] | None = None, steps: List[int] | None = None) -> List[str]:
+    output_paths = []
+    tasks = [(path, output_dir, variables, parameters, levels, deaccumulate, chunk_size, init_range, steps) for path in paths]
+    for idx, (file_output_paths, elapsed) in enumerate(map_files(derive_file, tasks, n_workers)):
+        scope_logger.info('[%s/%s] %s: %s inits in %.1f s', idx + 1, len(paths), paths[idx], len(file_output_paths), elapsed)
+        output_paths.extend(file_output_paths)
+    return output_paths
@@ -0,0 +1,176 @@
+from __future__ import annotations
+from typing import *
+import os
+import mmap
+from datetime import datetime, timedelta
+from src.utils.lazy import lazy_import
+
+pygrib = lazy_import('pygrib')
+
+if TYPE_CHECKING:
+    import numpy as np
+    from src.processing.tarindex import TarMember
+
+
+GRIB_MAGIC = b'GRIB'
+GRIB_END = b'7777'
+
+# RDA parameter names used in config/request_configs.yaml -> GRIB2 (discipline, category, number)
+RDA_PARAMETERS = {
+    'TMP': (0, 0, 0),
+    'APTMP': (0, 0, 21),
+    'SPF H': (0, 1, 0),
+    'R H': (0, 1, 1),
+    'A PCP': (0, 1, 8),
+    'CPOFP': (0, 1, 39),
+    'WDIR': (0, 2, 0),
+    'WIND': (0, 2, 1),
+    'U GRD': (0, 2, 2),
+    'V GRD': (0, 2, 3),
+    'GUST': (0, 2, 22),
+    'PRMSL': (0, 3, 1),
+    'DSWRF': (0, 4, 7),
+    'T CDC': (0, 6, 1),
+    'ALBDO': (0, 19, 1),
+}
+GRIB_PARAMETERS = {code: name for name, code in RDA_PARAMETERS.items()}
+
+# eccodes typeOfLevel -> RDA level type
+LEVEL_TYPES = {
+    'surface': 'SFC',
+    'heightAboveGround': 'HTGL',
+    'meanSea': 'MSL',
+    'atmosphere': 'EATM',
+    'entireAtmosphere': 'EATM',
+}
+
+
+class MessageInfo(NamedTuple):
+    param: str
+    level_type: str
+    level: float
+    step_type: str
+    start_step: int
+    end_step: int
+    init: datetime
+
+    @property
+    def valid_time(self) -> datetime:
+        return self.init + timedelta(hours=self.end_step)
+
+    @classmethod
+    def from_message(cls, message) -> 'MessageInfo':
+        code = (message['discipline'], message['parameterCategory'], message['parameterNumber'])
+        date, time = message['dataDate'], message['dataTime']
+        init = datetime(date // 10000, date // 100 % 100, date % 100, time // 100, time % 100)
+        return cls(
+            GRIB_PARAMETERS.get(code, '{}.{}.{}'.format(*code)),
+            LEVEL_TYPES.get(message['typeOfLevel'], message['typeOfLevel']),
+            message['level'],
+            message['stepType'],
+            message['startStep'],
+            message['endStep'],
+            init,
+        )
+
+
+def message_length(buffer: bytes | mmap.mmap, offset: int) -> int | None:
+    """Total length of the GRIB message starting at offset, None if it's not a valid header."""
+    if len(buffer) < offset + 16: return None
+    edition = buffer[offset + 7]
+    if edition == 2: return int.from_bytes(buffer[offset + 8:offset + 16], 'big')
+    if edition == 1: return int.from_bytes(buffer[offset + 4:offset + 7], 'big')
+    return None
+
+def iter_message_spans(buffer: bytes | mmap.mmap, start: int = 0, end: int | None = None) -> Iterator[Tuple[int, int]]:
+    """(offset, length) of every GRIB message in a buffer, or in buffer[start:end].
+
+    The buffer is scanned for the GRIB signature, so anything in between messages, like the
+    member headers of a tar archive, is skipped and .grib2 and .tar files are read the same way.
+    """
+    end = len(buffer) if end is None else end
+    offset = buffer.find(GRIB_MAGIC, start, end)
+    while offset != -1:
+        length = message_length(buffer, offset)
+        if length is not None and offset + length <= end and buffer[offset + length - 4:offset + length] == GRIB_END:
+            yield offset, length
+            offset = buffer.find(GRIB_MAGIC, offset + length, end)
+        else:
+            # 'GRIB' inside other data
+            offset = buffer.find(GRIB_MAGIC, offset + 1, end)
+
+def open_buffer(path: str) -> mmap.mmap | bytes:
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0: return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def iter_messages(path: str, select: Callable[[MessageInfo], bool] | None = None,
+                  members: List[TarMember] | None = None) -> Iterator[Tuple[MessageInfo, Any]]:
+    """Decoded pygrib messages of a .grib2 or .tar file, optionally filtered on their header.
+
+    Values are only unpacked when message.values is accessed, so filtered out messages are cheap.
+    With members (see tarindex.TarIndex) only those members of a tar file are read.
+    """
+    buffer = open_buffer(path)
+    ranges = [(member.offset, member.offset + member.size) for member in members] if members is not None else [(0, None)]
+    try:
+        for start, end in ranges:
+            for offset, length in iter_message_spans(buffer, start, end):
+                message = pygrib.fromstring(bytes(buffer[offset:offset + length]))
+                info = MessageInfo.from_message(message)
+                if select is None or select(info): yield info, message
+    finally:
+        if isinstance(buffer, mmap.mmap): buffer.close()
+
+def field_values(message) -> np.ndarray:
+    import numpy as np
+
+    # fields with a bitmap are decoded as masked arrays
+    return np.ma.filled(np.ma.asarray(message.values, dtype=np.float64), np.nan)
+
+def iter_field_batches(path: str, select: Callable[[MessageInfo], bool] | None = None, batch_size: int = 32,
+                       members: List[TarMember] | None = None) -> Iterator[Tuple[Any, List[MessageInfo], np.ndarray]]:
+    """(grid, infos, fields of shape (n, n_lat, n_lon)) for up to batch_size consecutive messages on the same grid."""
+    import numpy as np
+    from src.processing.grid import LatLonGrid
+
+    infos, fields, batch_grid = [], [], None
+    for info, message in iter_messages(path, select, members):
+        grid = LatLonGrid.from_message(message)
+        if len(infos) > 0 and (grid != batch_grid or len(infos) >= batch_size):
+            yield batch_grid, infos, np.stack(fields)
+            infos, fields = [], []
+        batch_grid = grid
+        infos.append(info)
+        fields.append(field_values(message))
+    if len(infos) > 0: yield batch_grid, infos, np.stack(fields)
+
+def select_fields(parameters: Iterable[str] | None = None, levels: Dict[str, Iterable[float]] | None = None) -> Callable[[MessageInfo], bool]:
+    """Filter for iter_messages in the terms of a request config, e.g. (['U GRD'], {'HTGL': [10, 100]})."""
+    parameters = set(parameters) if parameters is not None else None
+    levels = {level_type: set(float(value) for value in values) for level_type, values in levels.items()} if levels is not None else None
+
+    def select(info: MessageInfo) -> bool:
+        if parameters is not None and info.param not in parameters: return False
+        if levels is not None and float(info.level) not in levels.get(info.level_type, ()): return False
+        return True
+    return select
+
+def select_times(select: Callable[[MessageInfo], bool] | None = None, init_range: Tuple[datetime, datetime] | None = None,
+                 steps: Collection[int] | None = None) -> Callable[[MessageInfo], bool] | None:
+    """select restricted to the inits in init_range (inclusive) and the forecast steps (end step of a window), None matches all."""
+    if init_range is None and steps is None: return select
+    steps = set(steps) if steps is not None else None
+
+    def select_time(info: MessageInfo) -> bool:
+        if init_range is not None and not init_range[0] <= info.init <= init_range[1]: return False
+        if steps is not None and info.end_step not in steps: return False
+        return select is None or select(info)
+    return select_time
+
+def list_grib_files(input_dir: str) -> List[str]:
+    paths = []
+    for root, _, files in os.walk(input_dir):
+        for name in files:
+            if name.endswith(('.grib2', '.grb2', '.grib', '.tar')): paths.append(os.path.join(root, name))
+    return sorted(paths)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+from typing import *
+import re
+import numpy as np
+
+
+class LatLonGrid(NamedTuple):
+    """Regular lat/lon grid, rows run from lat_first in steps of d_lat (negative for north to south)."""
+    lat_first: float
+    lon_first: float
+    d_lat: float
+    d_lon: float
+    n_lat: int
+    n_lon: int
+
+    @classmethod
+    def from_griddef(cls, griddef: str) -> 'LatLonGrid':
+        """Parse an RDA griddef like '1440:721:90N:0E:90S:359.75E:0.25:0.25'."""
+        def degrees(value: str) -> float:
+            match = re.fullmatch(r'([\d.]+)([NSEW])', value)
+            if match is None: raise ValueError(f'Coordinate {value} not recognized in griddef {griddef}')
+            return float(match.group(1)) * (-1 if match.group(2) in 'SW' else 1)
+
+        n_lon, n_lat, lat_first, lon_first, lat_last, _, d_lon, d_lat = griddef.split(':')
+        lat_first, lat_last = degrees(lat_first), degrees(lat_last)
+        d_lat = float(d_lat) if lat_last >= lat_first else -float(d_lat)
+        return cls(lat_first, degrees(lon_first) % 360, d_lat, float(d_lon), int(n_lat), int(n_lon))
+
+    @classmethod
+    def from_message(cls, message) -> 'LatLonGrid':
+        d_lat = message['jDirectionIncrementInDegrees']
+        if not message['jScansPositively']: d_lat = -d_lat
+        return cls(message['latitudeOfFirstGridPointInDegrees'], message['longitudeOfFirstGridPointInDegrees'] % 360,
+                   d_lat, message['iDirectionIncrementInDegrees'], message['Nj'], message['Ni'])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.n_lat, self.n_lon
+
+    @property
+    def size(self) -> int:
+        return self.n_lat * self.n_lon
+
+    @property
+    def is_global(self) -> bool:
+        return self.n_lon * self.d_lon >= 360 - 1e-6
+
+    @property
+    def lats(self) -> np.ndarray:
+        return self.lat_first + self.d_lat * np.arange(self.n_lat)
+
+    @property
+    def lons(self) -> np.ndarray:
+        return (self.lon_first + self.d_lon * np.arange(self.n_lon)) % 360
+
+    def cache_key(self) -> str:
+        return '{:.4f}_{:.4f}_{:.4f}_{:.4f}_{}_{}'.format(*self)
+
+    def fractional_indices(self, lats: np.ndarray, lons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Fractional (row, column) of points, columns are relative to lon_first modulo 360."""
+        rows = (np.asarray(lats, dtype=float) - self.lat_first) / self.d_lat
+        columns = ((np.asarray(lons, dtype=float) - self.lon_first) % 360) / self.d_lon
+        return rows, columns
+
+    def bilinear_weights(self, lats: np.ndarray, lons: np.ndarray, eps: float = 1e-9) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Flat indices (n, 4) and weights (n, 4) of the surrounding grid points, and a mask of points inside the grid.
+
+        Interpolated values are (field.reshape(-1)[indices] * weights).sum(axis=-1). Points outside
+        the grid get index 0 and weight 0.
+        """
+        rows, columns = self.fractional_indices(lats, lons)
+        inside = (rows >= -eps) & (rows <= self.n_lat - 1 + eps)
+        if not self.is_global: inside &= columns <= self.n_lon - 1 + eps
+
+        row0 = np.clip(np.floor(rows), 0, max(self.n_lat - 2, 0)).astype(np.int64)
+        t_row = np.clip(rows - row0, 0, 1)
+        if self.is_global:
+            column0 = np.floor(columns).astype(np.int64) % self.n_lon
+            column1 = (column0 + 1) % self.n_lon
+        else:
+            column0 = np.clip(np.floor(columns), 0, max(self.n_lon - 2, 0)).astype(np.int64)
+            column1 = np.minimum(column0 + 1, self.n_lon - 1)
+        t_column = np.clip(columns - np.floor(columns), 0, 1) if self.is_global else np.clip(columns - column0, 0, 1)
+        row1 = np.minimum(row0 + 1, self.n_lat - 1)
+
+        indices = np.stack([row0 * self.n_lon + column0, row0 * self.n_lon + column1,
+                            row1 * self.n_lon + column0, row1 * self.n_lon + column1], axis=-1)
+        weights = np.stack([(1 - t_row) * (1 - t_column), (1 - t_row) * t_column,
+                            t_row * (1 - t_column), t_row * t_column], axis=-1)
+        indices[~inside] = 0
+        weights[~inside] = 0
+        return indices, weights, inside
@@ -0,0 +1,92 @@
+from __future__ import annotations
+from typing import *
+import os
+from datetime import datetime
+import numpy as np
+from src.processing.grib import MessageInfo
+from src.processing.grid import LatLonGrid
+from src.processing.deaccumulate import deaccumulate_dataset
+from src.utils.lazy import lazy_import
+
+xr = lazy_import('xarray')
+
+
+def variable_name(info: MessageInfo) -> str:
+    """e.g. 'U_GRD_HTGL_10_instant'.
+
+    Accumulations from the init (0-N, '..._accum_total') are kept apart from the 3h/6h windows
+    ('..._accum'), both can be requested for the same parameter and step.
+    """
+    step_type = f'{info.step_type}_total' if info.step_type == 'accum' and info.start_step == 0 else info.step_type
+    return '{}_{}_{:g}_{}'.format(info.param, info.level_type, info.level, step_type).replace(' ', '_').replace('.', 'p')
+
+
+class InitDatasetWriter(object):
+    """Collects the fields of one init at a time and writes them as a netCDF file per init.
+
+    Archives are ordered by init, so only one init is held in memory. Variables get the
+    dimensions (step, lat, lon), the start step of each field is kept next to it for windowed
+    (accumulated/averaged) products, or the interval start if they are deaccumulated.
+    """
+
+    def __init__(self, output_dir: str, stem: str, grid: LatLonGrid, attrs: Dict[str, Any] | None = None, deaccumulate: bool = False):
+        self.output_dir = output_dir
+        self.stem = stem
+        self.grid = grid
+        self.attrs = attrs or {}
+        self.deaccumulate = deaccumulate
+        self.init: datetime | None = None
+        self.fields: Dict[str, Dict[int, Tuple[MessageInfo, np.ndarray]]] = {}
+        self.written: Dict[datetime, int] = {}
+        self.paths: List[str] = []
+
+    def add(self, info: MessageInfo, field: np.ndarray) -> None:
+        if info.init != self.init:
+            self.flush()
+            self.init = info.init
+        self.fields.setdefault(variable_name(info), {})[info.end_step] = (info, field)
+
+    def flush(self) -> None:
+        if self.init is None or len(self.fields) == 0: return
+        path = self._path(self.init)
+        dataset = self._to_dataset()
+        if self.deaccumulate: dataset = deaccumulate_dataset(dataset)
+        dataset.to_netcdf(f'{path}.tmp', format='NETCDF4', engine='netcdf4',
+                          encoding={name: {'zlib': True, 'complevel': 1} for name in self.fields})
+        os.replace(f'{path}.tmp', path)
+        self.paths.append(path)
+        self.fields = {}
+
+    def close(self) -> List[str]:
+        self.flush()
+        return self.paths
+
+    def _path(self, init: datetime) -> str:
+        # an init that shows up again after others is written to an extra part instead of overwriting
+        part = self.written.get(init, 0)
+        self.written[init] = part + 1
+        suffix = f'.{part}' if part > 0 else ''
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f'{self.stem}.{init:%Y%m%d%H}{suffix}.nc')
+
+    def _to_dataset(self) -> 'xr.Dataset':
+        steps = sorted({step for fields in self.fields.values() for step in fields})
+        step_index = {step: idx for idx, step in enumerate(steps)}
+        data_vars = {}
+        for name, fields in self.fields.items():
+            values = np.full((len(steps),) + self.grid.shape, np.nan, dtype=np.float32)
+            start_steps = np.full(len(steps), -1, dtype=np.int16)
+            for step, (info, field) in fields.items():
+                values[step_index[step]] = field
+                start_steps[step_index[step]] = info.start_step
+            info = next(iter(fields.values()))[0]
+            attrs = {'param': info.param, 'level_type': info.level_type, 'level': info.level, 'step_type': info.step_type}
+            data_vars[name] = (('step', 'lat', 'lon'), values, attrs)
+            if info.step_type != 'instant': data_vars[f'{name}_start_step'] = (('step',), start_steps)
+
+        lons = self.grid.lons
+        # area subsets crossing the prime meridian stay monotonic in -180..180
+        if not self.grid.is_global: lons = np.where(lons > 180, lons - 360, lons)
+        coords = {'step': np.array(steps, dtype=np.int16), 'lat': self.grid.lats, 'lon': lons}
+        return xr.Dataset(data_vars, coords, attrs={'init': self.init.isoformat(), **self.attrs})
+
@@ -0,0 +1,27 @@
+from typing import *
+import time
+from src.utils.logger import log_handler
+from src.utils.profiling import profiler
+
+
+def _timed_call(args: Tuple[Callable, tuple]) -> Tuple[Any, float]:
+    func, func_args = args
+    start = time.monotonic()
+    try:
+        with profiler.stage(func.__name__): return func(*func_args), time.monotonic() - start
+    finally:
+        # pool workers exit without running atexit
+        log_handler.flush()
+
+def map_files(func: Callable, tasks: List[tuple], n_workers: int = 1) -> Iterator[Tuple[Any, float]]:
+    """Yield (func(*task), seconds) per task in order, on a process pool if n_workers > 1.
+
+    func has to be a module level function so it can be pickled.
+    """
+    if n_workers <= 1:
+        for task in tasks: yield _timed_call((func, task))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        yield from executor.map(_timed_call, [(func, task) for task in tasks])
@@ -0,0 +1,105 @@
+from __future__ import annotations
+from typing import *
+import os
+import hashlib
+from datetime import datetime
+import numpy as np
+from src.processing.grib import iter_messages, iter_field_batches, select_fields, select_times
+from src.processing.grid import LatLonGrid
+from src.processing.output import InitDatasetWriter
+from src.processing.parallel import map_files
+from src.processing.tarindex import select_members
+from src.utils.lazy import lazy_import
+from src.utils.logger import scope_logger
+
+sparse = lazy_import('scipy.sparse')
+
+
+def weights_path(cache_dir: str, source: LatLonGrid, target: LatLonGrid) -> str:
+    key = hashlib.sha1(f'bilinear:{source.cache_key()}:{target.cache_key()}'.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'bilinear_{key}.npz')
+
+def build_weights(source: LatLonGrid, target: LatLonGrid) -> 'sparse.csr_matrix':
+    """(target.size, source.size) matrix of bilinear weights, target points outside the source grid get an empty row."""
+    lats, lons = np.meshgrid(target.lats, target.lons, indexing='ij')
+    indices, weights, _ = source.bilinear_weights(lats.reshape(-1), lons.reshape(-1))
+    rows = np.repeat(np.arange(target.size), indices.shape[1])
+    matrix = sparse.csr_matrix((weights.reshape(-1), (rows, indices.reshape(-1))), shape=(target.size, source.size))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+class Regridder(object):
+    """Applies a precomputed sparse weight matrix to batches of fields in one product."""
+
+    def __init__(self, source: LatLonGrid, target: LatLonGrid, weights: 'sparse.csr_matrix'):
+        self.source = source
+        self.target = target
+        self.weights = weights
+        # rows without weights are outside the source grid
+        self.outside = np.diff(weights.indptr) == 0
+
+    @classmethod
+    def load(cls, source: LatLonGrid, target: LatLonGrid, cache_dir: str | None = None) -> 'Regridder':
+        """Weights from the cache directory, built and saved there if missing."""
+        if cache_dir is None: return cls(source, target, build_weights(source, target))
+
+        path = weights_path(cache_dir, source, target)
+        if os.path.exists(path): return cls(source, target, sparse.load_npz(path).tocsr())
+
+        scope_logger.info('Building regridding weights %s -> %s', source, target)
+        weights = build_weights(source, target)
+        os.makedirs(cache_dir, exist_ok=True)
+        # workers may build the same weights at the same time, the rename keeps the file whole
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        sparse.save_npz(tmp_path, weights)
+        os.replace(tmp_path, path)
+        return cls(source, target, weights)
+
+    def regrid(self, fields: np.ndarray) -> np.ndarray:
+        """(n_fields, *source.shape) -> (n_fields, *target.shape)."""
+        flat = fields.reshape(fields.shape[0], -1)
+        values = (self.weights @ flat.T).T
+        values[:, self.outside] = np.nan
+        return values.reshape((fields.shape[0],) + self.target.shape)
+
+
+# cached per process, next to the weights on disk
+_regridders: Dict[Tuple[LatLonGrid, LatLonGrid], Regridder] = {}
+
+def get_regridder(source: LatLonGrid, target: LatLonGrid, cache_dir: str | None) -> Regridder:
+    if (source, target) not in _regridders: _regridders[(source, target)] = Regridder.load(source, target, cache_dir)
+    return _regridders[(source, target)]
+
+def regrid_file(path: str, target: LatLonGrid, output_dir: str, cache_dir: str | None = None, parameters: List[str] | None = None,
+                levels: Dict[str, List[float]] | None = None, deaccumulate: bool = False, init_range: Tuple[datetime, datetime] | None = None,
+                steps: List[int] | None = None, batch_size: int = 32) -> List[str]:
+    """Regrid all selected messages of a .grib2/.tar file to target, written as one netCDF file per init.
+
+    Of a .tar file only the members of init_range and steps are read, found through its index.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    writer = InitDatasetWriter(output_dir, stem, target, {'source': os.path.basename(path), 'griddef': target.cache_key()}, deaccumulate)
+    members = select_members(path, init_range, steps)
+    for grid, infos, fields in iter_field_batches(path, select_times(select_fields(parameters, levels), init_range, steps), batch_size, members):
+        for info, field in zip(infos, get_regridder(grid, target, cache_dir).regrid(fields)): writer.add(info, field)
+    return writer.close()
+
+def source_grid(path: str) -> LatLonGrid | None:
+    for _, message in iter_messages(path):
+        return LatLonGrid.from_message(message)
+    return None
+
+def regrid_files(paths: List[str], target: LatLonGrid, output_dir: str, cache_dir: str | None = None, parameters: List[str] | None = None,
+                 levels: Dict[str, List[float]] | None = None, deaccumulate: bool = False, n_workers: int = 1,
+                 init_range: Tuple[datetime, datetime] | None = None, steps: List[int] | None = None) -> List[str]:
+    # build the weights once up front instead of in every worker
+    grid = source_grid(paths[0]) if len(paths) > 0 else None
+    if grid is not None and cache_dir is not None: Regridder.load(grid, target, cache_dir)
+
+    output_paths = []
+    tasks = [(path, target, output_dir, cache_dir, parameters, levels, deaccumulate, init_range, steps) for path in paths]
+    for idx, (file_output_paths, elapsed) in enumerate(map_files(regrid_file, tasks, n_workers)):
+        scope_logger.info('[%s/%s] %s: %s inits in %.1f s', idx + 1, len(paths), paths[idx], len(file_output_paths), elapsed)
+        output_paths.extend(file_output_paths)
+    return output_paths
@@ -0,0 +1,162 @@
+from __future__ import annotations
+from typing import *
+import os
+import csv
+import json
+from datetime import datetime
+import numpy as np
+from src.processing.grib import MessageInfo, iter_field_batches, select_fields, select_times
+from src.processing.grid import LatLonGrid
+from src.processing.deaccumulate import deaccumulate_columns
+from src.processing.derived import DerivedFields, derived_variables, with_inputs
+from src.utils.lazy import lazy_import
+from src.processing.parallel import map_files
+from src.processing.tarindex import select_members
+from src.utils.logger import scope_logger
+
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+
+
+class Site(NamedTuple):
+    name: str
+    lat: float
+    lon: float
+    hub_height: float | None = None
+
+
+def read_sites(path: str) -> List[Site]:
+    """Read a CSV with the columns name, lat, lon and optionally hub_height (m)."""
+    sites = []
+    with open(path, 'r', newline='') as file:
+        for row in csv.DictReader(file):
+            hub_height = row.get('hub_height', '').strip() if row.get('hub_height') is not None else ''
+            sites.append(Site(row['name'].strip(), float(row['lat']), float(row['lon']), float(hub_height) if hub_height else None))
+    if len({site.name for site in sites}) != len(sites): raise ValueError(f'Site names in {path} are not unique')
+    return sites
+
+
+class SiteExtractor(object):
+    """Bilinear interpolation of fields to a fixed set of sites, the weights are computed once per grid."""
+
+    def __init__(self, sites: List[Site], grid: LatLonGrid):
+        self.sites = sites
+        self.grid = grid
+        lats = np.array([site.lat for site in sites])
+        lons = np.array([site.lon for site in sites])
+        self.indices, self.weights, self.inside = grid.bilinear_weights(lats, lons)
+        outside = [site.name for site, inside in zip(sites, self.inside) if not inside]
+        if outside: scope_logger.warning('%s sites are outside the grid %s and get no values: %s', len(outside), grid, outside[:10])
+
+    def extract(self, fields: np.ndarray) -> np.ndarray:
+        """(n_fields, n_lat, n_lon) -> (n_fields, n_sites)."""
+        flat = fields.reshape(fields.shape[0], -1)
+        values = np.einsum('fsk,sk->fs', flat[:, self.indices], self.weights)
+        values[:, ~self.inside] = np.nan
+        return values
+
+
+# extractors are cached per process, all files of an archive normally share the grid
+_extractors: Dict[Tuple[Tuple[Site, ...], LatLonGrid], SiteExtractor] = {}
+
+def get_extractor(sites: List[Site], grid: LatLonGrid) -> SiteExtractor:
+    key = (tuple(sites), grid)
+    if key not in _extractors: _extractors[key] = SiteExtractor(sites, grid)
+    return _extractors[key]
+
+def to_columns(sites: List[Site], infos: List[MessageInfo], values: np.ndarray) -> Dict[str, np.ndarray]:
+    """Long format columns for values of shape (len(infos), len(sites))."""
+    n_sites = len(sites)
+    column = lambda items, dtype=None: np.repeat(np.array(items, dtype=dtype), n_sites)
+    return {
+        'site': np.tile(np.array([site.name for site in sites], dtype=object), len(infos)),
+        'init': column([info.init for info in infos], 'datetime64[s]'),
+        'valid_time': column([info.valid_time for info in infos], 'datetime64[s]'),
+        'start_step': column([info.start_step for info in infos], np.int16),
+        'end_step': column([info.end_step for info in infos], np.int16),
+        'param': column([info.param for info in infos], object),
+        'level_type': column([info.level_type for info in infos], object),
+        'level': column([info.level for info in infos], np.float32),
+        'step_type': column([info.step_type for info in infos], object),
+        'value': values.astype(np.float32).reshape(-1),
+    }
+
+def concat_columns(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    if len(parts) == 0: return {}
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+def hub_height_columns(sites: List[Site], columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Derived columns with the level of the hub height wind set per site, sites without a hub height are dropped."""
+    hub_heights = np.array([site.hub_height if site.hub_height is not None else np.nan for site in sites], dtype=np.float32)
+    per_site = np.isnan(columns['level'])
+    levels = np.where(per_site, np.tile(hub_heights, len(columns['level']) // len(sites)), columns['level'])
+    keep = ~np.isnan(levels)
+    return {name: (levels if name == 'level' else values)[keep] for name, values in columns.items()}
+
+def extract_file(path: str, sites: List[Site], parameters: List[str] | None = None, levels: Dict[str, List[float]] | None = None,
+                 deaccumulate: bool = False, derive: bool = False, init_range: Tuple[datetime, datetime] | None = None,
+                 steps: List[int] | None = None, batch_size: int = 32) -> Dict[str, np.ndarray]:
+    """Site time series of all selected messages in a .grib2/.tar file, as long format columns.
+
+    All steps of an init are in the same file, so windowed products can be deaccumulated per file.
+    Derived variables are computed from the values at the sites, the hub height wind at each site's hub height.
+    Of a .tar file only the members of init_range and steps are read, found through its index.
+    """
+    select = select_fields(parameters, levels)
+    variables = derived_variables(site_hub_heights=True) if derive else []
+    derived = DerivedFields(variables, heights=np.array([site.hub_height if site.hub_height is not None else np.nan for site in sites]))
+    members = select_members(path, init_range, steps)
+    parts = []
+    for grid, infos, fields in iter_field_batches(path, select_times(with_inputs(select, variables), init_range, steps), batch_size, members):
+        values = get_extractor(sites, grid).extract(fields)
+        selected = np.array([select(info) for info in infos])
+        if selected.any(): parts.append(to_columns(sites, [info for info in infos if select(info)], values[selected]))
+        for info, site_values in zip(infos, values):
+            for derived_info, derived_values in derived.add(info, site_values):
+                parts.append(hub_height_columns(sites, to_columns(sites, [derived_info], derived_values[None])))
+    columns = concat_columns(parts)
+    return deaccumulate_columns(columns) if deaccumulate else columns
+
+def parquet_schema(sites: List[Site]) -> 'pa.Schema':
+    fields = [
+        pa.field('site', pa.dictionary(pa.int32(), pa.string())),
+        pa.field('init', pa.timestamp('s', tz='UTC')),
+        pa.field('valid_time', pa.timestamp('s', tz='UTC')),
+        pa.field('start_step', pa.int16()),
+        pa.field('end_step', pa.int16()),
+        pa.field('param', pa.dictionary(pa.int32(), pa.string())),
+        pa.field('level_type', pa.dictionary(pa.int32(), pa.string())),
+        pa.field('level', pa.float32()),
+        pa.field('step_type', pa.dictionary(pa.int32(), pa.string())),
+        pa.field('value', pa.float32()),
+    ]
+    # site coordinates and hub heights travel with the file
+    metadata = {'sites': json.dumps([site._asdict() for site in sites])}
+    return pa.schema(fields, metadata=metadata)
+
+def columns_to_table(columns: Dict[str, np.ndarray], schema: 'pa.Schema') -> 'pa.Table':
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pa.array(values).cast(field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def extract_sites(paths: List[str], sites: List[Site], output_path: str, parameters: List[str] | None = None,
+                  levels: Dict[str, List[float]] | None = None, deaccumulate: bool = False, derive: bool = False, n_workers: int = 1,
+                  init_range: Tuple[datetime, datetime] | None = None, steps: List[int] | None = None) -> int:
+    """Extract the sites from every file in parallel and write one Parquet file, returns the number of rows."""
+    schema = parquet_schema(sites)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tasks = [(path, sites, parameters, levels, deaccumulate, derive, init_range, steps) for path in paths]
+    n_rows = 0
+    with pq.ParquetWriter(output_path, schema, compression='zstd') as writer:
+        for idx, (columns, elapsed) in enumerate(map_files(extract_file, tasks, n_workers)):
+            n_file_rows = len(columns.get('value', ()))
+            scope_logger.info('[%s/%s] %s: %s values in %.1f s', idx + 1, len(paths), paths[idx], n_file_rows, elapsed)
+            if n_file_rows == 0: continue
+            writer.write_table(columns_to_table(columns, schema))
+            n_rows += n_file_rows
+    return n_rows
@@ -0,0 +1,125 @@
+from __future__ import annotations
+from typing import *
+import os
+import re
+import json
+import tarfile
+from datetime import datetime
+from src.utils.logger import scope_logger
+
+INDEX_SUFFIX = '.idx.json'
+INDEX_VERSION = 1
+
+# e.g. gfs.0p25.2024010106.f012.grib2
+MEMBER_NAME = re.compile(r'\.(\d{10})\.f(\d{3})\.')
+
+
+class TarMember(NamedTuple):
+    name: str
+    # offset of the member data in the tar file, past its header
+    offset: int
+    size: int
+    init: datetime | None
+    step: int | None
+
+
+def parse_member_name(name: str) -> Tuple[datetime | None, int | None]:
+    """(init, forecast step) from an RDA member name, (None, None) if it doesn't follow the naming."""
+    match = MEMBER_NAME.search(os.path.basename(name))
+    if match is None: return None, None
+    return datetime.strptime(match.group(1), '%Y%m%d%H'), int(match.group(2))
+
+def index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+def scan_members(path: str) -> List[TarMember]:
+    """Members of a tar file in archive order, a single pass over the headers."""
+    members = []
+    with tarfile.open(path, 'r:') as tar:
+        for member in tar:
+            if not member.isfile(): continue
+            members.append(TarMember(member.name, member.offset_data, member.size, *parse_member_name(member.name)))
+    return members
+
+def _stat_key(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def build_index(path: str) -> List[TarMember]:
+    """Scan a tar file and write the index next to it."""
+    members = scan_members(path)
+    content = {
+        'version': INDEX_VERSION,
+        **_stat_key(path),
+        'members': [[member.name, member.offset, member.size, member.init.isoformat() if member.init else None, member.step]
+                    for member in members],
+    }
+    tmp_path = f'{index_path(path)}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as file: json.dump(content, file, separators=(',', ':'))
+        os.replace(tmp_path, index_path(path))
+    except OSError as e:
+        # read only archives are still indexed in memory
+        scope_logger.warning('Could not write tar index for %s: %s', path, e)
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    return members
+
+def read_index(path: str) -> List[TarMember] | None:
+    """Members from the index next to a tar file, None if there is none or the tar changed since."""
+    try:
+        with open(index_path(path), 'r') as file: content = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if content.get('version') != INDEX_VERSION or {key: content.get(key) for key in ('size', 'mtime_ns')} != _stat_key(path): return None
+    return [TarMember(name, offset, size, datetime.fromisoformat(init) if init else None, step)
+            for name, offset, size, init, step in content['members']]
+
+def load_index(path: str) -> List[TarMember]:
+    members = read_index(path)
+    return members if members is not None else build_index(path)
+
+
+class TarIndex(object):
+    """Member lookup of a tar file by name or by (init, step), built once and kept as a sidecar file."""
+
+    def __init__(self, path: str, members: List[TarMember] | None = None):
+        self.path = path
+        self.members = members if members is not None else load_index(path)
+        self.by_name = {member.name: member for member in self.members}
+        self.by_step = {(member.init, member.step): member for member in self.members if member.init is not None}
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __getitem__(self, name: str) -> TarMember:
+        return self.by_name[name]
+
+    def find(self, init: datetime, step: int) -> TarMember | None:
+        return self.by_step.get((init, step))
+
+    def select(self, inits: Iterable[datetime] | None = None, steps: Iterable[int] | None = None) -> List[TarMember]:
+        """Members of the given inits and steps in archive order, None matches all."""
+        inits = set(inits) if inits is not None else None
+        steps = set(steps) if steps is not None else None
+        return [member for member in self.members
+                if (inits is None or member.init in inits) and (steps is None or member.step in steps)]
+
+    def read(self, member: TarMember | str) -> bytes:
+        """Data of a single member, one seek and read."""
+        member = self.by_name[member] if isinstance(member, str) else member
+        with open(self.path, 'rb') as file:
+            file.seek(member.offset)
+            return file.read(member.size)
+
+
+def select_members(path: str, init_range: Tuple[datetime, datetime] | None = None, steps: Collection[int] | None = None) -> List[TarMember] | None:
+    """Members of a .tar file with an init in init_range (inclusive) and one of steps, from its index.
+
+    None means the whole file has to be read: it isn't a tar, nothing is filtered, or a member
+    name doesn't tell its init and step.
+    """
+    if not path.endswith('.tar') or init_range is None and steps is None: return None
+    index = TarIndex(path)
+    if any(member.init is None for member in index.members): return None
+    inits = [init for init in set(member.init for member in index.members) if init_range[0] <= init <= init_range[1]] if init_range is not None else None
+    return index.select(inits, steps)
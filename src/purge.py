@@ -0,0 +1,75 @@
+from typing import *
+import time
+import queue
+import threading
+import traceback
+from src.utils.logger import scope_logger
+
+
+PURGED_STATUSES = ('set for purge', 'purged')
+
+
+class PurgeStage(object):
+    """Purges requests on background threads, decoupled from the download threads.
+
+    A purge is only considered done once get_status no longer reports the request as
+    active, then on_purged is called so the scheduler can reuse the slot right away.
+    """
+
+    def __init__(self, purge: Callable[[str], Dict[str, Any] | None], get_status: Callable[[str], Dict[str, Any] | None],
+                 on_purged: Callable[[int], None], n_workers: int = 2, max_attempts: int = 5, confirm_delay: float = 5):
+        self.purge = purge
+        self.get_status = get_status
+        self.on_purged = on_purged
+        self.max_attempts = max_attempts
+        self.confirm_delay = confirm_delay
+        self._queue: queue.Queue = queue.Queue()
+        for idx in range(n_workers):
+            threading.Thread(target=self._worker, name=f'purge-{idx}', daemon=True).start()
+
+    def submit(self, request_id: int) -> None:
+        self._queue.put(int(request_id))
+
+    def join(self) -> None:
+        self._queue.join()
+
+    def is_purged(self, request_id: int) -> bool | None:
+        """True if purged, False if still active, None if the status could not be checked."""
+        response = self.get_status(str(request_id))
+        if response is None: return None
+        # an unknown request index is reported as an error, i.e. the request is gone
+        if response.get('status') == 'error': return True
+        data = response.get('data') or {}
+        if isinstance(data, list): data = data[0] if data else {}
+        return data.get('status', '').lower() in PURGED_STATUSES
+
+    def _purge(self, request_id: int) -> bool:
+        for attempt in range(self.max_attempts):
+            response = self.purge(str(request_id))
+            if response is None:
+                scope_logger.error('Could not purge request %s', request_id)
+                continue
+
+            time.sleep(self.confirm_delay * attempt)
+            if self.is_purged(request_id):
+                return True
+            scope_logger.info('Purge of request %s is not confirmed yet, trying again', request_id)
+
+        return False
+
+    def _worker(self) -> None:
+        while True:
+            request_id = self._queue.get()
+            with scope_logger.create_loggerscope(f'request_id={request_id}'):
+                try:
+                    scope_logger.info('Purging request %s', request_id)
+                    if self._purge(request_id):
+                        scope_logger.info('Purge of request %s confirmed', request_id)
+                        self.on_purged(request_id)
+                    else:
+                        scope_logger.error('Could not confirm purge of request %s, giving up', request_id)
+                except Exception:
+                    scope_logger.error('Exception in purge worker')
+                    traceback.print_exc()
+                finally:
+                    self._queue.task_done()
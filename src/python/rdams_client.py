@@ -20,14 +20,23 @@ __author__ = 'Doug Schuster (schuster@ucar.edu), Riley Conroy (rpconroy@ucar.edu
 
 import sys
 import os
-import requests
 import getpass
 import json
 import argparse
 import codecs
-import pdb
+import time
+import errno
 from pathlib import Path
 from src.utils.logger import scope_logger
+from src.utils.lazy import lazy_import
+from src.utils import metrics
+from src.utils.diskio import StreamWriter
+from src.utils.jsonstream import iter_array
+from src.utils.profiling import profiler
+from src.settings import DOWNLOAD_BUFFER_SIZE, DOWNLOAD_FSYNC_BYTES, DOWNLOAD_RETRIES
+
+# only imported once a request is made, keeps startup fast for short commands
+requests = lazy_import('requests')
 
 
 BASE_URL = 'https://rda.ucar.edu/api/'
@@ -220,48 +229,105 @@ def check_status(ret, token_file=DEFAULT_AUTH_FILE):
         print(ret.content)
         exit(1)
 
-def check_file_status(filepath, filesize):
+def check_file_status(filepath, filesize, size=None):
     """Prints file download status as percent of file complete.
 
     Args:
         filepath (str): File being downloaded.
         filesize (int): Expected total size of file in bytes.
+        size (int, Optional): Bytes written so far, defaults to the size on disk.
 
     Returns:
         None
     """
     sys.stdout.write('\r')
     sys.stdout.flush()
-    size = int(os.stat(filepath).st_size)
+    if size is None:
+        size = int(os.stat(filepath).st_size)
     percent_complete = (size/filesize)*100
     sys.stdout.write('%.3f %s' % (percent_complete, '% Completed'))
     sys.stdout.flush()
 
-def download_files(filelist, out_dir: Path, cookie_file=None):
+@profiler.profiled()
+def download_files(filelist, out_dir: Path, cookie_file=None, throttle=None, dedup=None, retries=DOWNLOAD_RETRIES):
     """Download files in a list.
 
     Args:
         filelist (list): List of web files to download.
         out_dir (Path): directory to put downloaded files
+        throttle (callable, Optional): Called with the size of each chunk, may block to limit bandwidth.
+        dedup (Deduplicator, Optional): Content store that known files are linked from instead of downloaded,
+            and that downloaded files are added to.
+        retries (int, Optional): Times a failed or incomplete file is downloaded again, with backoff, before giving up.
 
     Returns:
-        None
+        list: Paths of the downloaded files, each verified against its Content-Length.
+    """
+    out_files = []
+    writer = StreamWriter(DOWNLOAD_BUFFER_SIZE, DOWNLOAD_FSYNC_BYTES)
+    for _file in filelist:
+        out_file = str(out_dir / os.path.basename(_file))
+        for attempt in range(retries + 1):
+            try:
+                download_file(_file, out_file, writer, throttle, dedup)
+                break
+            # a broken connection while streaming the body surfaces as urllib3's error, not requests'
+            except (requests.RequestException, requests.packages.urllib3.exceptions.HTTPError, OSError) as error:
+                # a full disk doesn't get better by downloading again
+                if attempt == retries or getattr(error, 'errno', None) == errno.ENOSPC: raise
+                delay = min(2 ** attempt, 60)
+                scope_logger.warning('Could not download %s (%s), trying again in %s s', _file, error, delay)
+                time.sleep(delay)
+        out_files.append(out_file)
+    return out_files
+
+def download_file(_file, out_file, writer, throttle=None, dedup=None):
+    """Download one file of download_files, raises if it fails or is incomplete."""
+    scope_logger.info(f'Downloading {out_file}')
+    header = requests.head(_file, allow_redirects=True, stream=True)
+    header.raise_for_status()
+    filesize = int(header.headers['Content-Length'])
+    if dedup is not None and dedup.link(_file, filesize, out_file): return
+    req = requests.get(_file, allow_redirects=True, stream=True)
+    try:
+        req.raise_for_status()
+        # the bytes as sent, Content-Length counts them before any Content-Encoding is undone
+        req.raw.decode_content = False
+
+        def on_chunk(n_bytes, written):
+            metrics.download_bytes.inc(n_bytes)
+            check_file_status(out_file, filesize, written)
+            if throttle is not None: throttle(n_bytes)
+
+        start = time.monotonic()
+        # written to a temporary name and renamed once complete, a short read raises
+        writer.write(req.raw, out_file, filesize, on_chunk)
+    finally:
+        req.close()
+    print()
+    elapsed = time.monotonic() - start
+    metrics.downloaded_files.inc()
+    if elapsed > 0: metrics.download_throughput.observe(filesize / elapsed)
+    if dedup is not None: dedup.add(_file, out_file)
+
+def get_filelist_size(filelist):
+    """Total size of the unique files in a filelist.
+
+    Args:
+        filelist (list): 'web_files' of a get_filelist response.
+
+    Returns:
+        int: Size in bytes, from the listed size or else the Content-Length of a HEAD request.
     """
+    sizes = {}
     for _file in filelist:
-        file_base = os.path.basename(_file)
-        out_file = str(out_dir / file_base)
-        scope_logger.info(f'Downloading {out_file}')
-        header = requests.head(_file, allow_redirects=True, stream=True)
-        filesize = int(header.headers['Content-Length'])
-        req = requests.get(_file, allow_redirects=True, stream=True)
-        with open(out_file, 'wb') as outfile:
-            chunk_size=1048576
-            for chunk in req.iter_content(chunk_size=chunk_size):
-                outfile.write(chunk)
-                if chunk_size < filesize:
-                    check_file_status(out_file, filesize)
-        check_file_status(out_file, filesize)
-        print()
+        web_path = _file['web_path']
+        if web_path in sizes: continue
+        size = _file.get('size')
+        if size is None:
+            size = requests.head(web_path, allow_redirects=True).headers['Content-Length']
+        sizes[web_path] = int(size)
+    return sum(sizes.values())
 
 def encode_url(url, token):
     return url + '?token=' + token
@@ -299,11 +365,12 @@ def get_summary(ds):
     check_status(ret)
     return ret
 
-def get_metadata(ds):
+def get_metadata(ds, stream=False):
     """Return metadata of dataset.
 
     Args:
         ds (str): Datset id. e.g. 'ds083.2'
+        stream (bool): Don't read the body yet, see iter_metadata.
 
     Returns:
         dict: JSON decoded result of the query.
@@ -312,11 +379,44 @@ def get_metadata(ds):
     url += ds
 
     token = get_authentication()
-    ret = requests.get(encode_url(url,token))
+    ret = requests.get(encode_url(url,token), stream=stream)
 
     check_status(ret)
     return ret
 
+def iter_records(response, fields=None, chunk_size=1 << 16):
+    """Parse the records of a streamed metadata or parameter summary response one at a time.
+
+    Args:
+        response (requests.Response): Response requested with stream=True.
+        fields (list): Only keep these fields of each record, e.g. ['param', 'product'].
+        chunk_size (int): Bytes read from the connection at a time.
+
+    Returns:
+        iterator: Records under data/data, in the order they arrive.
+    """
+    try:
+        yield from iter_array(response.iter_content(chunk_size), ('data', 'data'), fields)
+    finally:
+        response.close()
+
+def iter_metadata(ds, fields=None, chunk_size=1 << 16):
+    """Yield metadata records of a dataset while the response is downloaded.
+
+    Peak memory is one record plus a chunk instead of the whole document.
+
+    Args:
+        ds (str): Datset id. e.g. 'ds083.2'
+        fields (list): Only keep these fields of each record, e.g. ['param', 'product', 'levels'].
+        chunk_size (int): Bytes read from the connection at a time.
+
+    Returns:
+        iterator: Metadata records.
+    """
+    ret = get_metadata(ds, stream=True)
+    ret.raise_for_status()
+    return iter_records(ret, fields, chunk_size)
+
 def get_all_params(ds):
     """Return set of parameters for a dataset.
 
@@ -326,19 +426,15 @@ def get_all_params(ds):
     Returns:
         set: All unique params in dataset.
     """
-    res = get_param_summary(ds)
-    res_data = res['data']['data']
-    param_names = set()
-    for param in res_data:
-        param_names.add(param['param'])
-    return param_names
+    return set(record['param'] for record in iter_param_summary(ds, ['param']))
 
 
-def get_param_summary(ds):
+def get_param_summary(ds, stream=False):
     """Return summary of parameters for a dataset.
 
     Args:
         ds (str): Datset id. e.g. 'ds083.2'
+        stream (bool): Don't read the body yet, see iter_param_summary.
 
     Returns:
         dict: JSON decoded result of the query.
@@ -347,11 +443,26 @@ def get_param_summary(ds):
     url += ds
 
     token = get_authentication()
-    ret = requests.get(encode_url(url,token))
+    ret = requests.get(encode_url(url,token), stream=stream)
 
     check_status(ret)
     return ret
 
+def iter_param_summary(ds, fields=None, chunk_size=1 << 16):
+    """Yield the parameter summary records of a dataset while the response is downloaded.
+
+    Args:
+        ds (str): Datset id. e.g. 'ds083.2'
+        fields (list): Only keep these fields of each record.
+        chunk_size (int): Bytes read from the connection at a time.
+
+    Returns:
+        iterator: Parameter summary records.
+    """
+    ret = get_param_summary(ds, stream=True)
+    ret.raise_for_status()
+    return iter_records(ret, fields, chunk_size)
+
 
 def submit_json(json_file):
     """Submit a RDA subset or format conversion request using json file or dict.
@@ -436,11 +547,13 @@ def get_filelist(request_idx):
     return ret
 
 
-def download(request_idx, target_dir: Path):
+def download(request_idx, target_dir: Path, throttle=None, dedup=None):
     """Download files given request Index
 
     Args:
         request_idx (str): Request Index, typically a 6-digit integer.
+        throttle (callable, Optional): Bandwidth limit, see download_files.
+        dedup (Deduplicator, Optional): Content store, see download_files.
 
     Returns:
         None
@@ -457,7 +570,7 @@ def download(request_idx, target_dir: Path):
     web_files = list(map(lambda x: x['web_path'], filelist))
 
     # Only download unique files.
-    download_files(set(web_files), out_dir=target_dir)
+    download_files(set(web_files), out_dir=target_dir, throttle=throttle, dedup=dedup)
     return ret
 
 def globus_download(request_idx):
@@ -0,0 +1,368 @@
+from __future__ import annotations
+from typing import *
+import heapq
+import json
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, field
+from pathlib import Path
+from src.utils.logger import scope_logger
+
+
+@dataclass
+class ConfigJob:
+    name: str
+    request_dict: Dict[str, str]
+    # a list of (from_dt, to_dt) is put in a backlog with the default order
+    time_intervals: Backlog | List[Tuple[Any, Any]]
+    target_dir: Path
+    priority: int = 0
+    weight: float = 1.0
+    request_ids: Set[int] = field(default_factory=set)
+    n_pending: int = 0
+    n_submitted: int = 0
+
+    def __post_init__(self):
+        if not isinstance(self.time_intervals, Backlog): self.time_intervals = Backlog(self.time_intervals)
+
+
+class WorkItem(NamedTuple):
+    """A time interval of a job, with the request dict fields it overrides once a failed request was split."""
+    from_dt: Any
+    to_dt: Any
+    # e.g. (('product', '3-hour Forecast/6-hour Forecast'),)
+    overrides: Tuple[Tuple[str, str], ...] = ()
+    depth: int = 0
+
+def as_work_item(interval: Tuple[Any, ...]) -> WorkItem:
+    return interval if isinstance(interval, WorkItem) else WorkItem(*interval)
+
+# GFS init cycles, intervals include the cycle at to_dt
+CYCLE = timedelta(hours=6)
+
+def split_work_item(item: WorkItem, request_dict: Dict[str, str]) -> List[WorkItem]:
+    """Halves of a failed work item: its init cycles, or for a single cycle its products and then its parameters."""
+    # pendulum periods don't support floor division by a timedelta
+    n_cycles = int((item.to_dt - item.from_dt).total_seconds() // CYCLE.total_seconds()) + 1
+    if n_cycles > 1:
+        middle = item.from_dt + (n_cycles // 2) * CYCLE
+        return [WorkItem(item.from_dt, middle - CYCLE, item.overrides, item.depth + 1), WorkItem(middle, item.to_dt, item.overrides, item.depth + 1)]
+
+    fields = {**request_dict, **dict(item.overrides)}
+    for key in ('product', 'param'):
+        values = fields.get(key, '').split('/')
+        if len(values) < 2: continue
+        halves = (values[:len(values) // 2], values[len(values) // 2:])
+        return [WorkItem(item.from_dt, item.to_dt, tuple({**dict(item.overrides), key: '/'.join(half)}.items()), item.depth + 1) for half in halves]
+    return []
+
+
+ORDERS = ('recent', 'oldest', 'gaps')
+# bisected pieces of a failed work item are submitted before the rest of their job
+RETRY_RANK = -1
+
+def time_value(value: Any) -> float:
+    return value.timestamp() if hasattr(value, 'timestamp') else float(value)
+
+def bit_reversed(value: int, n_bits: int) -> int:
+    return int(format(value, f'0{n_bits}b')[::-1], 2) if n_bits > 0 else 0
+
+
+class Backlog(object):
+    """Work items of a job waiting to be submitted, in a heap ordered by rank, deadline and order.
+
+    Lower ranks come first, then the earliest deadline (items without one last), then the
+    order of the backlog: 'recent' is newest first, 'oldest' oldest first, and 'gaps' spreads
+    the submissions over the date range (first, middle, quarters, ...), so the data that has
+    arrived so far covers the whole range evenly. reprioritise re-keys all items in O(n),
+    which is cheap enough to do while the service is running. Not thread safe, the
+    scheduler holds its lock.
+    """
+
+    def __init__(self, items: Iterable[Tuple[Any, ...]] = (), order: str = 'recent'):
+        if order not in ORDERS: raise ValueError(f'Backlog order {order} not recognized, expected one of {ORDERS}')
+        self.order = order
+        # (rank, deadline, order key, sequence number, item)
+        self._heap: List[Tuple[int, float, float, int, WorkItem]] = []
+        self._sequence = itertools.count()
+        self.extend(items)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __iter__(self) -> Iterator[WorkItem]:
+        """Items in the order they would be popped."""
+        return (entry[-1] for entry in sorted(self._heap))
+
+    def _order_key(self, item: WorkItem) -> float:
+        if self.order == 'recent': return -time_value(item.from_dt)
+        if self.order == 'oldest': return time_value(item.from_dt)
+        # set for all items by _rebuild
+        return 0.0
+
+    def _entry(self, item: Tuple[Any, ...], rank: int, deadline: Any | None) -> Tuple[int, float, float, int, WorkItem]:
+        item = as_work_item(item)
+        return (rank, time_value(deadline) if deadline is not None else float('inf'), self._order_key(item), next(self._sequence), item)
+
+    def push(self, item: Tuple[Any, ...], rank: int = 0, deadline: Any | None = None) -> None:
+        heapq.heappush(self._heap, self._entry(item, rank, deadline))
+        if self.order == 'gaps': self._rebuild()
+
+    def extend(self, items: Iterable[Tuple[Any, ...]], rank: int = 0, deadline: Any | None = None) -> None:
+        self._heap.extend(self._entry(item, rank, deadline) for item in items)
+        self._rebuild()
+
+    def pop(self) -> WorkItem:
+        return heapq.heappop(self._heap)[-1]
+
+    def peek(self) -> WorkItem | None:
+        return self._heap[0][-1] if self._heap else None
+
+    def reprioritise(self, order: str | None = None, rank: Callable[[WorkItem], int | None] | None = None) -> None:
+        """Change the order, and the rank of the items for which rank returns a number."""
+        if order is not None:
+            if order not in ORDERS: raise ValueError(f'Backlog order {order} not recognized, expected one of {ORDERS}')
+            self.order = order
+        entries = []
+        for entry_rank, deadline, _, sequence, item in self._heap:
+            new_rank = rank(item) if rank is not None else None
+            entries.append((new_rank if new_rank is not None else entry_rank, deadline, self._order_key(item), sequence, item))
+        self._heap = entries
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        if self.order == 'gaps' and self._heap:
+            # the i-th item by date is submitted at position bit_reversed(i), like a van der Corput sequence
+            by_date = sorted(self._heap, key=lambda entry: (time_value(entry[-1].from_dt), entry[3]))
+            n_bits = (len(by_date) - 1).bit_length()
+            self._heap = [(rank, deadline, float(bit_reversed(idx, n_bits)), sequence, item)
+                          for idx, (rank, deadline, _, sequence, item) in enumerate(by_date)]
+        heapq.heapify(self._heap)
+
+
+def parse_config_item_spec(spec: str) -> Tuple[str, int, float]:
+    """Parse 'name[:priority[:weight]]', e.g. 'solar:1:2' -> ('solar', 1, 2.0)."""
+    parts = spec.split(':')
+    if len(parts) > 3 or not parts[0]: raise ValueError(f'Config item {spec} not recognized, expected name[:priority[:weight]]')
+    priority = int(parts[1]) if len(parts) > 1 and parts[1] else 0
+    weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+    if weight <= 0: raise ValueError(f'Weight of config item {parts[0]} must be positive')
+    return parts[0], priority, weight
+
+
+SCHEDULE_OPTIONS = ('order', 'priority', 'weight', 'first')
+
+def load_schedule(path: str) -> Dict[str, Dict[str, Any]]:
+    """Read a schedule file, e.g. {"solar": {"order": "gaps", "priority": 1, "weight": 2, "first": ["2024-01-01", "2024-02-01"]}}.
+
+    Per config item, all options are optional: the order of its backlog, its priority and weight
+    (as in name:priority:weight) and a date range whose intervals are submitted before the others.
+    """
+    with open(path, 'r') as file: schedule = json.load(file)
+    for name, options in schedule.items():
+        unknown = set(options) - set(SCHEDULE_OPTIONS)
+        if unknown: raise ValueError(f'Schedule options {sorted(unknown)} of {name} not recognized, expected some of {SCHEDULE_OPTIONS}')
+        if 'order' in options and options['order'] not in ORDERS: raise ValueError(f'Backlog order {options["order"]} not recognized, expected one of {ORDERS}')
+        if float(options.get('weight', 1.0)) <= 0: raise ValueError(f'Weight of config item {name} must be positive')
+    return schedule
+
+def parse_schedule_date(value: str) -> float:
+    date = datetime.fromisoformat(value)
+    return (date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)).timestamp()
+
+
+class Scheduler(object):
+    """Shares the request slots of the RDA account between several config items.
+
+    Jobs with a higher priority are served first. Between jobs of the same priority,
+    free slots go to the job with the fewest requests in flight relative to its weight,
+    so each job converges to a share of the slots proportional to its weight.
+
+    Submissions run concurrently with the service loop, so a slot is taken when an
+    interval is handed out and only returned by complete_submission (on failure),
+    mark_purged (as soon as a purge is confirmed) or release (once the request is gone
+    from get_status).
+
+    Work items that are rejected or end in Error are split in halves by bisect and queued
+    again, up to max_split_depth times, so a bad day or product only loses that part.
+    """
+
+    def __init__(self, max_requests: int, jobs: List[ConfigJob] | None = None, max_split_depth: int = 0,
+                 on_submitted: Callable[[ConfigJob, WorkItem, int | None], None] | None = None,
+                 on_split: Callable[[ConfigJob, WorkItem, List[WorkItem]], None] | None = None):
+        self.max_requests = max_requests
+        self.max_split_depth = max_split_depth
+        # called outside the lock once a submission is done (request id None if it failed) and when a work item was split
+        self.on_submitted = on_submitted
+        self.on_split = on_split
+        self.jobs: Dict[str, ConfigJob] = {}
+        self._request_to_job: Dict[int, str] = {}
+        self._request_items: Dict[int, WorkItem] = {}
+        # the request dict as submitted, with the overrides of a split item and what the validator dropped
+        self._request_dicts: Dict[int, Dict[str, str]] = {}
+        self._registered_at: Dict[int, float] = {}
+        self._n_pending = 0
+        # purged requests can still be listed by get_status for a while, their slots are free already
+        self._purged: Set[int] = set()
+        self.slot_freed = threading.Event()
+        self._lock = threading.RLock()
+        for job in jobs or []: self.add_job(job)
+
+    def add_job(self, job: ConfigJob) -> None:
+        with self._lock:
+            if job.name in self.jobs: raise ValueError(f'Config item {job.name} is already scheduled')
+            self.jobs[job.name] = job
+
+    def add_intervals(self, job: ConfigJob, time_intervals: List[Tuple[Any, Any]], rank: int = 0, deadline: Any | None = None) -> None:
+        """Add intervals while the service is running, they are submitted in the order of the job's backlog."""
+        with self._lock:
+            job.time_intervals.extend(time_intervals, rank, deadline)
+
+    def reprioritise(self, job: ConfigJob, order: str | None = None, rank: Callable[[WorkItem], int | None] | None = None) -> None:
+        """Change the order of a job's intervals that are not submitted yet, see Backlog.reprioritise."""
+        with self._lock:
+            job.time_intervals.reprioritise(order, rank)
+
+    def apply_schedule(self, schedule: Dict[str, Dict[str, Any]]) -> None:
+        """Apply a schedule (see load_schedule) to the running jobs, unfinished work is reordered right away."""
+        for name, options in schedule.items():
+            job = self.jobs.get(name)
+            if job is None:
+                scope_logger.warning('Config item %s of the schedule is not running, ignored', name)
+                continue
+            rank = None
+            if 'first' in options:
+                start, end = (parse_schedule_date(value) for value in options['first'])
+                # bisected pieces keep their retry rank, the others move in or out of the range
+                rank = lambda item: (RETRY_RANK if start <= time_value(item.from_dt) <= end else 0) if item.depth == 0 else None
+            with self._lock:
+                job.priority = int(options.get('priority', job.priority))
+                job.weight = float(options.get('weight', job.weight))
+                self.reprioritise(job, options.get('order'), rank)
+            scope_logger.info('Rescheduled %s: order %s, priority %s, weight %s', name, job.time_intervals.order, job.priority, job.weight)
+
+    def n_remaining(self) -> int:
+        with self._lock:
+            return sum(len(job.time_intervals) for job in self.jobs.values())
+
+    def n_in_flight(self) -> int:
+        with self._lock:
+            return len(self._request_to_job)
+
+    def n_pending(self) -> int:
+        with self._lock:
+            return self._n_pending
+
+    def job_for_request(self, request_id: int) -> ConfigJob | None:
+        with self._lock:
+            name = self._request_to_job.get(int(request_id))
+            return self.jobs.get(name) if name is not None else None
+
+    def item_for_request(self, request_id: int) -> WorkItem | None:
+        with self._lock:
+            return self._request_items.get(int(request_id))
+
+    def request_dict_for(self, request_id: int) -> Dict[str, str] | None:
+        with self._lock:
+            return self._request_dicts.get(int(request_id))
+
+    def register_request(self, request_id: int, job: ConfigJob, item: WorkItem | None = None, request_dict: Dict[str, str] | None = None) -> None:
+        with self._lock:
+            self._request_to_job[int(request_id)] = job.name
+            self._registered_at[int(request_id)] = time.monotonic()
+            if item is not None: self._request_items[int(request_id)] = item
+            if request_dict is not None: self._request_dicts[int(request_id)] = request_dict
+            job.request_ids.add(int(request_id))
+
+    def complete_submission(self, job: ConfigJob, request_id: int | None, item: WorkItem | None = None,
+                            request_dict: Dict[str, str] | None = None) -> None:
+        """Called once per interval from next_submissions, with the new request id and the submitted request dict or None if the submit failed."""
+        with self._lock:
+            self._n_pending -= 1
+            job.n_pending -= 1
+            if request_id is not None: self.register_request(request_id, job, item, request_dict)
+        if self.on_submitted is not None and item is not None: self.on_submitted(job, item, request_id)
+
+    def bisect(self, job: ConfigJob, item: WorkItem) -> List[WorkItem]:
+        """Queue the halves of a failed work item, returns them or [] if it can't be split any further."""
+        if item.depth >= self.max_split_depth: return []
+        pieces = split_work_item(item, job.request_dict)
+        with self._lock:
+            job.time_intervals.extend(pieces, RETRY_RANK)
+        if self.on_split is not None and pieces: self.on_split(job, item, pieces)
+        return pieces
+
+    def release(self, request_id: int) -> None:
+        with self._lock:
+            name = self._request_to_job.pop(int(request_id), None)
+            self._registered_at.pop(int(request_id), None)
+            self._request_items.pop(int(request_id), None)
+            self._request_dicts.pop(int(request_id), None)
+            if name is not None: self.jobs[name].request_ids.discard(int(request_id))
+
+    def mark_purged(self, request_id: int) -> None:
+        with self._lock:
+            self.release(request_id)
+            self._purged.add(int(request_id))
+        self.slot_freed.set()
+
+    def is_purged(self, request_id: int) -> bool:
+        with self._lock:
+            return int(request_id) in self._purged
+
+    def wait_for_slot(self, timeout: float) -> bool:
+        """Sleep up to timeout, returns early when a purge frees a slot."""
+        freed = self.slot_freed.wait(timeout)
+        self.slot_freed.clear()
+        return freed
+
+    def sync(self, current_request_ids: Iterable[int], snapshot_time: float | None = None) -> None:
+        """Release requests that are no longer listed by get_status.
+
+        Requests registered after snapshot_time (when get_status was called) may not be listed yet and are kept.
+        """
+        current_request_ids = set(int(request_id) for request_id in current_request_ids)
+        with self._lock:
+            self._purged &= current_request_ids
+            for request_id in list(self._request_to_job):
+                if request_id in current_request_ids: continue
+                if snapshot_time is not None and self._registered_at[request_id] >= snapshot_time: continue
+                self.release(request_id)
+
+    def free_slots(self, current_request_ids: Iterable[int]) -> int:
+        """Slots left after the listed requests, our requests not listed yet and submissions still in progress."""
+        with self._lock:
+            occupied = (set(int(request_id) for request_id in current_request_ids) - self._purged) | set(self._request_to_job)
+            return max(self.max_requests - len(occupied) - self._n_pending, 0)
+
+    def _pick_job(self, planned: Dict[str, int]) -> ConfigJob | None:
+        candidates = [job for job in self.jobs.values() if len(job.time_intervals) > planned[job.name]]
+        if len(candidates) == 0: return None
+        top_priority = max(job.priority for job in candidates)
+        candidates = [job for job in candidates if job.priority == top_priority]
+        return min(candidates, key=lambda job: ((len(job.request_ids) + job.n_pending + planned[job.name] + 1) / job.weight, job.n_submitted, job.name))
+
+    def next_submissions(self, n_slots: int) -> List[Tuple[ConfigJob, WorkItem]]:
+        """Take up to n_slots time intervals, distributed fairly between the jobs."""
+        with self._lock:
+            planned = {name: 0 for name in self.jobs}
+            picked = []
+            for _ in range(n_slots):
+                job = self._pick_job(planned)
+                if job is None: break
+                planned[job.name] += 1
+                picked.append(job)
+
+            submissions = []
+            for job in picked:
+                submissions.append((job, job.time_intervals.pop()))
+                job.n_submitted += 1
+                job.n_pending += 1
+            self._n_pending += len(submissions)
+
+            if submissions:
+                counts = {name: count for name, count in planned.items() if count > 0}
+                scope_logger.info('Scheduling %s new requests: %s', len(submissions), counts)
+            return submissions
@@ -1,4 +1,29 @@
 import os
 
 SLEEP_INTERVAL = int(os.environ.get("SLEEP_INTERVAL", 60))
-LOGLEVEL = os.environ.get("ML_LOGLEVEL", "DEBUG")
\ No newline at end of file
+LOGLEVEL = os.environ.get("ML_LOGLEVEL", "DEBUG")
+LOG_FORMAT = os.environ.get("ML_LOG_FORMAT", "text")
+LOG_FILE = os.environ.get("ML_LOG_FILE")
+METRICS_PORT = int(os.environ["ML_METRICS_PORT"]) if "ML_METRICS_PORT" in os.environ else None
+METRICS_TEXTFILE = os.environ.get("ML_METRICS_TEXTFILE")
+# only local scrapers by default, e.g. 0.0.0.0 to serve other hosts
+METRICS_HOST = os.environ.get("ML_METRICS_HOST", "127.0.0.1")
+RDA_RATE_LIMIT = float(os.environ.get("RDA_RATE_LIMIT", 2))
+RDA_RATE_BURST = float(os.environ.get("RDA_RATE_BURST", 5))
+RDA_CIRCUIT_FAILURES = int(os.environ.get("RDA_CIRCUIT_FAILURES", 5))
+RDA_CIRCUIT_RESET = float(os.environ.get("RDA_CIRCUIT_RESET", 60))
+MAX_REQUESTS = int(os.environ.get("RDA_MAX_REQUESTS", 10))
+MAX_SPLIT_DEPTH = int(os.environ.get("RDA_MAX_SPLIT_DEPTH", 6))
+DOWNLOAD_BUFFER_SIZE = int(os.environ.get("ML_DOWNLOAD_BUFFER_SIZE", 1 << 20))
+DOWNLOAD_FSYNC_BYTES = int(os.environ.get("ML_DOWNLOAD_FSYNC_BYTES", 0))
+DOWNLOAD_RETRIES = int(os.environ.get("ML_DOWNLOAD_RETRIES", 3))
+DISK_WATERMARK = float(os.environ.get("ML_DISK_WATERMARK", 0.9))
+BANDWIDTH_LIMIT = os.environ.get("ML_BANDWIDTH_LIMIT")
+BANDWIDTH_SCHEDULE = os.environ.get("ML_BANDWIDTH_SCHEDULE")
+CONTENT_STORE = os.environ.get("ML_CONTENT_STORE")
+S3_ENDPOINT_URL = os.environ.get("ML_S3_ENDPOINT_URL")
+GFS_INVENTORY = os.environ.get("ML_GFS_INVENTORY", "./data_cache/inventory/noaa-gfs-bdp-pds.json")
+PROFILE = os.environ.get("ML_PROFILE")
+PROFILE_DIR = os.environ.get("ML_PROFILE_DIR", "./data_cache/profiles")
+PROFILE_INTERVAL = float(os.environ.get("ML_PROFILE_INTERVAL", 300))
+PROFILE_TOP = int(os.environ.get("ML_PROFILE_TOP", 25))
@@ -0,0 +1,101 @@
+from typing import *
+import os
+import shutil
+import threading
+from pathlib import Path
+from src.utils import metrics
+from src.utils.logger import scope_logger
+
+
+class Reservation(NamedTuple):
+    directory: Path
+    device: int
+    n_bytes: int
+
+
+class StorageManager(object):
+    """Admission control for downloads based on free disk space.
+
+    A download reserves its expected size in the first directory (its target dir, then the
+    same subdirectory of each spill dir) whose file system stays below the watermark, counting
+    the reservations of the other downloads. Reservations are held until a download ends, so
+    the part a running download already wrote is counted twice, which errs on the safe side.
+    """
+
+    def __init__(self, target_dir: Path, spill_dirs: List[Path] | None = None, watermark: float = 0.9, history: int = 20):
+        self.target_dir = Path(target_dir)
+        self.spill_dirs = [Path(spill_dir) for spill_dir in spill_dirs or []]
+        self.watermark = watermark
+        self.history = history
+        self._reservations: Dict[int, Reservation] = {}
+        self._request_sizes: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def candidate_dirs(self, target_dir: Path) -> List[Path]:
+        try:
+            relative = Path(target_dir).relative_to(self.target_dir)
+        except ValueError:
+            return [Path(target_dir)] + self.spill_dirs
+        return [Path(target_dir)] + [spill_dir / relative for spill_dir in self.spill_dirs]
+
+    @staticmethod
+    def usage(directory: Path) -> Tuple[int, int, int]:
+        """(device, total bytes, used bytes) of the file system a (possibly not yet created) directory is on."""
+        existing = Path(directory).absolute()
+        while not existing.exists(): existing = existing.parent
+        usage = shutil.disk_usage(existing)
+        return os.stat(existing).st_dev, usage.total, usage.total - usage.free
+
+    def _reserved_on(self, device: int) -> int:
+        return sum(reservation.n_bytes for reservation in self._reservations.values() if reservation.device == device)
+
+    def reserve(self, request_id: int, n_bytes: int, target_dir: Path) -> Path | None:
+        """Directory to download a request of n_bytes to, or None if it doesn't fit anywhere right now."""
+        with self._lock:
+            # a deferred download retries its reservation, its size is only counted once
+            if int(request_id) not in self._request_sizes:
+                self._request_sizes[int(request_id)] = n_bytes
+                if len(self._request_sizes) > self.history: del self._request_sizes[next(iter(self._request_sizes))]
+            for directory in self.candidate_dirs(target_dir):
+                device, total, used = self.usage(directory)
+                if used + self._reserved_on(device) + n_bytes > self.watermark * total: continue
+
+                os.makedirs(directory, exist_ok=True)
+                self._reservations[int(request_id)] = Reservation(directory, device, n_bytes)
+                if directory != Path(target_dir): scope_logger.info('Not enough space in %s, downloading to %s', target_dir, directory)
+                metrics.disk_reserved_bytes.set(sum(reservation.n_bytes for reservation in self._reservations.values()))
+                return directory
+        return None
+
+    def release(self, request_id: int) -> None:
+        with self._lock:
+            self._reservations.pop(int(request_id), None)
+            metrics.disk_reserved_bytes.set(sum(reservation.n_bytes for reservation in self._reservations.values()))
+
+    def expected_request_size(self) -> float | None:
+        with self._lock:
+            if len(self._request_sizes) == 0: return None
+            return sum(self._request_sizes.values()) / len(self._request_sizes)
+
+    def available_bytes(self) -> int:
+        """Bytes that can still be reserved below the watermark, over all directories."""
+        devices = {}
+        for directory in [self.target_dir] + self.spill_dirs:
+            device, total, used = self.usage(directory)
+            devices[device] = (total, used)
+        with self._lock:
+            return sum(max(int(self.watermark * total) - used - self._reserved_on(device), 0) for device, (total, used) in devices.items())
+
+    def admissible_requests(self, n_outstanding: int) -> int | None:
+        """How many more requests fit on disk next to n_outstanding requests that are not downloaded yet.
+
+        None until a request size has been seen, there is nothing to project from before that.
+        """
+        size = self.expected_request_size()
+        if size is None or size <= 0: return None
+        return max(int(self.available_bytes() // size) - n_outstanding, 0)
+
+    def update_metrics(self) -> None:
+        for directory in [self.target_dir] + self.spill_dirs:
+            _, total, used = self.usage(directory)
+            metrics.disk_free_bytes.set(total - used, directory=str(directory))
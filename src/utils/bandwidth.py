@@ -0,0 +1,125 @@
+from typing import *
+import re
+import time
+import itertools
+import threading
+from src.utils import metrics
+
+
+UNITS = {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9}
+
+
+def parse_rate(value: str | None) -> float | None:
+    """'20M' -> 20e6 bytes/s, None/''/'unlimited' -> None."""
+    if value is None or value.strip().lower() in ('', 'unlimited', 'none'): return None
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMG]?)B?\s*', value.upper())
+    if match is None: raise ValueError(f'Bandwidth {value} not recognized, expected e.g. 500K, 20M or 1G (bytes per second)')
+    rate = float(match.group(1)) * UNITS[match.group(2)]
+    if rate <= 0: raise ValueError(f'Bandwidth must be positive, use "unlimited" instead of {value}')
+    return rate
+
+def parse_schedule(spec: str | None) -> List[Tuple[int, int, float | None]]:
+    """'08:00-17:00=20M,17:00-22:00=50M' -> [(start minute, end minute, bytes/s), ...], windows may wrap midnight."""
+    schedule = []
+    for part in (spec or '').split(','):
+        if not part.strip(): continue
+        match = re.fullmatch(r'\s*(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)', part)
+        if match is None: raise ValueError(f'Bandwidth schedule entry {part} not recognized, expected HH:MM-HH:MM=RATE')
+        start_h, start_m, end_h, end_m = (int(group) for group in match.groups()[:4])
+        schedule.append((start_h * 60 + start_m, end_h * 60 + end_m, parse_rate(match.group(5))))
+    return schedule
+
+
+class BandwidthSession(object):
+    """One download's share of the governor, pass consume as the per-chunk callback."""
+
+    def __init__(self, governor: 'BandwidthGovernor', key: int):
+        self.governor = governor
+        self.key = key
+        self.tag = 0.0
+
+    def consume(self, n_bytes: int) -> None:
+        self.governor.acquire(self, n_bytes)
+
+    def __enter__(self) -> 'BandwidthSession':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.governor.close(self)
+
+
+class BandwidthGovernor(object):
+    """Caps the total download rate of all threads and shares it fairly between active downloads.
+
+    The cap is a byte rate token bucket, optionally depending on the local time of day.
+    Waiting downloads are served in start-time fair queueing order: the one with the fewest
+    bytes served since it became active goes first, so a large download can't starve small
+    ones, and a download that is slower on its own leaves its share to the others.
+    """
+
+    def __init__(self, rate: float | None = None, schedule: List[Tuple[int, int, float | None]] | None = None):
+        self._condition = threading.Condition()
+        self._keys = itertools.count()
+        self._waiting: Dict[int, float] = {}
+        self._virtual_time = 0.0
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.configure(rate, schedule)
+
+    def configure(self, rate: float | None, schedule: List[Tuple[int, int, float | None]] | None = None) -> None:
+        with self._condition:
+            self.rate = rate
+            self.schedule = schedule or []
+            self._condition.notify_all()
+
+    def current_rate(self, now: time.struct_time | None = None) -> float | None:
+        now = now if now is not None else time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end): return rate
+        return self.rate
+
+    def session(self) -> BandwidthSession:
+        return BandwidthSession(self, next(self._keys))
+
+    def close(self, session: BandwidthSession) -> None:
+        with self._condition:
+            self._waiting.pop(session.key, None)
+            self._condition.notify_all()
+
+    def acquire(self, session: BandwidthSession, n_bytes: int) -> float:
+        """Block until n_bytes may be transferred by session, returns the time spent waiting."""
+        start = time.monotonic()
+        with self._condition:
+            # an idle session doesn't bank credit, it starts at the current virtual time
+            session.tag = max(session.tag, self._virtual_time)
+            self._waiting[session.key] = session.tag
+            while True:
+                rate = self.current_rate()
+                metrics.bandwidth_limit.set(rate if rate is not None else 0)
+                now = time.monotonic()
+                if rate is None:
+                    self._tokens = 0.0
+                    self._last = now
+                    break
+
+                # at most one second of burst
+                self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+                self._last = now
+                is_next = min(self._waiting.items(), key=lambda item: (item[1], item[0]))[0] == session.key
+                if is_next and self._tokens > 0:
+                    # chunks may be larger than the burst, the debt is paid off by the next caller
+                    self._tokens -= n_bytes
+                    break
+
+                # woken by other sessions, or once the tokens are refilled, at least every second for schedule changes
+                self._condition.wait(timeout=min(max(-self._tokens / rate, 0.01), 1.0) if is_next else 1.0)
+
+            del self._waiting[session.key]
+            self._virtual_time = max(self._virtual_time, session.tag)
+            session.tag += n_bytes
+            self._condition.notify_all()
+
+        waited = time.monotonic() - start
+        if waited > 0.001: metrics.bandwidth_wait.inc(waited)
+        return waited
@@ -0,0 +1,72 @@
+from typing import *
+import os
+import errno
+
+
+PART_SUFFIX = '.part'
+
+
+def preallocate(fd: int, size: int) -> bool:
+    """Reserve size bytes up front, avoids fragmentation and fails early if the disk is full."""
+    if size <= 0 or not hasattr(os, 'posix_fallocate'): return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError as error:
+        # not every file system supports it (e.g. some network mounts), a full disk is a real error
+        if error.errno == errno.ENOSPC: raise
+        return False
+
+
+def write_all(file: BinaryIO, data: memoryview) -> None:
+    """Unbuffered writes can be partial (e.g. interrupted by a signal), write until all of data is on disk."""
+    while len(data) > 0: data = data[file.write(data):]
+
+
+class StreamWriter(object):
+    """Copies a file-like stream to disk through one reused buffer.
+
+    Data goes to '<path>.part' and is only renamed to path once all expected bytes are
+    written (and synced), so an interrupted download never looks like a complete file.
+    """
+
+    def __init__(self, buffer_size: int = 1 << 20, fsync_bytes: int = 0):
+        self.buffer_size = buffer_size
+        # 0: leave flushing to the OS, otherwise fsync every fsync_bytes and before the rename
+        self.fsync_bytes = fsync_bytes
+        self._buffer = bytearray(buffer_size)
+
+    def write(self, stream: BinaryIO, path: str, expected_size: int | None = None,
+              on_chunk: Callable[[int, int], None] | None = None) -> int:
+        """Write stream to path, returns the number of bytes written.
+
+        on_chunk is called with (chunk size, total written) after each buffer.
+        """
+        view = memoryview(self._buffer)
+        part_path = path + PART_SUFFIX
+        written = unsynced = 0
+        try:
+            with open(part_path, 'wb', buffering=0) as file:
+                if expected_size is not None: preallocate(file.fileno(), expected_size)
+                while True:
+                    n = stream.readinto(view)
+                    if not n: break
+                    write_all(file, view[:n])
+                    written += n
+                    unsynced += n
+                    if self.fsync_bytes and unsynced >= self.fsync_bytes:
+                        os.fsync(file.fileno())
+                        unsynced = 0
+                    if on_chunk is not None: on_chunk(n, written)
+
+                if expected_size is not None and written != expected_size:
+                    raise IOError(f'Incomplete download of {path}: {written} of {expected_size} bytes')
+                # drop preallocated space past the end, in case the size was overestimated
+                file.truncate(written)
+                if self.fsync_bytes: os.fsync(file.fileno())
+        except BaseException:
+            if os.path.exists(part_path): os.remove(part_path)
+            raise
+
+        os.replace(part_path, path)
+        return written
@@ -0,0 +1,87 @@
+from __future__ import annotations
+from typing import *
+import json
+import codecs
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',]}'
+
+
+class JsonStream(object):
+    """Incremental reader of a JSON document arriving in chunks (str or bytes).
+
+    Only the text that hasn't been consumed is kept, so a large array can be read one element at a time.
+    """
+
+    def __init__(self, chunks: Iterable[str | bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.done = False
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+
+    def fill(self) -> bool:
+        """Append the next chunk, returns False at the end of the document."""
+        for chunk in self.chunks:
+            text = self._text.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if text == '': continue
+            self.buffer = self.buffer[self.pos:] + text
+            self.pos = 0
+            return True
+        self.done = True
+        return False
+
+    def peek(self) -> str:
+        """Next character that isn't whitespace, '' at the end of the document."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE: self.pos += 1
+            if self.pos < len(self.buffer): return self.buffer[self.pos]
+            if not self.fill(): return ''
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char: raise ValueError(f'Expected {char!r} at offset {self.pos} of the JSON stream, found {found!r}')
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next value, reading as many chunks as it needs."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+                # a number is only complete once something follows it, '1.' decodes as 1 until the next chunk arrives
+                if self.done or not isinstance(value, (int, float)) or isinstance(value, bool) or end < len(self.buffer) and self.buffer[end] in DELIMITERS:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.done: raise
+            if not self.fill() and self.pos >= len(self.buffer): raise ValueError('JSON stream ended in the middle of a value')
+
+
+def iter_array(chunks: Iterable[str | bytes], path: Sequence[str] = (), fields: Collection[str] | None = None) -> Iterator[Any]:
+    """Yield the elements of the array at path (keys of nested objects) one at a time.
+
+    With fields, elements that are objects are reduced to these keys. Values before the
+    array are skipped, nothing after it is read. Nothing is yielded if the path doesn't exist.
+    """
+    stream = JsonStream(chunks)
+    for key in path:
+        stream.expect('{')
+        while True:
+            if stream.peek() == '}': return
+            name = stream.value()
+            stream.expect(':')
+            if name == key: break
+            stream.value()
+            if stream.peek() == ',': stream.pos += 1
+
+    stream.expect('[')
+    if stream.peek() == ']': return
+    while True:
+        element = stream.value()
+        if fields is not None and isinstance(element, dict): element = {name: element[name] for name in fields if name in element}
+        yield element
+        separator = stream.peek()
+        if separator == ']': return
+        stream.expect(',')
@@ -0,0 +1,32 @@
+from typing import *
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy that imports the real module on first attribute access.
+
+    Keeps heavy dependencies (requests, pendulum, ...) out of interpreter startup
+    for entry points that never use them, e.g. `download_data_v3.py report`.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__['_LazyModule__module'] = None
+
+    def __load(self) -> types.ModuleType:
+        module = self.__dict__['_LazyModule__module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_LazyModule__module'] = module
+        return module
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self.__load(), attribute)
+
+    def __dir__(self) -> List[str]:
+        return dir(self.__load())
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    return LazyModule(name)
@@ -2,9 +2,16 @@ from typing import *
 from enum import Enum
 import contextvars
 import traceback
+import threading
+import queue
+import atexit
+import json
+import os
+import sys
+import time
+from datetime import datetime
 from abc import ABC, abstractmethod
-from src.settings import LOGLEVEL
-import pendulum as pm
+from src.settings import LOGLEVEL, LOG_FORMAT, LOG_FILE
 
 
 class LogLevel(Enum):
@@ -27,24 +34,150 @@ def get_system_loglevel() -> LogLevel:
         case _: raise Exception("Invalid LogLevel in settings")
 
 
+# resolved once, the settings can't change while the process is running
+SYSTEM_LOGLEVEL = get_system_loglevel()
+
+LOGLEVEL_TO_STRING = {
+    LogLevel.DEBUG :     "DEBUG",
+    LogLevel.INFO :      "INFO ",
+    LogLevel.WARNING :   "WARN ",
+    LogLevel.ERROR :     "ERROR",
+    LogLevel.EXCEPTION : "EXCPT",
+    LogLevel.FATAL :     "FATAL",
+}
+
+
+# keys of a json log line, scope fields with the same name are prefixed with field_
+RESERVED_FIELDS = ("timestamp", "level", "scope", "message")
+
+
+class LogRecord(NamedTuple):
+    timestamp: float
+    level: LogLevel
+    scope: str | None
+    fields: Dict[str, str]
+    message: str
+    args: tuple
+
+
+def parse_scope_fields(scope : str | None) -> Dict[str, str]:
+    """Extract key=value pairs (e.g. request_id=123) from a scope like 'service/request_id=123'."""
+    fields = {}
+    if scope is None: return fields
+    for part in scope.split('/'):
+        key, sep, value = part.partition('=')
+        if sep and key.strip().isidentifier(): fields[key.strip()] = value.strip()
+    return fields
+
+
+class LogHandler(object):
+    """Formats and writes log records on a background thread, so callers only pay for a queue put."""
+
+    def __init__(self, log_format : str = LOG_FORMAT, log_file : str | None = LOG_FILE):
+        if log_format not in ("text", "json"): raise Exception("Invalid log format in settings")
+        self.__format = log_format
+        self.__log_file = log_file
+        self.__queue : queue.SimpleQueue = queue.SimpleQueue()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__stream = None
+
+    def emit(self, record : LogRecord):
+        if self.__thread is None:
+            with self.__lock:
+                if self.__thread is None: self.__start()
+        self.__queue.put(record)
+
+    def close(self):
+        if self.__thread is None: return
+        self.__queue.put(None)
+        self.__thread.join(timeout=5)
+
+    def flush(self, timeout : float = 5):
+        """Wait until everything emitted so far is written, e.g. before a worker process exits without atexit."""
+        if self.__thread is None: return
+        written = threading.Event()
+        self.__queue.put(written)
+        written.wait(timeout)
+
+    def after_fork(self):
+        # the writer thread doesn't exist in a forked child, start a new one on the next emit
+        self.__queue = queue.SimpleQueue()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def __start(self):
+        self.__stream = open(self.__log_file, 'a') if self.__log_file is not None else sys.stdout
+        self.__thread = threading.Thread(target=self.__run, name='log-handler', daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    def __run(self):
+        while True:
+            record = self.__queue.get()
+            lines, flushed = [], []
+            # drain whatever is queued to write and flush once per batch
+            while record is not None:
+                if isinstance(record, threading.Event):
+                    flushed.append(record)
+                else:
+                    lines.append(self.__format_record(record))
+                try:
+                    record = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                if lines:
+                    self.__stream.write('\n'.join(lines) + '\n')
+                    self.__stream.flush()
+            except Exception:
+                traceback.print_exc()
+            for written in flushed: written.set()
+            if record is None: return
+
+    def __format_record(self, record : LogRecord) -> str:
+        try:
+            message = str(record.message) % record.args if record.args else str(record.message)
+        except Exception:
+            message = f'{record.message} {record.args}'
+        timestamp = datetime.fromtimestamp(record.timestamp).astimezone().isoformat()
+
+        if self.__format == "json":
+            return json.dumps({
+                "timestamp": timestamp,
+                "level": record.level.name,
+                "scope": record.scope,
+                **{f"field_{key}" if key in RESERVED_FIELDS else key: value for key, value in record.fields.items()},
+                "message": message,
+            }, default=str)
+
+        if record.scope is not None:
+            return "[{} - {}]: {} {}".format(LOGLEVEL_TO_STRING[record.level], record.scope, timestamp, message)
+        return "[{}] {} {}".format(LOGLEVEL_TO_STRING[record.level], timestamp, message)
+
+
+log_handler = LogHandler()
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=log_handler.after_fork)
+
+
 class LoggerScopeABC(ABC):    
     pass
 
 class LoggerABC(ABC):
     @abstractmethod
-    def debug(self, message : str):
+    def debug(self, message : str, *args):
         pass
 
     @abstractmethod
-    def info(self, message : str):
+    def info(self, message : str, *args):
         pass
 
     @abstractmethod
-    def warning(self, message : str):
+    def warning(self, message : str, *args):
         pass
 
     @abstractmethod
-    def error(self, message : str):
+    def error(self, message : str, *args):
         pass
 
     @abstractmethod
@@ -99,50 +232,45 @@ class LoggerScope(LoggerScopeABC):
     
 
 class Logger(object):
-    def __init__(self, scope : str = None):        
+    def __init__(self, scope : str = None, level : Optional[LogLevel] = None, handler : LogHandler = None):
         self.__scope = scope
-        self.__LogLevel_to_string_dict = {
-            LogLevel.DEBUG :     "DEBUG",
-            LogLevel.INFO :      "INFO ",
-            LogLevel.WARNING :   "WARN ",
-            LogLevel.ERROR :     "ERROR",
-            LogLevel.EXCEPTION : "EXCPT",
-            LogLevel.FATAL :     "FATAL",
-        }
+        self.__fields = parse_scope_fields(scope)
+        self.__level = level if level is not None else SYSTEM_LOGLEVEL
+        self.__handler = handler if handler is not None else log_handler
         pass
 
-    def __print_log(self, level : LogLevel, message : str):        
-        if self.__scope is not None:
-            print("[{} - {}]: {}".format(self.__LogLevel_to_string_dict[level], self.__scope, message))
-        else:
-            print("[{}] {}".format(self.__LogLevel_to_string_dict[level], message))
+    def __log(self, level : LogLevel, message : str, args : tuple):
+        self.__handler.emit(LogRecord(time.time(), level, self.__scope, self.__fields, message, args))
 
-    def __current_LogLevel(self) -> LogLevel:
-        return get_system_loglevel()
+    def is_enabled_for(self, level : LogLevel) -> bool:
+        return self.__level.value <= level.value
 
-    def debug(self, message : str):
-        if self.__current_LogLevel().value > LogLevel.DEBUG.value: return
-        self.__print_log(LogLevel.DEBUG, message)
+    def debug(self, message : str, *args):
+        if self.__level.value > LogLevel.DEBUG.value: return
+        self.__log(LogLevel.DEBUG, message, args)
 
-    def info(self, message : str):
-        if self.__current_LogLevel().value > LogLevel.INFO.value: return
-        self.__print_log(LogLevel.INFO, message)
+    def info(self, message : str, *args):
+        if self.__level.value > LogLevel.INFO.value: return
+        self.__log(LogLevel.INFO, message, args)
 
-    def warning(self, message : str):
-        if self.__current_LogLevel().value > LogLevel.WARNING.value: return
-        self.__print_log(LogLevel.WARNING, message)
+    def warning(self, message : str, *args):
+        if self.__level.value > LogLevel.WARNING.value: return
+        self.__log(LogLevel.WARNING, message, args)
 
-    def error(self, message : str):
-        if self.__current_LogLevel().value > LogLevel.ERROR.value: return
-        self.__print_log(LogLevel.ERROR, message)
+    def error(self, message : str, *args):
+        if self.__level.value > LogLevel.ERROR.value: return
+        self.__log(LogLevel.ERROR, message, args)
 
     def exception(self, exception):
-        if self.__current_LogLevel().value > LogLevel.EXCEPTION.value: return
-        self.__print_log(LogLevel.EXCEPTION, exception)
+        if self.__level.value > LogLevel.EXCEPTION.value: return
+        self.__log(LogLevel.EXCEPTION, exception, ())
 
     def make_variant(self, scope : str, level : Optional[LogLevel] = None):
         scope = scope if self.__scope is None else "{}/{}".format(self.__scope, scope)
-        return Logger(scope)
+        return Logger(scope, level if level is not None else self.__level, self.__handler)
+
+    def set_level(self, level : LogLevel):
+        self.__level = level
 
     def create_loggerscope(self, scope : str) -> LoggerScope:
         return LoggerScope(self.make_variant(scope))
@@ -156,20 +284,24 @@ class ScopeLogger(object):
     def __logger(self) -> LoggerABC:        
         return LoggerScope.get_current_scope().logger
 
-    def debug(self, message : str):
-        self.__logger.debug(f'{pm.now()} {message}')
+    # messages are formatted lazily with %-style args, and only if the level is enabled
+    def debug(self, message : str, *args):
+        self.__logger.debug(message, *args)
 
-    def info(self, message : str):
-        self.__logger.info(f'{pm.now()} {message}')
+    def info(self, message : str, *args):
+        self.__logger.info(message, *args)
 
-    def warning(self, message : str):
-        self.__logger.warning(f'{pm.now()} {message}')
+    def warning(self, message : str, *args):
+        self.__logger.warning(message, *args)
 
-    def error(self, message : str):
-        self.__logger.error(f'{pm.now()} {message}')
+    def error(self, message : str, *args):
+        self.__logger.error(message, *args)
 
     def exception(self, exception):
-        self.__logger.exception(f'{pm.now()}, {exception}')
+        self.__logger.exception(exception)
+
+    def is_enabled_for(self, level : LogLevel) -> bool:
+        return self.__logger.is_enabled_for(level)
 
     def make_variant(self, scope : str):
         return self.__logger.make_variant(scope)
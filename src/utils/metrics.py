@@ -0,0 +1,212 @@
+from typing import *
+import os
+import threading
+import time
+import traceback
+from src.utils.logger import scope_logger
+
+
+DEFAULT_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DEFAULT_THROUGHPUT_BUCKETS = tuple(2**power * 1024**2 for power in range(-2, 10)) # 256 KiB/s to 512 MiB/s
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)]
+    if extra: pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value: float) -> str:
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'Metric {self.name} expects labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if amount < 0: raise ValueError('Counters can only be incremented')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        if not values and not self.label_names: values = [((), 0)]
+        return [f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for idx, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[idx] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.label_names, key, f'le="{format_value(upper_bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics: raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+download_bytes = registry.counter('rda_download_bytes_total', 'Bytes downloaded from RDA')
+downloaded_files = registry.counter('rda_download_files_total', 'Files downloaded from RDA')
+download_throughput = registry.histogram('rda_download_file_throughput_bytes_per_second', 'Throughput per downloaded file', buckets=DEFAULT_THROUGHPUT_BUCKETS)
+api_latency = registry.histogram('rda_api_request_duration_seconds', 'Duration of RDA API calls per endpoint', ['endpoint'])
+api_retries = registry.counter('rda_api_retries_total', 'Retries made by request_wrapper per endpoint', ['endpoint'])
+api_responses = registry.counter('rda_api_responses_total', 'RDA API responses per endpoint and status code', ['endpoint', 'code'])
+api_circuit_open = registry.gauge('rda_api_circuit_open', 'Whether the RDA API circuit breaker is open (1) or closed (0)')
+api_failures = registry.counter('rda_api_failures_total', 'RDA API calls given up by request_wrapper per endpoint', ['endpoint'])
+requests_by_state = registry.gauge('rda_requests', 'Current RDA requests by state', ['state'])
+request_slots_free = registry.gauge('rda_request_slots_free', 'Free request slots in the RDA account quota')
+time_intervals_remaining = registry.gauge('rda_time_intervals_remaining', 'Time intervals not yet submitted')
+disk_free_bytes = registry.gauge('rda_disk_free_bytes', 'Free bytes on the file system of each download directory', ['directory'])
+disk_reserved_bytes = registry.gauge('rda_disk_reserved_bytes', 'Bytes reserved by downloads in progress')
+bandwidth_limit = registry.gauge('rda_download_bandwidth_limit_bytes_per_second', 'Current download bandwidth cap, 0 if unlimited')
+bandwidth_wait = registry.counter('rda_download_bandwidth_wait_seconds_total', 'Time downloads spent waiting for the bandwidth governor')
+downloads_deferred = registry.counter('rda_downloads_deferred_total', 'Downloads postponed because there was not enough disk space')
+dedup_files = registry.counter('rda_dedup_files_total', 'Files handled by the content store by outcome (stored, duplicate, skipped)', ['outcome'])
+dedup_bytes = registry.counter('rda_dedup_bytes_total', 'Bytes not stored twice or not downloaded again thanks to the content store')
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> Any:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    scope_logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+    return server
+
+def write_textfile(path: str) -> None:
+    # write to a temporary file and rename, so the node exporter never reads a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(registry.render())
+    os.replace(tmp_path, path)
+
+def start_textfile_exporter(path: str, interval: float = 15) -> threading.Thread:
+    def export():
+        while True:
+            try:
+                write_textfile(path)
+            except Exception:
+                scope_logger.error('Could not write metrics to %s', path)
+                traceback.print_exc()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=export, name='metrics-textfile', daemon=True)
+    thread.start()
+    scope_logger.info('Writing metrics to %s every %s s', path, interval)
+    return thread
@@ -0,0 +1,277 @@
+from __future__ import annotations
+from typing import *
+import io
+import os
+import sys
+import time
+import atexit
+import threading
+import functools
+import contextlib
+from collections import Counter
+from src.settings import PROFILE, PROFILE_DIR, PROFILE_INTERVAL, PROFILE_TOP
+from src.utils.logger import scope_logger
+
+# imported by the API client on every start, the profilers are only imported once profiling is enabled
+if TYPE_CHECKING:
+    import pstats
+    import cProfile
+    import tracemalloc
+
+MODES = ('cprofile', 'sample', 'tracemalloc')
+
+
+def parse_modes(spec: str | None) -> FrozenSet[str]:
+    """'cprofile,tracemalloc' -> frozenset({'cprofile', 'tracemalloc'}), None or '' disables profiling."""
+    modes = frozenset(mode.strip() for mode in (spec or '').split(',') if mode.strip() != '')
+    unknown = modes - set(MODES)
+    if unknown: raise ValueError(f'Profiling modes {sorted(unknown)} not recognized, expected some of {MODES}')
+    return modes
+
+def frame_name(frame: Any) -> str:
+    return f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}'
+
+def write_atomic(path: str, write: Callable[[str], None]) -> None:
+    tmp_path = f'{path}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def write_text(path: str, text: str) -> None:
+    def write(tmp_path: str) -> None:
+        with open(tmp_path, 'w') as file: file.write(text)
+    write_atomic(path, write)
+
+
+class Profiler(object):
+    """Opt-in profiling of named stages, e.g. an iteration of the service loop or a download.
+
+    Modes:
+    - cprofile: deterministic profile of the outermost stage a thread is in, nested stages are
+      part of it. Stages that never return (the service loop) have to be entered per iteration.
+    - sample: a thread samples the stacks of all threads in a stage every sample_interval
+      seconds and attributes them to their innermost stage, cheap enough for production.
+    - tracemalloc: snapshots of the allocations, compared to the first one.
+
+    Every interval seconds and at exit, the profiles are written to output_dir per stage and
+    process (<stage>.<pid>.pstats, <stage>.<pid>.folded for flamegraph.pl), next to a top-N
+    summary.<pid>.txt. The wall time of every stage is recorded in any mode.
+    """
+
+    def __init__(self, modes: FrozenSet[str] = frozenset(), output_dir: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL,
+                 top_n: int = PROFILE_TOP, sample_interval: float = 0.01):
+        self.modes: FrozenSet[str] = frozenset()
+        self.output_dir = output_dir
+        self.interval = interval
+        self.top_n = top_n
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._reset()
+        if modes: self.configure(modes, output_dir, interval, top_n)
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.modes) > 0
+
+    def _reset(self) -> None:
+        self._started_at = time.time()
+        # thread id -> names of the stages the thread is in, innermost last
+        self._stacks: Dict[int, List[str]] = {}
+        self._active: Dict[int, 'cProfile.Profile'] = {}
+        self._wall: Dict[str, List[float]] = {}
+        self._profiles: Dict[str, 'pstats.Stats'] = {}
+        self._samples: Dict[str, Counter] = {}
+        self._baseline: 'tracemalloc.Snapshot | None' = None
+
+    def configure(self, modes: FrozenSet[str], output_dir: str | None = None, interval: float | None = None, top_n: int | None = None) -> None:
+        """Enable the given modes, e.g. from a CLI flag, profiling started before is kept."""
+        if output_dir is not None: self.output_dir = output_dir
+        if interval is not None: self.interval = interval
+        if top_n is not None: self.top_n = top_n
+        if not modes or modes == self.modes: return
+        import multiprocessing.util
+
+        self.close()
+        self.modes = frozenset(modes)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._start()
+        atexit.register(self.close)
+        # pool workers exit without running atexit, but with the finalizers multiprocessing registers after the fork
+        multiprocessing.util.register_after_fork(self, lambda profiler: multiprocessing.util.Finalize(None, profiler.close, exitpriority=10))
+        scope_logger.info('Profiling %s, writing to %s every %s s', ', '.join(sorted(self.modes)), self.output_dir, self.interval)
+
+    def _start(self) -> None:
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._dump_periodically, name='profiler-dump', daemon=True)]
+        if 'sample' in self.modes: self._threads.append(threading.Thread(target=self._sample, name='profiler-sample', daemon=True))
+        if 'tracemalloc' in self.modes:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing(): tracemalloc.start()
+            self._baseline = self._snapshot()
+        for thread in self._threads: thread.start()
+
+    def close(self) -> None:
+        """Stop the profiler threads and write the profiles a last time."""
+        if not self.enabled or self._stop.is_set(): return
+        self._stop.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread(): thread.join(timeout=5)
+        self.dump()
+
+    def after_fork(self) -> None:
+        # the forked child profiles for itself, without the threads and numbers of its parent
+        if not self.enabled: return
+        profile = self._active.get(threading.get_ident())
+        if profile is not None: profile.disable()
+        self._lock = threading.Lock()
+        self._reset()
+        self._start()
+
+    def stage(self, name: str) -> ContextManager[None]:
+        if not self.enabled: return contextlib.nullcontext()
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name: str) -> Iterator[None]:
+        thread_id = threading.get_ident()
+        stack = self._stacks.setdefault(thread_id, [])
+        profile = None
+        if 'cprofile' in self.modes and len(stack) == 0:
+            import cProfile
+
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self._active[thread_id] = profile
+            except ValueError:
+                # another profiler is active in this thread
+                profile = None
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if not stack: self._stacks.pop(thread_id, None)
+            if profile is not None:
+                profile.disable()
+                self._active.pop(thread_id, None)
+            with self._lock:
+                wall = self._wall.setdefault(name, [0, 0.0])
+                wall[0] += 1
+                wall[1] += elapsed
+                if profile is not None:
+                    if name in self._profiles:
+                        self._profiles[name].add(profile)
+                    else:
+                        import pstats
+
+                        self._profiles[name] = pstats.Stats(profile)
+
+    def profiled(self, name: str | None = None) -> Callable[[Callable], Callable]:
+        """Decorator running a function as a stage, named after the function by default."""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__name__): return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            frames = sys._current_frames()
+            samples = []
+            for thread_id, stack in list(self._stacks.items()):
+                frame = frames.get(thread_id)
+                try:
+                    stage = stack[-1]
+                except IndexError:
+                    # the thread left its stage meanwhile
+                    continue
+                if frame is None: continue
+                names = []
+                while frame is not None and len(names) < 64:
+                    names.append(frame_name(frame))
+                    frame = frame.f_back
+                samples.append((stage, tuple(reversed(names))))
+            with self._lock:
+                for stage, names in samples: self._samples.setdefault(stage, Counter())[names] += 1
+
+    def _snapshot(self) -> 'tracemalloc.Snapshot':
+        import tracemalloc
+
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, '<frozen importlib._bootstrap>')])
+
+    def _dump_periodically(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.dump()
+            except Exception:
+                scope_logger.error('Could not write profiles to %s', self.output_dir)
+
+    def dump(self) -> None:
+        """Write the profiles collected so far and the summary."""
+        if not self.enabled: return
+        pid = os.getpid()
+        os.makedirs(self.output_dir, exist_ok=True)
+        snapshot = None
+        if 'tracemalloc' in self.modes:
+            import tracemalloc
+
+            if tracemalloc.is_tracing(): snapshot = self._snapshot()
+        with self._lock:
+            for stage, stats in self._profiles.items():
+                write_atomic(os.path.join(self.output_dir, f'{stage}.{pid}.pstats'), stats.dump_stats)
+            for stage, samples in self._samples.items():
+                folded = ''.join(f'{";".join(names)} {count}\n' for names, count in samples.items())
+                write_text(os.path.join(self.output_dir, f'{stage}.{pid}.folded'), folded)
+            if snapshot is not None: write_atomic(os.path.join(self.output_dir, f'tracemalloc.{pid}.snapshot'), snapshot.dump)
+            summary = self.summary(snapshot)
+        write_text(os.path.join(self.output_dir, f'summary.{pid}.txt'), summary)
+
+    def summary(self, snapshot: 'tracemalloc.Snapshot | None' = None) -> str:
+        """Wall time per stage and the top_n functions (or allocating lines) per mode."""
+        top_n = self.top_n
+        lines = [f'Profile of pid {os.getpid()} over {time.time() - self._started_at:.0f} s ({", ".join(sorted(self.modes))})', '',
+                 f'{"stage":<32} {"calls":>8} {"total s":>10} {"mean s":>10}']
+        for stage, (calls, seconds) in sorted(self._wall.items(), key=lambda item: -item[1][1]):
+            lines.append(f'{stage:<32} {calls:>8} {seconds:>10.2f} {seconds / calls:>10.4f}')
+
+        for stage, stats in self._profiles.items():
+            stream = io.StringIO()
+            # print_stats writes to the stream the stats were created with
+            stats.stream = stream
+            stats.sort_stats('cumulative').print_stats(top_n)
+            lines += ['', f'== cProfile {stage}, by cumulative time ==', stream.getvalue().strip()]
+
+        for stage, samples in self._samples.items():
+            total = sum(samples.values())
+            own, inclusive = Counter(), Counter()
+            for names, count in samples.items():
+                own[names[-1]] += count
+                for name in set(names): inclusive[name] += count
+            lines += ['', f'== Samples {stage}, {total} samples ==', f'{"own %":>7} {"total %":>7}  function']
+            for name, count in own.most_common(top_n): lines.append(f'{100 * count / total:>7.1f} {100 * inclusive[name] / total:>7.1f}  {name}')
+            lines.append(f'{"":>7} {"total %":>7}  function, including callees')
+            for name, count in inclusive.most_common(top_n): lines.append(f'{"":>7} {100 * count / total:>7.1f}  {name}')
+
+        if snapshot is not None:
+            import tracemalloc
+
+            current, peak = tracemalloc.get_traced_memory()
+            lines += ['', f'== tracemalloc, {current / 2**20:.1f} MiB allocated, peak {peak / 2**20:.1f} MiB ==']
+            lines += [str(stat) for stat in snapshot.statistics('lineno')[:top_n]]
+            if self._baseline is not None:
+                lines += ['', '== tracemalloc, growth since profiling started ==']
+                lines += [str(stat) for stat in snapshot.compare_to(self._baseline, 'lineno')[:top_n]]
+        return '\n'.join(lines) + '\n'
+
+
+# configured from the environment, CLI flags can enable it later with configure
+profiler = Profiler(parse_modes(PROFILE))
+
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=profiler.after_fork)
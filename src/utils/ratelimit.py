@@ -0,0 +1,135 @@
+from typing import *
+import time
+import random
+import threading
+from enum import Enum
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket shared by every caller of the RDA API."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._not_before = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Block until tokens are available, returns the time spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._not_before and self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = max(self._not_before - now, (tokens - self._tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all callers, e.g. when the server answers 429 with Retry-After."""
+        with self._lock:
+            self._not_before = max(self._not_before, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class RetryDecision(Enum):
+    SUCCESS = 'success'
+    RETRY = 'retry'
+    FAIL = 'fail'
+
+
+class RetryPolicy(object):
+    """Classifies responses by status code and computes jittered exponential backoff."""
+
+    RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+    def __init__(self, max_attempts: int = 10, base_delay: float = 2, max_delay: float = 120):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def classify(self, status_code: int) -> RetryDecision:
+        if 200 <= status_code < 300: return RetryDecision.SUCCESS
+        if status_code in self.RETRYABLE_STATUS_CODES: return RetryDecision.RETRY
+        # remaining client errors won't get better by asking again
+        return RetryDecision.FAIL
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        # "full jitter", spreads out threads that failed at the same time
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if retry_after is not None: delay = max(delay, retry_after)
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value: str | None) -> float | None:
+        if value is None: return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+class CircuitState(Enum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """Stops all threads from calling a failing API, and lets a single probe through after reset_timeout."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """Block while the circuit is open."""
+        with self._condition:
+            while True:
+                if self.state == CircuitState.CLOSED:
+                    return
+
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if self.state == CircuitState.OPEN and remaining <= 0:
+                    self.state = CircuitState.HALF_OPEN
+
+                if self.state == CircuitState.HALF_OPEN and not self._probe_in_flight:
+                    self._probe_in_flight = True
+                    return
+
+                self._condition.wait(timeout=remaining if remaining > 0 else self.reset_timeout)
+
+    def record_success(self) -> None:
+        with self._condition:
+            self.state = CircuitState.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+            self._condition.notify_all()
+
+    def record_failure(self) -> None:
+        with self._condition:
+            self._failures += 1
+            if self.state == CircuitState.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = CircuitState.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+            self._condition.notify_all()
@@ -0,0 +1,183 @@
+from typing import *
+import os
+import json
+import glob
+import time
+import threading
+import traceback
+from enum import Enum
+from src.utils.logger import scope_logger
+
+
+class TraceEvent(str, Enum):
+    SUBMITTED = 'submitted'
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    COMPLETED = 'completed'
+    DOWNLOAD_START = 'download_start'
+    DOWNLOAD_END = 'download_end'
+    PURGED = 'purged'
+    ERROR = 'error'
+
+
+# (phase name, start event(s), end event), the first start event present is used
+PHASES = [
+    ('queue', (TraceEvent.SUBMITTED, TraceEvent.QUEUED), TraceEvent.PROCESSING),
+    ('processing', (TraceEvent.PROCESSING, TraceEvent.QUEUED, TraceEvent.SUBMITTED), TraceEvent.COMPLETED),
+    ('download_wait', (TraceEvent.COMPLETED,), TraceEvent.DOWNLOAD_START),
+    ('download', (TraceEvent.DOWNLOAD_START,), TraceEvent.DOWNLOAD_END),
+    ('purge', (TraceEvent.DOWNLOAD_END,), TraceEvent.PURGED),
+    ('total', (TraceEvent.SUBMITTED, TraceEvent.QUEUED, TraceEvent.PROCESSING, TraceEvent.COMPLETED), TraceEvent.PURGED),
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+def status_to_event(request_status: str) -> TraceEvent | None:
+    status = request_status.lower()
+    if 'queue' in status: return TraceEvent.QUEUED
+    if status == 'processing': return TraceEvent.PROCESSING
+    if status == 'completed': return TraceEvent.COMPLETED
+    if status == 'error': return TraceEvent.ERROR
+    return None
+
+
+class RequestTracer(object):
+    """Appends request lifecycle events as JSON lines to a trace file.
+
+    Status changes are only observed once per service loop iteration, so the
+    resolution of the queued/processing/completed timestamps is SLEEP_INTERVAL.
+    """
+
+    def __init__(self, trace_path: str | None, config_item: str | None = None):
+        self.trace_path = trace_path
+        self.config_item = config_item
+        self._lock = threading.Lock()
+        self._seen: Set[Tuple[int, TraceEvent]] = set()
+        self._traces: Dict[int, Dict[str, Any]] = {}
+        if trace_path is not None: os.makedirs(os.path.dirname(trace_path) or '.', exist_ok=True)
+
+    def record(self, request_id: int, event: TraceEvent, timestamp: float | None = None, config_item: str | None = None, **fields) -> None:
+        """Record the first occurrence of an event for a request."""
+        key = (int(request_id), event)
+        timestamp = timestamp if timestamp is not None else time.time()
+        config_item = config_item if config_item is not None else self.config_item
+        with self._lock:
+            if key in self._seen: return
+            self._seen.add(key)
+            merge_event(self._traces, int(request_id), event.value, timestamp, config_item, fields)
+
+        if self.trace_path is None: return
+        line = {
+            'request_id': int(request_id),
+            'event': event.value,
+            'timestamp': timestamp,
+            'config_item': config_item,
+            **fields,
+        }
+        try:
+            with self._lock:
+                with open(self.trace_path, 'a') as file:
+                    file.write(json.dumps(line, default=str) + '\n')
+        except Exception:
+            scope_logger.error('Could not write to trace file')
+            traceback.print_exc()
+
+    def snapshot(self) -> Dict[int, Dict[str, Any]]:
+        """Traces recorded by this tracer, in the same format as load_traces."""
+        with self._lock:
+            return {request_id: {'config_item': trace['config_item'], 'events': dict(trace['events']), 'fields': dict(trace['fields'])}
+                    for request_id, trace in self._traces.items()}
+
+    def record_status(self, request_id: int, request_status: str, timestamp: float | None = None) -> None:
+        event = status_to_event(request_status)
+        if event is None: return
+        self.record(request_id, event, timestamp)
+        # a request seen as Completed right away still went through processing
+        if event == TraceEvent.COMPLETED: self.record(request_id, TraceEvent.PROCESSING, timestamp)
+
+
+def merge_event(traces: Dict[int, Dict[str, Any]], request_id: int, event: str, timestamp: float, config_item: str | None, fields: Dict[str, Any]) -> None:
+    trace = traces.setdefault(request_id, {'config_item': None, 'events': {}, 'fields': {}})
+    if config_item is not None: trace['config_item'] = config_item
+    if event not in trace['events'] or timestamp < trace['events'][event]:
+        trace['events'][event] = timestamp
+    trace['fields'].update(fields)
+
+def load_traces(trace_paths: Iterable[str]) -> Dict[int, Dict[str, Any]]:
+    """Merge trace files into request_id -> {'config_item': ..., 'events': {event: first timestamp}, 'fields': {...}}."""
+    traces = {}
+    for trace_path in trace_paths:
+        with open(trace_path, 'r') as file:
+            for line in file:
+                if not line.strip(): continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+                request_id, event, timestamp, config_item = (entry.pop(key, None) for key in ('request_id', 'event', 'timestamp', 'config_item'))
+                merge_event(traces, request_id, event, timestamp, config_item, entry)
+    return traces
+
+def phase_durations(events: Dict[str, float]) -> Dict[str, float]:
+    durations = {}
+    for phase, start_events, end_event in PHASES:
+        if end_event.value not in events: continue
+        start = next((events[event.value] for event in start_events if event.value in events), None)
+        if start is None: continue
+        durations[phase] = max(events[end_event.value] - start, 0.0)
+    return durations
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    if len(values) == 1: return values[0]
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarise(traces: Dict[int, Dict[str, Any]]) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Return config_item -> phase -> {n, mean, p50, p90, p99, max} in seconds, including an 'all' config item."""
+    durations_by_config: Dict[str, Dict[str, List[float]]] = {}
+    for trace in traces.values():
+        config_item = trace['config_item'] or 'unknown'
+        for phase, duration in phase_durations(trace['events']).items():
+            for key in (config_item, 'all'):
+                durations_by_config.setdefault(key, {}).setdefault(phase, []).append(duration)
+
+    summary = {}
+    for config_item, phases in durations_by_config.items():
+        summary[config_item] = {}
+        for phase, _, _ in PHASES:
+            if phase not in phases: continue
+            values = phases[phase]
+            stats = {'n': len(values), 'mean': sum(values) / len(values)}
+            for q in PERCENTILES: stats[f'p{q}'] = percentile(values, q)
+            stats['max'] = max(values)
+            summary[config_item][phase] = stats
+    return summary
+
+def format_duration(seconds: float) -> str:
+    if seconds < 120: return f'{seconds:.0f}s'
+    if seconds < 2*3600: return f'{seconds/60:.1f}m'
+    return f'{seconds/3600:.1f}h'
+
+def format_report(summary: Dict[str, Dict[str, Dict[str, float]]]) -> str:
+    columns = ['n', 'mean'] + [f'p{q}' for q in PERCENTILES] + ['max']
+    lines = []
+    for config_item in sorted(summary, key=lambda key: (key == 'all', key)):
+        lines.append(f'\n{config_item}')
+        lines.append('  {:<14}'.format('phase') + ''.join('{:>9}'.format(column) for column in columns))
+        for phase, stats in summary[config_item].items():
+            values = [str(stats['n'])] + [format_duration(stats[column]) for column in columns[1:]]
+            lines.append('  {:<14}'.format(phase) + ''.join('{:>9}'.format(value) for value in values))
+    return '\n'.join(lines)
+
+def report(trace_dir: str, config_item: str | None = None) -> str:
+    trace_paths = sorted(glob.glob(os.path.join(trace_dir, '*.jsonl')))
+    traces = load_traces(trace_paths)
+    if config_item is not None:
+        traces = {request_id: trace for request_id, trace in traces.items() if trace['config_item'] == config_item}
+    summary = summarise(traces)
+    return f'{len(traces)} traced requests from {len(trace_paths)} trace files' + format_report(summary)
@@ -0,0 +1,15 @@
+import io
+import tarfile
+
+
+def fake_grib2(payload: bytes) -> bytes:
+    """Framing of a GRIB2 message (indicator section and end marker) around an arbitrary payload."""
+    length = 16 + len(payload) + 4
+    return b'GRIB' + b'\x00\x00\x00\x02' + length.to_bytes(8, 'big') + payload + b'7777'
+
+def write_tar(path, members):
+    with tarfile.open(path, 'w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
@@ -0,0 +1,33 @@
+import time
+import threading
+import pytest
+from src.utils.bandwidth import BandwidthGovernor, parse_rate, parse_schedule
+
+
+def test_parse_schedule():
+    assert parse_rate('20M') == 20e6 and parse_rate('unlimited') is None
+    with pytest.raises(ValueError): parse_rate('0')
+    governor = BandwidthGovernor(parse_rate('100M'), parse_schedule('08:00-17:00=10M,22:00-06:00=unlimited'))
+    at = lambda hour: time.struct_time((2024, 1, 1, hour, 0, 0, 0, 1, 0))
+    assert governor.current_rate(at(9)) == 10e6
+    assert governor.current_rate(at(18)) == 100e6
+    assert governor.current_rate(at(23)) is None and governor.current_rate(at(3)) is None
+
+def test_rate_is_capped_and_shared():
+    governor = BandwidthGovernor(20e6)
+    served = {}
+
+    def download(name):
+        with governor.session() as session:
+            end = time.monotonic() + 0.5
+            while time.monotonic() < end:
+                session.consume(1 << 18)
+                served[name] = served.get(name, 0) + (1 << 18)
+
+    threads = [threading.Thread(target=download, args=(name,)) for name in ('a', 'b')]
+    start = time.monotonic()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    total = sum(served.values())
+    assert total / (time.monotonic() - start) < 20e6 * 1.5
+    assert abs(served['a'] - served['b']) <= 2 * (1 << 18)
@@ -0,0 +1,36 @@
+import sys
+import pytest
+from src.config import parse_time_intervals
+from src.utils.lazy import lazy_import
+
+
+# blank and whitespace only lines, padded values and windows line endings
+INTERVALS = '2024-01-01 00:00:00,2024-01-31 18:00:00\n   \n\n  2024-02-01 00:00:00 , 2024-02-29 18:00:00\r\n'
+
+def test_parse_time_intervals(tmp_path):
+    path = tmp_path / 'intervals.csv'
+    # an empty row made the pandas version fail, it's skipped as well
+    path.write_text(INTERVALS + ',\n')
+    intervals = parse_time_intervals(str(path))
+    assert [(from_dt.isoformat(), to_dt.isoformat()) for from_dt, to_dt in intervals] == [
+        ('2024-01-01T00:00:00+00:00', '2024-01-31T18:00:00+00:00'), ('2024-02-01T00:00:00+00:00', '2024-02-29T18:00:00+00:00')]
+
+def test_parse_time_intervals_like_pandas(tmp_path):
+    # the pandas version this replaced
+    pd = pytest.importorskip('pandas')
+    pm = pytest.importorskip('pendulum')
+    path = tmp_path / 'intervals.csv'
+    path.write_text(INTERVALS)
+    expected = pd.read_csv(path, header=None, names=['from_dt', 'to_dt'])
+    expected = [(pm.instance(pd.to_datetime(from_dt.strip(), format='%Y-%m-%d %H:%M:%S')), pm.instance(pd.to_datetime(to_dt.strip(), format='%Y-%m-%d %H:%M:%S')))
+                for from_dt, to_dt in zip(expected['from_dt'], expected['to_dt'])]
+    assert parse_time_intervals(str(path)) == expected
+
+def test_lazy_import(tmp_path, monkeypatch):
+    (tmp_path / 'lazy_probe.py').write_text('value = 42\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = lazy_import('lazy_probe')
+    assert 'lazy_probe' not in sys.modules
+    assert module.value == 42 and 'lazy_probe' in sys.modules
+    assert 'value' in dir(module)
+    monkeypatch.delitem(sys.modules, 'lazy_probe')
@@ -0,0 +1,35 @@
+import os
+from src.content_store import ContentStore, Deduplicator, selection_key
+
+
+def write(path, data):
+    with open(path, 'wb') as file: file.write(data)
+    return str(path)
+
+def test_duplicates_are_linked(tmp_path):
+    store = ContentStore(tmp_path / 'store')
+    first = write(tmp_path / 'gfs.0p25.2024010100.f003.grib2', b'GRIB' * 100)
+    second = write(tmp_path / 'other_name.grib2', b'GRIB' * 100)
+    digest = store.add('https://x/gfs.0p25.2024010100.f003.grib2', first)
+    assert store.add('https://x/other_name.grib2', second) == digest
+    assert os.path.samefile(first, second) and os.stat(first).st_nlink == 3
+
+def test_known_files_are_not_fetched(tmp_path):
+    store = ContentStore(tmp_path / 'store')
+    selection = selection_key({'param': 'TMP', 'level': 'HTGL:2', 'date': '202401010000/to/202401310000'})
+    assert selection == selection_key({'param': 'TMP', 'level': 'HTGL:2', 'date': '202402010000/to/202402290000'})
+    dedup = Deduplicator(store, selection)
+    dedup.add('https://x/gfs.0p25.2024010100.f003.grib2.req1', write(tmp_path / 'a', b'data'))
+
+    # same name and size, and the same cycle, selection and size under another name
+    assert dedup.link('https://x/gfs.0p25.2024010100.f003.grib2.req1', 4, str(tmp_path / 'b'))
+    assert dedup.link('https://x/gfs.0p25.2024010100.f003.grib2.req2', 4, str(tmp_path / 'c'))
+    assert open(tmp_path / 'c', 'rb').read() == b'data'
+    # a file of the same cycle and selection with another size has other content
+    assert not dedup.link('https://x/gfs.0p25.2024010100.f003.grib2.req4', 10, str(tmp_path / 'f'))
+    assert not Deduplicator(store, selection_key({'param': 'R H'})).link('https://x/gfs.0p25.2024010100.f003.grib2.req3', 4, str(tmp_path / 'd'))
+    assert not dedup.link('https://x/gfs.0p25.2024010100.f006.grib2.req2', 4, str(tmp_path / 'e'))
+
+    # reopened from disk
+    store.close()
+    assert ContentStore(tmp_path / 'store').lookup('gfs.0p25.2024010100.f003.grib2.req1', 4) is not None
@@ -0,0 +1,49 @@
+import re
+import numpy as np
+from src.config import get_average_products, get_six_hour_accumulated_products, get_total_accumulated_products
+from src.processing.deaccumulate import interval_values, deaccumulate_columns
+
+
+def windows(products):
+    steps = sorted((int(end), int(start)) for start, end in (re.search(r'initial\+(\d+) to initial\+(\d+)', p).groups() for p in products))
+    return np.array([start for _, start in steps]), np.array([end for end, _ in steps])
+
+def test_constant_rate_over_all_windows():
+    rate = 2.5
+    for products, step_type in [(get_six_hour_accumulated_products(), 'accum'), (get_total_accumulated_products(), 'accum'),
+                                (get_average_products(), 'avg')]:
+        start_steps, end_steps = windows(products)
+        values = rate * (end_steps - start_steps) if step_type == 'accum' else np.full(len(end_steps), rate)
+        rates, interval_starts = interval_values(values, start_steps, end_steps, step_type)
+        np.testing.assert_allclose(rates, rate)
+        # contiguous intervals, also across the switch to 6-hourly output at 240h
+        assert interval_starts[0] == 0 and (interval_starts[1:] == end_steps[:-1]).all()
+
+def test_columns_with_interleaved_series():
+    columns = {
+        'site': np.array(['a', 'b', 'a', 'b', 'a']), 'init': np.zeros(5, dtype='datetime64[s]'),
+        'param': np.array(['A PCP'] * 4 + ['TMP']), 'level_type': np.array(['SFC'] * 5), 'level': np.zeros(5),
+        'step_type': np.array(['accum'] * 4 + ['instant'], dtype=object),
+        'start_step': np.array([0, 0, 0, 0, 0], dtype=np.int16), 'end_step': np.array([3, 6, 6, 3, 0], dtype=np.int16),
+        'value': np.array([3.0, 12.0, 9.0, 6.0, 280.0]),
+    }
+    result = deaccumulate_columns(columns)
+    np.testing.assert_allclose(result['value'], [1.0, 2.0, 2.0, 2.0, 280.0])
+    assert list(result['start_step']) == [0, 3, 3, 0, 0]
+    assert list(result['step_type']) == ['rate'] * 4 + ['instant']
+    assert list(columns['step_type']) == ['accum'] * 4 + ['instant']
+
+def test_total_and_six_hour_accumulations_are_separate_series():
+    # 1, 2, 3 and 4 mm/h in the 3h intervals up to 12h, 0-3h and 0-6h are the same product in both lists
+    start_steps = np.array([0, 0, 0, 0, 6, 6], dtype=np.int16)
+    end_steps = np.array([3, 6, 9, 12, 9, 12], dtype=np.int16)
+    values = np.array([3.0, 9.0, 18.0, 30.0, 9.0, 21.0])
+    n = len(values)
+    columns = {
+        'site': np.array(['a'] * n), 'init': np.zeros(n, dtype='datetime64[s]'), 'param': np.array(['A PCP'] * n),
+        'level_type': np.array(['SFC'] * n), 'level': np.zeros(n), 'step_type': np.array(['accum'] * n, dtype=object),
+        'start_step': start_steps, 'end_step': end_steps, 'value': values,
+    }
+    result = deaccumulate_columns(columns)
+    np.testing.assert_allclose(result['value'], [1.0, 2.0, 3.0, 4.0, 3.0, 4.0])
+    assert list(result['start_step']) == [0, 3, 6, 9, 6, 9]
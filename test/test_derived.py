@@ -0,0 +1,30 @@
+import numpy as np
+from datetime import datetime
+from src.processing.grib import MessageInfo
+from src.processing.derived import DerivedFields, derived_variables, hub_height_wind, specific_humidity, wind_direction
+
+
+def test_wind_direction_is_where_the_wind_comes_from():
+    u, v = np.array([0.0, 5.0, 0.0, -5.0]), np.array([-5.0, 0.0, 5.0, 0.0])
+    np.testing.assert_allclose(wind_direction(u, v), [0, 270, 180, 90])
+
+def test_hub_height_wind_power_law():
+    # speed doubles from 10 to 100 m, exponent log10(2)
+    speed = hub_height_wind(np.array([3.0, 0.0]), np.array([4.0, 0.0]), np.array([6.0, 8.0]), np.array([8.0, 0.0]), np.array([1000.0, 200.0]))
+    np.testing.assert_allclose(speed, [20.0, 8.0 * 2 ** (1 / 7)])
+
+def test_specific_humidity():
+    np.testing.assert_allclose(specific_humidity(np.array(50.0), np.array(293.15), np.array(101325.0)), 0.00725, rtol=0.01)
+
+def test_chunks_and_completion():
+    init = datetime(2024, 1, 1)
+    instant = lambda param, level, field: (MessageInfo(param, 'HTGL', level, 'instant', 0, 3, init), field)
+    rng = np.random.default_rng(0)
+    u10, v10, u100, v100 = (rng.normal(size=(7, 11)) for _ in range(4))
+    derived = DerivedFields(derived_variables(hub_heights=[120]), chunk_size=5)
+
+    assert derived.add(*instant('U GRD', 10, u10)) == [] and derived.add(*instant('V GRD', 10, v10)) != []
+    derived.add(*instant('U GRD', 100, u100))
+    results = {(info.param, info.level): field for info, field in derived.add(*instant('V GRD', 100, v100))}
+    assert set(results) == {('WIND', 100.0), ('WDIR', 100.0), ('WIND', 120.0)}
+    np.testing.assert_allclose(results[('WIND', 120.0)], hub_height_wind(u10, v10, u100, v100, 120.0), rtol=1e-6)
@@ -0,0 +1,26 @@
+import io
+import os
+import pytest
+from src.utils.diskio import StreamWriter, PART_SUFFIX
+
+
+def test_complete_write_is_renamed(tmp_path):
+    path = str(tmp_path / 'file.tar')
+    chunks = []
+    written = StreamWriter(buffer_size=7, fsync_bytes=10).write(io.BytesIO(b'x' * 50), path, 50, lambda n, total: chunks.append(total))
+    assert written == 50 and chunks[-1] == 50 and max(b - a for a, b in zip([0] + chunks, chunks)) == 7
+    assert open(path, 'rb').read() == b'x' * 50 and not os.path.exists(path + PART_SUFFIX)
+
+def test_short_stream_leaves_no_file(tmp_path):
+    path = str(tmp_path / 'file.tar')
+    with pytest.raises(IOError):
+        StreamWriter().write(io.BytesIO(b'x' * 10), path, 50)
+    assert os.listdir(tmp_path) == []
+
+def test_partial_writes_are_completed(tmp_path, monkeypatch):
+    class ShortWrites(io.FileIO):
+        def write(self, data): return super().write(data[:3])
+    monkeypatch.setattr('src.utils.diskio.open', lambda path, mode, buffering: ShortWrites(path, mode), raising=False)
+    path = str(tmp_path / 'file.tar')
+    assert StreamWriter(buffer_size=8).write(io.BytesIO(bytes(range(50))), path, 50) == 50
+    assert open(path, 'rb').read() == bytes(range(50))
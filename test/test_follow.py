@@ -0,0 +1,43 @@
+import json
+from pathlib import Path
+import pendulum as pm
+from src.follow import CycleFollower
+from src.scheduler import ConfigJob, Scheduler
+from src.utils.tracing import RequestTracer
+
+
+def saved_cycle(path):
+    return json.loads(path.read_text())['gfs'] if path.exists() else None
+
+def test_state_only_covers_submitted_cycles(tmp_path):
+    state_path = tmp_path / 'state.json'
+    job = ConfigJob('gfs', {'param': 'TMP', 'product': '3-hour Forecast/6-hour Forecast'}, [], Path('.'))
+    metadata = [{'param': 'TMP', 'end_date': 202501011800}]
+    follower = CycleFollower([job], lambda: metadata, str(state_path), str(tmp_path / 'latency.csv'), 0, pm.datetime(2025, 1, 1, tz='UTC'))
+    scheduler = Scheduler(10, [job], max_split_depth=2, on_submitted=follower.on_submitted, on_split=follower.on_split)
+    follower.poll(scheduler, RequestTracer(str(tmp_path / 'trace.jsonl')))
+    # queued, but nothing submitted yet
+    assert saved_cycle(state_path) is None
+
+    newest, second, third, oldest = [item for _, item in scheduler.next_submissions(4)]
+    scheduler.complete_submission(job, 1, newest)
+    scheduler.complete_submission(job, 2, oldest)
+    assert saved_cycle(state_path) == '2025-01-01T00:00:00Z'
+
+    # a rejected cycle is only done once all of its pieces are submitted
+    scheduler.bisect(job, second)
+    scheduler.complete_submission(job, None, second)
+    scheduler.complete_submission(job, 3, third)
+    assert saved_cycle(state_path) == '2025-01-01T06:00:00Z'
+    for request_id, (_, piece) in enumerate(scheduler.next_submissions(2), 10): scheduler.complete_submission(job, request_id, piece)
+    assert saved_cycle(state_path) == '2025-01-01T18:00:00Z'
+
+    # a cycle that could not be submitted is requested again after a restart
+    metadata[0]['end_date'] = 202501020000
+    follower.last_poll = 0
+    follower.poll(scheduler, RequestTracer(str(tmp_path / 'trace.jsonl')))
+    (_, failed), = scheduler.next_submissions(1)
+    scheduler.complete_submission(job, None, failed)
+    assert saved_cycle(state_path) == '2025-01-01T18:00:00Z'
+    restarted = CycleFollower([job], lambda: metadata, str(state_path), str(tmp_path / 'latency.csv'), 0)
+    assert restarted.new_cycles(job, pm.datetime(2025, 1, 2, tz='UTC')) == [pm.datetime(2025, 1, 2, tz='UTC')]
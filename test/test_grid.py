@@ -0,0 +1,45 @@
+import numpy as np
+from src.processing.grid import LatLonGrid
+from src.processing.grib import iter_message_spans
+from .helpers import fake_grib2
+
+
+def test_from_griddef():
+    grid = LatLonGrid.from_griddef('1440:721:90N:0E:90S:359.75E:0.25:0.25')
+    assert grid == LatLonGrid(90.0, 0.0, -0.25, 0.25, 721, 1440) and grid.is_global
+
+def test_bilinear_weights_reproduce_linear_field():
+    grid = LatLonGrid(74.0, 332.0, -0.25, 0.25, 169, 297)
+    lats, lons = grid.lats, (grid.lons - 332.0) % 360
+    field = 2 * lats[:, None] + lons[None, :]
+    points_lat, points_lon = np.array([59.91, 38.72, 10.0]), np.array([10.75, -9.14, 10.0])
+    indices, weights, inside = grid.bilinear_weights(points_lat, points_lon)
+    values = (field.reshape(-1)[indices] * weights).sum(-1)
+    assert inside.tolist() == [True, True, False]
+    np.testing.assert_allclose(values[:2], 2 * points_lat[:2] + (points_lon[:2] + 28))
+
+def test_global_grid_wraps_around():
+    grid = LatLonGrid.from_griddef('1440:721:90N:0E:90S:359.75E:0.25:0.25')
+    indices, weights, inside = grid.bilinear_weights(np.array([0.0]), np.array([359.9]))
+    assert inside[0] and set(indices[0] % grid.n_lon) == {1439, 0}
+    np.testing.assert_allclose(weights.sum(), 1)
+
+def test_message_spans_skip_tar_headers():
+    first, second = fake_grib2(b'x' * 10), fake_grib2(b'GRIB' * 3)
+    buffer = b'\0' * 512 + first + b'\0' * 100 + second + b'\0' * 1024
+    spans = list(iter_message_spans(buffer))
+    assert spans == [(512, len(first)), (512 + len(first) + 100, len(second))]
+
+def test_regrid_weights_are_cached(tmp_path):
+    from src.processing.regrid import Regridder, weights_path
+    source = LatLonGrid(74.0, 332.0, -0.25, 0.25, 169, 297)
+    target = LatLonGrid.from_griddef('60:40:70N:350E:50.5N:19.5E:0.5:0.5')
+    field = 2 * source.lats[:, None] + np.arange(source.n_lon)[None, :] * source.d_lon
+    regridder = Regridder.load(source, target, str(tmp_path))
+    assert (tmp_path / weights_path('', source, target)).exists()
+
+    expected = 2 * target.lats[:, None] + ((target.lons - 332.0) % 360)[None, :]
+    for regridder in (regridder, Regridder.load(source, target, str(tmp_path))):
+        values = regridder.regrid(np.stack([field, field + 1]))
+        np.testing.assert_allclose(values[0], expected)
+        np.testing.assert_allclose(values[1], expected + 1)
@@ -0,0 +1,60 @@
+import threading
+from datetime import datetime
+from src.inventory import GfsInventory, LAST_STEP
+
+
+class LocalS3(object):
+    """Stand-in for list_objects_v2 of an S3 client, with small pages to exercise the pagination."""
+
+    def __init__(self, keys, page_size=3):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, StartAfter=None, ContinuationToken=None):
+        with self._lock: self.calls.append(Prefix)
+        entries = []
+        for key in self.keys:
+            if not key.startswith(Prefix) or StartAfter is not None and key <= StartAfter: continue
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                entry = ('prefix', Prefix + rest[:rest.index(Delimiter) + 1])
+            else:
+                entry = ('key', key)
+            if entry not in entries: entries.append(entry)
+
+        start = int(ContinuationToken or 0)
+        page_entries = entries[start:start + self.page_size]
+        page = {'CommonPrefixes': [{'Prefix': value} for kind, value in page_entries if kind == 'prefix'],
+                'Contents': [{'Key': value} for kind, value in page_entries if kind == 'key'],
+                'IsTruncated': start + self.page_size < len(entries)}
+        if page['IsTruncated']: page['NextContinuationToken'] = str(start + self.page_size)
+        return page
+
+def cycle_keys(date, hours, steps):
+    keys = []
+    for hour in hours:
+        for step in steps:
+            key = f'gfs.{date}/{hour}/atmos/gfs.t{hour}z.pgrb2.0p25.f{step:03d}'
+            keys += [key, key + '.idx', f'gfs.{date}/{hour}/atmos/gfs.t{hour}z.pgrb2.1p00.f{step:03d}']
+    return keys
+
+def test_inventory_is_incremental(tmp_path):
+    all_steps = [0, 3, 6, LAST_STEP]
+    s3 = LocalS3(cycle_keys('20240101', ['00', '06', '12', '18'], all_steps) + cycle_keys('20240102', ['00', '06'], [0, 3]))
+    inventory = GfsInventory(str(tmp_path / 'gfs.json'), client=s3, n_workers=4)
+    assert inventory.update() == ['20240101', '20240102']
+    assert inventory.cycles(start=datetime(2024, 1, 1, 12)) == [datetime(2024, 1, 1, 12), datetime(2024, 1, 1, 18), datetime(2024, 1, 2), datetime(2024, 1, 2, 6)]
+    assert inventory.steps(datetime(2024, 1, 1, 6)) == all_steps
+    assert inventory.has(datetime(2024, 1, 2, 6), 3) and not inventory.has(datetime(2024, 1, 2, 6), 6) and not inventory.has(datetime(2024, 1, 2, 12))
+    assert inventory.latest_cycle(min_step=LAST_STEP) == datetime(2024, 1, 1, 18)
+
+    # the next run only lists the new date and the incomplete one, from the cache on disk
+    s3.keys = sorted(s3.keys + cycle_keys('20240102', ['00', '06', '12'], all_steps) + cycle_keys('20240103', ['00'], [0]))
+    s3.calls = []
+    inventory = GfsInventory(str(tmp_path / 'gfs.json'), client=s3)
+    assert inventory.has(datetime(2024, 1, 1, 18), 6)
+    assert inventory.update() == ['20240102', '20240103']
+    assert not any(call.startswith('gfs.20240101') for call in s3.calls)
+    assert inventory.steps(datetime(2024, 1, 2, 12)) == all_steps and inventory.has(datetime(2024, 1, 3), 0)
@@ -0,0 +1,23 @@
+import json
+import pytest
+from src.utils.jsonstream import iter_array
+
+
+def chunked(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+def test_records_are_parsed_across_chunks():
+    records = [{'param': 'TMP', 'product': '3-hour Forecast', 'start_date': 201501150000, 'levels': [{'level': 'HTGL', 'level_value': '2'}]},
+               {'param': 'A PCP', 'product': 'Ø 6-hour Accumulation', 'start_date': 201906120000, 'end_date': 2.5e11, 'levels': []}]
+    document = json.dumps({'status': 'ok', 'request_duration': 1.25, 'data': {'dsid': 'd084001', 'data': records, 'after': [1, 2]}})
+    data = document.encode()
+    # every split position, including inside numbers and the two bytes of 'Ø'
+    for size in (1, 2, 3, 7, 64, len(data)):
+        assert list(iter_array(chunked(data, size), ('data', 'data'))) == records
+    assert list(iter_array(chunked(document, 5), ('data', 'data'), fields=['param', 'end_date'])) == [{'param': 'TMP'}, {'param': 'A PCP', 'end_date': 2.5e11}]
+
+def test_missing_path_and_truncated_stream():
+    assert list(iter_array([b'{"status": "error", "messages": ["Invalid dataset"]}'], ('data', 'data'))) == []
+    assert list(iter_array([b' [ ] '])) == []
+    with pytest.raises(ValueError):
+        list(iter_array([b'{"data": {"data": [{"param": "TMP"}, {"param": "R'], ('data', 'data')))
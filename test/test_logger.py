@@ -0,0 +1,35 @@
+import json
+import threading
+from src.utils.logger import LogHandler, LogLevel, Logger
+
+
+def test_json_lines_from_several_threads(tmp_path):
+    handler = LogHandler('json', str(tmp_path / 'service.log'))
+    logger = Logger('service/request_id=7/level=surface', LogLevel.INFO, handler)
+
+    def log(thread):
+        for i in range(100): logger.info('thread %s line %s', thread, i)
+    threads = [threading.Thread(target=log, args=(thread,)) for thread in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    logger.debug('not enabled %s', 1)
+    handler.flush()
+
+    lines = [json.loads(line) for line in (tmp_path / 'service.log').read_text().splitlines()]
+    assert len(lines) == 400
+    # scope fields don't overwrite the keys of the line itself
+    assert lines[0]['level'] == 'INFO' and lines[0]['field_level'] == 'surface' and lines[0]['request_id'] == '7'
+    assert lines[0]['scope'] == 'service/request_id=7/level=surface'
+    for thread in range(4):
+        assert [line['message'] for line in lines if line['message'].startswith(f'thread {thread} ')] == [f'thread {thread} line {i}' for i in range(100)]
+    handler.close()
+
+def test_text_format(tmp_path):
+    handler = LogHandler('text', str(tmp_path / 'service.log'))
+    Logger('service', LogLevel.INFO, handler).make_variant('request_id=7').error('%s files missing', 3)
+    Logger(None, LogLevel.INFO, handler).warning('bad format %d', 'x')
+    handler.flush()
+    first, second = (tmp_path / 'service.log').read_text().splitlines()
+    assert first.startswith('[ERROR - service/request_id=7]: ') and first.endswith(' 3 files missing')
+    assert second.startswith('[WARN ] ') and second.endswith(" bad format %d ('x',)")
+    handler.close()
@@ -0,0 +1,65 @@
+import json
+from src.config import parse_config
+from src.metadata import MetadataCache, MetadataIndex, RequestValidator
+
+METADATA = [
+    {'param': 'TMP', 'product': '3-hour Forecast', 'start_date': 201501150000, 'end_date': 202501010000,
+     'levels': [{'level': 'HTGL', 'level_value': '2'}, {'level': 'HTGL', 'level_value': '100'}]},
+    {'param': 'TMP', 'product': '6-hour Forecast', 'start_date': 201501150000, 'end_date': 202501010000,
+     'levels': [{'level': 'HTGL', 'level_value': '2'}]},
+    {'param': 'A PCP', 'product': '3-hour Accumulation (initial+0 to initial+3)', 'start_date': 201906120000, 'end_date': 202501010000,
+     'levels': [{'level': 'SFC', 'level_value': '0'}]},
+    {'param': 'R H', 'product': '3-hour Forecast', 'start_date': 201501150000, 'end_date': 202501010000},
+]
+
+def request(param, level, product, date='202401010000/to/202401311800'):
+    return {'dataset': 'd084001', 'date': date, 'param': param, 'level': level, 'product': product}
+
+def test_drops_unavailable_products_and_levels():
+    validator = RequestValidator(lambda: METADATA)
+    result = validator.validate(request('TMP/A PCP', 'HTGL:2/10;SFC:0', '3-hour Forecast/9-hour Forecast/3-hour Accumulation (initial+0 to initial+3)'))
+    assert result.valid and len(result.issues) == 2
+    assert result.request_dict['product'] == '3-hour Forecast/3-hour Accumulation (initial+0 to initial+3)'
+    assert result.request_dict['level'] == 'HTGL:2;SFC:0'
+
+    # R H doesn't list its levels, so they are kept
+    result = validator.validate(request('R H', 'HTGL:10', '3-hour Forecast'))
+    assert result.valid and result.issues == [] and result.request_dict['level'] == 'HTGL:10'
+
+def test_dates_outside_the_metadata():
+    validator = RequestValidator(lambda: METADATA)
+    result = validator.validate(request('A PCP', 'SFC:0', '3-hour Accumulation (initial+0 to initial+3)', '201801010000/to/201801311800'))
+    assert not result.valid and 'A PCP' in result.issues[0]
+
+def test_flag_mode_only_reports():
+    validator = RequestValidator(lambda: METADATA, drop=False)
+    unavailable = request('A PCP', 'SFC:0', '3-hour Accumulation (initial+0 to initial+3)', '201801010000/to/201801311800')
+    result = validator.validate(unavailable)
+    assert result.valid and result.request_dict == unavailable and 'A PCP' in result.issues[0]
+    result = validator.validate(request('TMP', 'HTGL:2/10', '3-hour Forecast'))
+    assert result.valid and result.request_dict['level'] == 'HTGL:2/10' and len(result.issues) == 1
+
+def test_index_lookups():
+    index = MetadataIndex(METADATA + [{'param': 'TMP', 'product': '3-hour Forecast', 'start_date': 201001010000, 'end_date': 201412310000,
+                                       'levels': [{'level': 'SFC', 'level_value': '0'}]}])
+    assert index.params() == ['TMP', 'A PCP', 'R H'] and 'TMP' in index and 'CPOFP' not in index
+    assert index.products('TMP') == ['3-hour Forecast', '6-hour Forecast']
+    assert index.products('A PCP', '^3-hour') == ['3-hour Accumulation (initial+0 to initial+3)'] and index.products('A PCP', to_date=201801010000) == []
+    assert index.levels('TMP', '3-hour Forecast') == {'HTGL': {'2', '100'}, 'SFC': {'0'}}
+    assert index.levels('TMP', '3-hour Forecast', 202001010000, 202001010000) == {'HTGL': {'2', '100'}}
+    assert index.levels('R H') is None
+    assert index.product_levels('TMP', 201001010000, 201101010000) == {'3-hour Forecast': {'SFC': {'0'}}}
+    assert index.date_range('TMP', '3-hour Forecast') == (201001010000, 202501010000) and index.date_range('CPOFP') is None
+
+def test_config_products_are_well_formed():
+    products = parse_config({'parameters': ['A PCP'], 'levels': {'SFC': [0]}, 'product_types': ['total_accumulated']}).products.split('/')
+    assert all(product.count('(') == product.count(')') == 1 for product in products)
+
+def test_cache(tmp_path):
+    calls = []
+    fetch = lambda: calls.append(1) or METADATA
+    path = str(tmp_path / 'metadata.json')
+    assert MetadataCache(fetch, path).get() == METADATA
+    assert MetadataCache(fetch, path).get() == METADATA and len(calls) == 1
+    assert MetadataCache(lambda: None, path, max_age=0).get() == METADATA
+    assert json.load(open(path))['data'] == METADATA
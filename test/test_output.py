@@ -0,0 +1,21 @@
+from datetime import datetime
+import numpy as np
+import xarray as xr
+from src.processing.grib import MessageInfo
+from src.processing.grid import LatLonGrid
+from src.processing.output import InitDatasetWriter
+
+
+def test_total_and_window_accumulations_are_kept_apart(tmp_path):
+    grid = LatLonGrid.from_griddef('3:2:1N:0E:0N:2E:1:1')
+    init = datetime(2024, 1, 1)
+    writer = InitDatasetWriter(str(tmp_path), 'request', grid, deaccumulate=True)
+    # 1, 2 and 3 mm/h in the 3h intervals up to 9h, as the 0-N total and the 6-9h window
+    for start_step, end_step, value in [(0, 3, 3.0), (0, 6, 9.0), (0, 9, 18.0), (6, 9, 9.0)]:
+        writer.add(MessageInfo('A PCP', 'SFC', 0.0, 'accum', start_step, end_step, init), np.full(grid.shape, value))
+    path, = writer.close()
+
+    with xr.open_dataset(path) as dataset:
+        np.testing.assert_allclose(dataset['A_PCP_SFC_0_accum_total'].values[:, 0, 0], [1.0, 2.0, 3.0])
+        np.testing.assert_allclose(dataset['A_PCP_SFC_0_accum'].values[:, 0, 0], [np.nan, np.nan, 3.0])
+        assert list(dataset['A_PCP_SFC_0_accum_start_step'].values) == [-1, -1, 6]
@@ -0,0 +1,35 @@
+import os
+import time
+import pytest
+from src.utils.profiling import Profiler, parse_modes
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end: sum(range(1000))
+
+def test_stages_are_profiled_and_dumped(tmp_path):
+    profiler = Profiler(parse_modes('cprofile,sample,tracemalloc'), str(tmp_path), interval=3600, top_n=5)
+    try:
+        for _ in range(3):
+            with profiler.stage('service'):
+                # nested stages are part of the outer cProfile, but sampled on their own
+                with profiler.stage('api.get_status'): busy(0.1)
+        profiler.profiled('download_files')(busy)(0.1)
+    finally:
+        profiler.close()
+
+    files = set(os.listdir(tmp_path))
+    pid = os.getpid()
+    assert {f'service.{pid}.pstats', f'download_files.{pid}.pstats', f'api.get_status.{pid}.folded', f'summary.{pid}.txt'} <= files
+    assert f'api.get_status.{pid}.pstats' not in files
+    summary = open(tmp_path / f'summary.{pid}.txt').read()
+    assert 'api.get_status' in summary and 'cProfile service' in summary and 'test_profiling.py:busy' in summary and 'tracemalloc' in summary
+    assert '       3 ' in next(line for line in summary.splitlines() if line.startswith('service '))
+
+def test_disabled_profiler_does_nothing(tmp_path):
+    profiler = Profiler(parse_modes(None), str(tmp_path / 'profiles'))
+    with profiler.stage('service'): pass
+    profiler.close()
+    assert not profiler.enabled and not os.path.exists(tmp_path / 'profiles')
+    with pytest.raises(ValueError): parse_modes('cprofile,perf')
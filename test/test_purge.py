@@ -0,0 +1,32 @@
+from pathlib import Path
+import pytest
+import download_data_v3
+from src.purge import PurgeStage
+from src.storage import StorageManager
+from src.utils.tracing import RequestTracer
+
+
+def test_confirmed_purge_frees_the_slot():
+    purged, statuses = [], iter(['Completed', 'Set for Purge'])
+    stage = PurgeStage(lambda request_id: {'status': 'ok'}, lambda request_id: {'status': 'ok', 'data': {'status': next(statuses)}},
+                       purged.append, n_workers=1, confirm_delay=0)
+    stage.submit(7)
+    stage.join()
+    assert purged == [7]
+
+@pytest.mark.parametrize('fails', [False, True])
+def test_only_intact_downloads_are_purged(tmp_path, monkeypatch, fails):
+    def download_files(web_paths, download_dir, throttle=None, dedup=None):
+        if fails: raise IOError('Incomplete download')
+        return [str(download_dir / 'file.grib2')]
+
+    monkeypatch.setattr(download_data_v3, 'admit_download', lambda request_id, target_dir, storage: (target_dir, ['https://x/file.grib2']))
+    monkeypatch.setattr(download_data_v3.rda_client, 'download_files', download_files)
+    purge_requests = []
+    stage = PurgeStage(lambda request_id: purge_requests.append(request_id) or {'status': 'ok'}, lambda request_id: {'status': 'error'},
+                       lambda request_id: None, n_workers=1, confirm_delay=0)
+    storage = StorageManager(tmp_path)
+    download_data_v3.download_worker({'request_index': 7}, Path(tmp_path), str(tmp_path / 'errors.log'), RequestTracer(None), stage,
+                                     storage, lambda request_id: None)
+    stage.join()
+    assert purge_requests == ([] if fails else ['7'])
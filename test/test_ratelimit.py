@@ -0,0 +1,96 @@
+import time
+import threading
+import pytest
+import download_data_v3
+from src.utils.ratelimit import TokenBucket, RetryPolicy, RetryDecision, CircuitBreaker, CircuitState
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=100, capacity=5)
+    # the burst is served at once, the rest at the refill rate
+    assert sum(bucket.acquire() for _ in range(5)) == 0
+    start = time.monotonic()
+    for _ in range(10): bucket.acquire()
+    assert 0.08 <= time.monotonic() - start < 0.5
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=1000, capacity=10)
+    bucket.pause(0.1)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+def test_retry_policy_classify():
+    policy = RetryPolicy()
+    assert policy.classify(200) == RetryDecision.SUCCESS
+    assert policy.classify(429) == RetryDecision.RETRY and policy.classify(503) == RetryDecision.RETRY
+    assert policy.classify(404) == RetryDecision.FAIL
+
+def test_retry_policy_backoff():
+    policy = RetryPolicy(base_delay=2, max_delay=10)
+    for attempt in range(8):
+        assert 0 <= policy.backoff(attempt) <= min(10, 2 * 2**attempt)
+    # Retry-After is a lower bound, also beyond max_delay
+    assert policy.backoff(0, retry_after=30) == 30
+    assert policy.backoff(5, retry_after=0.5) <= 10
+
+def test_parse_retry_after():
+    assert RetryPolicy.parse_retry_after(None) is None
+    assert RetryPolicy.parse_retry_after('12') == 12 and RetryPolicy.parse_retry_after('-3') == 0
+    assert RetryPolicy.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert RetryPolicy.parse_retry_after('soon') is None
+    in_a_minute = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 60))
+    assert 55 <= RetryPolicy.parse_retry_after(in_a_minute) <= 60
+
+def test_circuit_breaker_transitions():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.state == CircuitState.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+
+    # one probe is let through after the reset timeout, a failed probe opens the circuit again
+    start = time.monotonic()
+    breaker.acquire()
+    assert time.monotonic() - start >= 0.09 and breaker.state == CircuitState.HALF_OPEN
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+
+    breaker.acquire()
+    blocked = threading.Thread(target=breaker.acquire)
+    blocked.start()
+    blocked.join(0.05)
+    assert blocked.is_alive()
+    breaker.record_success()
+    blocked.join(1)
+    assert not blocked.is_alive() and breaker.state == CircuitState.CLOSED
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def json(self):
+        return {'status': 'ok'}
+
+    def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize('status_code', [503, 200])
+def test_retried_responses_are_closed(monkeypatch, status_code):
+    monkeypatch.setattr(download_data_v3, 'rate_limiter', TokenBucket(1000, 1000))
+    monkeypatch.setattr(download_data_v3, 'retry_policy', RetryPolicy(max_attempts=3, base_delay=0))
+    monkeypatch.setattr(download_data_v3, 'circuit_breaker', CircuitBreaker(failure_threshold=10))
+    responses = [Response(status_code, {'Retry-After': '0'}), Response(200)]
+
+    def decode(response):
+        # e.g. a streamed response that breaks off while reading it
+        if response.status_code == 200 and response is responses[0]: raise IOError('Connection broken')
+        return response.json()
+
+    calls = iter(responses)
+    def get_status(): return next(calls)
+    assert download_data_v3.request_wrapper(get_status, decode=decode) == {'status': 'ok'}
+    assert responses[0].closed and not responses[1].closed
@@ -0,0 +1,108 @@
+from pathlib import Path
+from datetime import datetime
+import pytest
+from src.scheduler import Backlog, ConfigJob, Scheduler, WorkItem, load_schedule, parse_config_item_spec, split_work_item
+
+
+def make_job(name, n_intervals, priority=0, weight=1.0):
+    return ConfigJob(name, {}, [(idx, idx + 1) for idx in range(n_intervals)], Path('.'), priority, weight)
+
+def test_parse_config_item_spec():
+    assert parse_config_item_spec('solar') == ('solar', 0, 1.0)
+    assert parse_config_item_spec('solar:2:0.5') == ('solar', 2, 0.5)
+
+def test_slots_are_shared_by_weight():
+    scheduler = Scheduler(10, [make_job('solar', 20, weight=1), make_job('temperature', 20, weight=3)])
+    submissions = scheduler.next_submissions(8)
+    names = [job.name for job, _ in submissions]
+    assert names.count('solar') == 2 and names.count('temperature') == 6
+
+def test_in_flight_requests_count_against_share():
+    solar, temperature = make_job('solar', 10), make_job('temperature', 10)
+    scheduler = Scheduler(10, [solar, temperature])
+    for request_id in range(4): scheduler.register_request(request_id, solar)
+    names = [job.name for job, _ in scheduler.next_submissions(6)]
+    assert names.count('solar') == 1 and names.count('temperature') == 5
+
+    scheduler.sync([0, 1])
+    assert scheduler.n_in_flight() == 2 and solar.request_ids == {0, 1}
+
+def test_higher_priority_first():
+    scheduler = Scheduler(10, [make_job('solar', 2, priority=1), make_job('temperature', 10)])
+    names = [job.name for job, _ in scheduler.next_submissions(5)]
+    assert names[:2] == ['solar', 'solar'] and names[2:] == ['temperature'] * 3
+
+def test_pending_submissions_hold_slots():
+    solar = make_job('solar', 10)
+    scheduler = Scheduler(4, [solar])
+    submissions = scheduler.next_submissions(scheduler.free_slots([]))
+    assert len(submissions) == 4 and scheduler.free_slots([]) == 0
+
+    scheduler.complete_submission(solar, 101, request_dict={'param': 'DSWRF', 'product': '3-hour Average'})
+    scheduler.complete_submission(solar, None)
+    assert scheduler.free_slots([]) == 1 and scheduler.request_dict_for(101) == {'param': 'DSWRF', 'product': '3-hour Average'}
+
+    # a request registered after the status snapshot is kept even though it's not listed yet
+    scheduler.sync([], snapshot_time=0)
+    assert scheduler.n_in_flight() == 1
+
+def test_purged_request_frees_slot_while_still_listed():
+    solar = make_job('solar', 10)
+    scheduler = Scheduler(2, [solar])
+    for request_id in (1, 2): scheduler.register_request(request_id, solar)
+    assert scheduler.free_slots([1, 2]) == 0
+
+    scheduler.mark_purged(1)
+    assert scheduler.slot_freed.is_set() and scheduler.free_slots([1, 2]) == 1
+    assert scheduler.wait_for_slot(0) and not scheduler.slot_freed.is_set()
+
+    # once get_status stops listing it, it's forgotten
+    scheduler.sync([2])
+    assert not scheduler.is_purged(1)
+
+def test_failed_work_is_bisected_down_to_the_depth_limit():
+    job = ConfigJob('wind', {'param': 'U GRD/V GRD', 'product': '3-hour Forecast/6-hour Forecast/9-hour Forecast'}, [], Path('.'))
+    scheduler = Scheduler(10, [job], max_split_depth=4)
+    item = WorkItem(datetime(2024, 1, 1, 0), datetime(2024, 1, 1, 18))
+
+    first, second = scheduler.bisect(job, item)
+    assert (first.from_dt, first.to_dt, second.from_dt, second.to_dt) == (datetime(2024, 1, 1, 0), datetime(2024, 1, 1, 6), datetime(2024, 1, 1, 12), datetime(2024, 1, 1, 18))
+    # ahead of the rest of the job, newest first like every backlog by default
+    scheduler.add_intervals(job, [(datetime(2024, 2, 1), datetime(2024, 2, 29))])
+    assert [item for _, item in scheduler.next_submissions(2)] == [second, first]
+
+    # a single cycle is split by products, then by parameters
+    cycle = WorkItem(datetime(2024, 1, 1, 0), datetime(2024, 1, 1, 0), depth=2)
+    products = split_work_item(cycle, job.request_dict)
+    assert [dict(piece.overrides)['product'] for piece in products] == ['3-hour Forecast', '6-hour Forecast/9-hour Forecast']
+    params = split_work_item(products[0], job.request_dict)
+    assert [dict(piece.overrides) for piece in params] == [{'product': '3-hour Forecast', 'param': 'U GRD'}, {'product': '3-hour Forecast', 'param': 'V GRD'}]
+    assert split_work_item(params[0], job.request_dict) == []
+    assert scheduler.bisect(job, params[0]) == [] and scheduler.n_remaining() == 1
+
+def test_backlog_orders():
+    days = [(datetime(2024, 1, day), datetime(2024, 1, day, 18)) for day in range(1, 9)]
+    backlog = Backlog(days)
+    assert [item.from_dt.day for item in backlog] == [8, 7, 6, 5, 4, 3, 2, 1]
+
+    # every prefix covers the month evenly
+    backlog.reprioritise('gaps')
+    assert [backlog.pop().from_dt.day for _ in range(4)] == [1, 5, 3, 7]
+    backlog.push((datetime(2024, 1, 9), datetime(2024, 1, 9, 18)))
+    assert len(backlog) == 5 and backlog.peek().from_dt.day == 2
+
+    backlog.reprioritise('oldest', rank=lambda item: -1 if item.from_dt.day == 8 else None)
+    backlog.push((datetime(2024, 1, 6), datetime(2024, 1, 6, 18)), deadline=datetime(2024, 1, 1))
+    assert [item.from_dt.day for item in backlog] == [8, 6, 2, 4, 6, 9]
+    with pytest.raises(ValueError): Backlog(order='random')
+
+def test_schedule_reprioritises_running_jobs(tmp_path):
+    solar = ConfigJob('solar', {}, [(datetime(2024, month, 1), datetime(2024, month, 28)) for month in range(1, 7)], Path('.'))
+    scheduler = Scheduler(10, [solar, make_job('temperature', 3)])
+    path = tmp_path / 'schedule.json'
+    path.write_text('{"solar": {"order": "oldest", "priority": 1, "first": ["2024-04-01", "2024-05-31"]}}')
+    scheduler.apply_schedule(load_schedule(str(path)))
+    assert solar.priority == 1 and [item.from_dt.month for item in solar.time_intervals] == [4, 5, 1, 2, 3, 6]
+
+    path.write_text('{"solar": {"order": "sideways"}}')
+    with pytest.raises(ValueError): load_schedule(str(path))
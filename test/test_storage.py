@@ -0,0 +1,36 @@
+from pathlib import Path
+from src.storage import StorageManager
+
+
+def make_storage(monkeypatch, tmp_path, disks):
+    # disks: directory name -> (device, total, used)
+    storage = StorageManager(tmp_path / 'primary', [tmp_path / 'spill'], watermark=0.9)
+    monkeypatch.setattr(StorageManager, 'usage', staticmethod(lambda directory: disks[Path(directory).relative_to(tmp_path).parts[0]]))
+    return storage
+
+def test_reservation_spills_to_secondary_dir(monkeypatch, tmp_path):
+    storage = make_storage(monkeypatch, tmp_path, {'primary': (1, 100, 50), 'spill': (2, 100, 0)})
+    assert storage.reserve(1, 30, tmp_path / 'primary' / 'solar') == tmp_path / 'primary' / 'solar'
+    # 50 used + 30 reserved + 30 > 90
+    assert storage.reserve(2, 30, tmp_path / 'primary' / 'solar') == tmp_path / 'spill' / 'solar'
+    assert storage.reserve(3, 80, tmp_path / 'primary' / 'solar') is None
+
+    storage.release(1)
+    assert storage.reserve(3, 30, tmp_path / 'primary') == tmp_path / 'primary'
+
+def test_admissible_requests(monkeypatch, tmp_path):
+    storage = make_storage(monkeypatch, tmp_path, {'primary': (1, 100, 50), 'spill': (1, 100, 50)})
+    assert storage.admissible_requests(3) is None
+
+    storage.reserve(1, 10, tmp_path / 'primary')
+    # one file system, 90 - 50 - 10 = 30 bytes left for requests of 10 bytes
+    assert storage.available_bytes() == 30
+    assert storage.admissible_requests(1) == 2 and storage.admissible_requests(5) == 0
+
+
+def test_retried_reservations_count_once(monkeypatch, tmp_path):
+    storage = make_storage(monkeypatch, tmp_path, {'primary': (1, 100, 50), 'spill': (1, 100, 50)})
+    storage.reserve(1, 10, tmp_path / 'primary')
+    # a deferred request that doesn't fit is retried until it does
+    for _ in range(5): assert storage.reserve(2, 50, tmp_path / 'primary') is None
+    assert storage.expected_request_size() == 30
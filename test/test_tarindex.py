@@ -0,0 +1,39 @@
+import os
+from datetime import datetime
+from src.processing.grib import MessageInfo, iter_message_spans, select_times
+from src.processing.tarindex import TarIndex, index_path, parse_member_name, read_index, select_members
+from .helpers import fake_grib2, write_tar
+
+
+def test_parse_member_name():
+    assert parse_member_name('gfs.0p25.2024010106.f012.grib2') == (datetime(2024, 1, 1, 6), 12)
+    assert parse_member_name('README') == (None, None)
+
+def test_index_lookup_and_staleness(tmp_path):
+    path = str(tmp_path / 'request.tar')
+    members = [(f'gfs.0p25.2024010100.f{step:03d}.grib2', fake_grib2(bytes([step]) * 100) * 2) for step in (3, 6, 9)]
+    write_tar(path, members)
+
+    index = TarIndex(path)
+    assert os.path.exists(index_path(path)) and len(index) == 3
+    member = index.find(datetime(2024, 1, 1), 6)
+    assert index.read(member) == members[1][1]
+    with open(path, 'rb') as file: buffer = file.read()
+    assert [offset for offset, _ in iter_message_spans(buffer, member.offset, member.offset + member.size)] == \
+        [member.offset, member.offset + len(members[1][1]) // 2]
+
+    assert read_index(path) == index.members
+    write_tar(path, members[:2])
+    assert read_index(path) is None and len(TarIndex(path)) == 2
+
+def test_members_are_selected_by_init_and_step(tmp_path):
+    path = str(tmp_path / 'request.tar')
+    write_tar(path, [(f'gfs.0p25.{init}.f{step:03d}.grib2', fake_grib2(b'x' * 10)) for init in ('2024010100', '2024010106') for step in (3, 6, 9)])
+    selected = select_members(path, (datetime(2024, 1, 1, 6), datetime.max), [6, 9])
+    assert [member.name for member in selected] == ['gfs.0p25.2024010106.f006.grib2', 'gfs.0p25.2024010106.f009.grib2']
+    # nothing to filter, or not a tar: the whole file is read
+    assert select_members(path) is None and select_members(str(tmp_path / 'field.grib2'), steps=[6]) is None
+
+    select = select_times(lambda info: info.param == 'TMP', steps=[6])
+    info = MessageInfo('TMP', 'HTGL', 2.0, 'instant', 0, 6, datetime(2024, 1, 1))
+    assert select(info) and not select(info._replace(end_step=3)) and not select(info._replace(param='RH'))
@@ -0,0 +1,56 @@
+from src.utils.tracing import TraceEvent, RequestTracer, load_traces, phase_durations, percentile, summarise, report
+
+
+def record_requests(trace_dir):
+    # request 1 goes through every phase, 2 is seen Completed right away, 3 is still downloading
+    tracer = RequestTracer(str(trace_dir / 'gfs.jsonl'), 'gfs')
+    tracer.record(1, TraceEvent.SUBMITTED, 0)
+    tracer.record_status(1, 'Queued for Processing', 60)
+    tracer.record_status(1, 'Queued for Processing', 120)
+    tracer.record_status(1, 'Processing', 180)
+    tracer.record_status(1, 'Completed', 600)
+    tracer.record(1, TraceEvent.DOWNLOAD_START, 660)
+    tracer.record(1, TraceEvent.DOWNLOAD_END, 4260, n_files=12)
+    tracer.record(1, TraceEvent.PURGED, 4320)
+    tracer.record(2, TraceEvent.SUBMITTED, 0)
+    tracer.record_status(2, 'Completed', 300)
+    tracer.record(2, TraceEvent.DOWNLOAD_START, 300)
+    tracer.record(2, TraceEvent.DOWNLOAD_END, 1500)
+    tracer.record(2, TraceEvent.PURGED, 1500)
+
+    # another service, the download of request 3 was picked up after a restart
+    tracer = RequestTracer(str(trace_dir / 'solar.jsonl'), 'solar')
+    tracer.record(3, TraceEvent.SUBMITTED, 0)
+    tracer.record_status(3, 'Completed', 900)
+    tracer.record_status(3, 'Completed', 960)
+    RequestTracer(str(trace_dir / 'restart.jsonl')).record(3, TraceEvent.DOWNLOAD_START, 1200)
+
+def test_phase_durations(tmp_path):
+    record_requests(tmp_path)
+    traces = load_traces(sorted(map(str, tmp_path.glob('*.jsonl'))))
+    assert traces[1]['fields'] == {'n_files': 12} and traces[3]['config_item'] == 'solar'
+    assert phase_durations(traces[1]['events']) == {'queue': 180, 'processing': 420, 'download_wait': 60, 'download': 3600, 'purge': 60, 'total': 4320}
+    assert phase_durations(traces[2]['events']) == {'queue': 300, 'processing': 0, 'download_wait': 0, 'download': 1200, 'purge': 0, 'total': 1500}
+    assert phase_durations(traces[3]['events']) == {'queue': 900, 'processing': 0, 'download_wait': 300}
+
+def test_percentiles():
+    assert percentile([5.0], 90) == 5.0
+    assert percentile([4.0, 1.0, 3.0, 2.0], 50) == 2.5
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 90) == 4.6
+    assert percentile([1.0, 2.0, 3.0], 100) == 3.0
+
+def test_summary_and_report(tmp_path):
+    record_requests(tmp_path)
+    summary = summarise(load_traces(sorted(map(str, tmp_path.glob('*.jsonl')))))
+    assert summary['all']['queue'] == {'n': 3, 'mean': 460, 'p50': 300, 'p90': 780, 'p99': 888, 'max': 900}
+    assert summary['gfs']['download'] == {'n': 2, 'mean': 2400, 'p50': 2400, 'p90': 3360, 'p99': 3576, 'max': 3600}
+    assert list(summary['solar']) == ['queue', 'processing', 'download_wait']
+
+    lines = report(str(tmp_path)).splitlines()
+    assert lines[0] == '3 traced requests from 3 trace files'
+    assert [line for line in lines[1:] if line and not line.startswith(' ')] == ['gfs', 'solar', 'all']
+    assert lines[lines.index('gfs') + 1].split() == ['phase', 'n', 'mean', 'p50', 'p90', 'p99', 'max']
+    assert lines[lines.index('gfs') + 5].split() == ['download', '2', '40.0m', '40.0m', '56.0m', '59.6m', '60.0m']
+
+    lines = report(str(tmp_path), 'solar').splitlines()
+    assert lines[0] == '1 traced requests from 3 trace files' and 'gfs' not in lines and 'all' in lines
@@ -0,0 +1,98 @@
+"""Measure download write throughput to local disk, without the network.
+
+Compares the old write path (a new bytes object per 1 MiB chunk, written to the final name)
+with StreamWriter at several buffer sizes and fsync batch sizes.
+
+Usage:
+    python -m tools.benchmark_disk_write [--target_dir /data/gfs] [--size_mb 1024] [--repeat 3] [--sync]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils.diskio import StreamWriter
+
+MiB = 1 << 20
+
+
+class SyntheticStream(object):
+    """Serves size bytes from a fixed block, like a streamed response body."""
+
+    def __init__(self, size: int, block: bytes):
+        self.remaining = size
+        self.block = memoryview(block)
+
+    def read(self, n: int) -> bytes:
+        n = min(n, self.remaining, len(self.block))
+        self.remaining -= n
+        return bytes(self.block[:n])
+
+    def readinto(self, buffer: memoryview) -> int:
+        n = min(len(buffer), self.remaining, len(self.block))
+        buffer[:n] = self.block[:n]
+        self.remaining -= n
+        return n
+
+
+def write_iter_content(stream: SyntheticStream, path: str, chunk_size: int = MiB) -> None:
+    # the write path of download_files before StreamWriter
+    with open(path, 'wb') as file:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk: break
+            file.write(chunk)
+
+def run(name: str, write: Callable[[SyntheticStream, str], None], target_dir: str, size: int, block: bytes,
+        repeat: int, sync: bool) -> Dict[str, Any]:
+    path = os.path.join(target_dir, 'benchmark_disk_write.bin')
+    throughputs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        write(SyntheticStream(size, block), path)
+        if sync: os.sync()
+        elapsed = time.perf_counter() - start
+        throughputs.append(size / MiB / elapsed)
+        os.remove(path)
+    return {'name': name, 'mb_s': statistics.median(throughputs), 'min_mb_s': min(throughputs), 'max_mb_s': max(throughputs)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Disk write throughput of the download write path')
+    parser.add_argument('--target_dir', default=tempfile.gettempdir(), help='Directory on the disk to benchmark')
+    parser.add_argument('--size_mb', type=int, default=1024, help='Size of the written file')
+    parser.add_argument('--buffer_sizes_kb', type=int, nargs='+', default=[256, 1024, 4096, 16384], help='StreamWriter buffer sizes to compare')
+    parser.add_argument('--fsync_mb', type=int, nargs='+', default=[64], help='fsync batch sizes to compare (with a 4 MiB buffer)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per variant, the median is reported')
+    parser.add_argument('--sync', action='store_true', help='Include flushing the page cache (os.sync) in every measurement')
+    parser.add_argument('--output', help='Append the results as a JSON line to this file')
+    args = parser.parse_args()
+
+    size = args.size_mb * MiB
+    block = os.urandom(max(args.buffer_sizes_kb) * 1024)
+    variants = [('iter_content 1 MiB', write_iter_content)]
+    for buffer_kb in args.buffer_sizes_kb:
+        variants.append((f'StreamWriter {buffer_kb} KiB', lambda stream, path, buffer_kb=buffer_kb: StreamWriter(buffer_kb * 1024).write(stream, path, size)))
+    for fsync_mb in args.fsync_mb:
+        variants.append((f'StreamWriter 4096 KiB, fsync every {fsync_mb} MiB',
+                         lambda stream, path, fsync_mb=fsync_mb: StreamWriter(4 * MiB, fsync_mb * MiB).write(stream, path, size)))
+
+    print(f'Writing {args.size_mb} MiB to {args.target_dir}, median of {args.repeat} runs')
+    results = []
+    for name, write in variants:
+        result = run(name, write, args.target_dir, size, block, args.repeat, args.sync)
+        results.append(result)
+        print(f'  {name:<45} {result["mb_s"]:8.0f} MB/s  ({result["min_mb_s"]:.0f}-{result["max_mb_s"]:.0f})')
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'a') as file:
+            file.write(json.dumps({'timestamp': time.time(), 'target_dir': args.target_dir, 'size_mb': args.size_mb, 'sync': args.sync, 'results': results}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
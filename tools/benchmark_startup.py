@@ -0,0 +1,84 @@
+"""Measure interpreter startup and import cost per entry point with `python -X importtime`.
+
+Usage:
+    python -m tools.benchmark_startup [--repeat 5] [--top 10] [--output data_cache/startup_benchmark.jsonl]
+
+Appending to --output keeps a history, so regressions in import cost show up over time.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import *
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = {
+    'download_data_v3': ['-c', 'import download_data_v3'],
+    'download_data_v3 --help': ['download_data_v3.py', '--help'],
+    'download_data_v3 report': ['download_data_v3.py', 'report', '--trace_dir', os.devnull],
+    'rdams_client': ['-c', 'import src.python.rdams_client'],
+}
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """Return (module, nesting depth, self us, cumulative us) from -X importtime output."""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line: continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return modules
+
+def run_entry_point(args: List[str]) -> Tuple[float, List[Tuple[str, int, int, int]]]:
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, capture_output=True, text=True, cwd=REPO_ROOT)
+    elapsed = time.perf_counter() - start
+    return elapsed, parse_importtime(process.stderr)
+
+def benchmark(repeat: int, top: int) -> Dict[str, Any]:
+    results = {}
+    for name, args in ENTRY_POINTS.items():
+        run_entry_point(args) # warm up the file system cache and bytecode
+        wall_times, import_times, heaviest = [], [], {}
+        for _ in range(repeat):
+            elapsed, modules = run_entry_point(args)
+            wall_times.append(elapsed)
+            # top-level imports only, nested ones are included in their cumulative time
+            import_times.append(sum(cumulative for _, depth, _, cumulative in modules if depth == 0))
+            for module, _, _, cumulative in modules:
+                heaviest[module] = max(heaviest.get(module, 0), cumulative)
+
+        results[name] = {
+            'wall_ms': statistics.median(wall_times) * 1000,
+            'imports_ms': statistics.median(import_times) / 1000,
+            'n_modules': len(modules),
+            'heaviest': sorted(heaviest.items(), key=lambda item: -item[1])[:top],
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup/import time benchmark of the CLI entry points')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per entry point, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='Number of heaviest imports to list per entry point')
+    parser.add_argument('--output', help='Append the results as a JSON line to this file')
+    args = parser.parse_args()
+
+    results = benchmark(args.repeat, args.top)
+    for name, result in results.items():
+        print(f'\n{name}: wall {result["wall_ms"]:.0f} ms, imports {result["imports_ms"]:.0f} ms, {result["n_modules"]} modules')
+        for module, cumulative in result['heaviest']:
+            print(f'  {cumulative / 1000:8.1f} ms  {module}')
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'a') as file:
+            file.write(json.dumps({'timestamp': time.time(), 'python': sys.version.split()[0], 'results': results}) + '\n')
+
+
+if __name__ == '__main__':
+    main()